@@ -1,2 +1,3 @@
 from archipelago import *
+from async_archipelago import AsyncArchipelago
 import setup.models as models
\ No newline at end of file
@@ -1,47 +1,199 @@
 import sqlite3
 import os
+import time
 
-from sqlalchemy import create_engine 
-from sqlalchemy.orm import sessionmaker  
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session, subqueryload, joinedload
 
 from setup.models import MPCommons, Address, Office
-from setup import setup_archipelago
+from setup import setup_archipelago, refresh_archipelago, rollback_archipelago
+from setup.generation import read_generation
+from setup.migrations import migrate
+from setup import search_index, history
+from query_cache import QueryCache, cached_query, cache_check_interval
+from records import build_records
+from instrumentation import QueryCounter
+from engines import registry
+import columnar
+import lookups
+from resolver import TwitterResolver
+from frozen import FrozenArchipelago
+from graph import OfficeGraph, office_pairs, people, graph_check_interval
 
 
 
+# relationships which the ORM accessors can load eagerly, eg. get_all_mps(load=('offices',))
+RELATIONSHIPS = {'addresses':MPCommons.Addresses, 'offices':MPCommons.Offices}
+LOAD_STRATEGIES = {'subquery':subqueryload, 'joined':joinedload}
+
+
 class Archipelago(object):
 
-    # totally run into problems if more than one db
-    _db_url = None 
-    _engine = None 
-    _session_factory = sessionmaker()
-    
-    def __init__(self, database=None):
-        if not self._db_url:
-            self._db_url = os.getenv('ARCHIPELAGO_DB', 'sqlite:///parl.db')
-
-        if  database != None:
-            # effectively a 'reset' & change db. not ideal. this all needs serious rework.
-            self._db_url = database
-            self._engine = None
-        
-        if not self._engine:
-            self._engine = create_engine(self._db_url, echo=False)
-            self._session_factory.configure(bind=self._engine)
+    def __init__(self, database=None, cache=False, cache_size=128, cache_ttl=None,
+                 read_only=False, cache_check_interval=cache_check_interval):
+        self._db_url = database or os.getenv('ARCHIPELAGO_DB', 'sqlite:///parl.db')
+
+        # the engine is shared by every Archipelago on this url, the sessions are this
+        # instance's own: one per thread using it
+        self._engine = registry.engine(self._db_url, read_only)
+        self._session_factory = registry.session_factory(self._db_url, read_only)
+        self._sessions = scoped_session(self._session_factory)
+
+        # a read only database is served as it is: never built or migrated here.
+        # read_only='replica' also skips locking, for copies which are never written
+        if not read_only:
+            registry.ensure_schema(self._db_url, self._build, self._upgrade,
+                [MPCommons.__tablename__, Address.__tablename__, Office.__tablename__])
+
+        # opt in memoization of the accessors, invalidated by the db generation stamp
+        self._query_cache = QueryCache(cache_size, cache_ttl, 
+                                       cache_check_interval) if cache else None
+        self._office_graph = None
+        self._graph_checked = 0
+        self.graph_check_interval = graph_check_interval
+        self._twitter_resolver = None
+
+    def _build(self):
+        engine, session_factory = setup_archipelago(self._db_url)
+        engine.dispose()
+
+    def _upgrade(self):
+        # add any indexes & columns introduced since the db was built
+        migrate(self._engine, self._session_factory)
+
+    @property
+    def session(self):
+        """The calling thread's session for this database."""
+        return self._sessions()
+
+    def close(self):
+        """Close the calling thread's session, handing its connection back."""
+        self._sessions.remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def generation(self):
+        """Return the stamp which changes every time setup or refresh writes to the database."""
+        return read_generation(self._engine)
+
+    def cache_stats(self):
+        """Return hit/miss statistics for the query cache, or None if caching is off."""
+        return self._query_cache.stats() if self._query_cache else None
+
+    def count_queries(self):
+        """Return a context manager counting the SQL statements run inside it."""
+        return QueryCounter(self._engine)
+
+    def _mp_query(self, load=(), strategy='subquery'):
+        # one extra query per relationship with 'subquery', none with 'joined', 
+        # rather than one per MP per relationship when touched lazily
+        query = self.session.query(MPCommons)
+        for name in load:
+            if name not in RELATIONSHIPS:
+                raise ValueError("Can't load %r, choose from %s" % (name, sorted(RELATIONSHIPS)))
+            query = query.options(LOAD_STRATEGIES[strategy](RELATIONSHIPS[name]))
+        return query
 
-        if  not self._engine.has_table(MPCommons.__tablename__) or \
-            not self._engine.has_table(Address.__tablename__) or \
-            not self._engine.has_table(Office.__tablename__): 
-           self._engine, self._session_factory = setup_archipelago(self._db_url)
+    def search(self, query, limit=10):
+        """Return up to limit MPs matching query by name, constituency, party or office,
+        best first, as dicts of name, party, constituency and score. Matches prefixes 
+        and tolerates misspellings."""
+        return search_index.search(self.session, query, limit)
 
+    def as_of(self, date):
+        """Return a view of the membership and office history on date (a date or 
+        'YYYY-MM-DD'): who sat for each seat, and who held which office."""
+        return history.AsOf(self.session, date)
 
-        self.session = self._session_factory()
+    def get_memberships(self, since=None, until=None, constituency=None, person_id=None):
+        """Return the membership intervals overlapping since..until (either may be
+        left open), eg. get_memberships(since='2010-05-06') for every MP since 2010."""
+        return history.memberships(self.session, since, until, constituency, person_id)
 
+    def refresh(self):
+        """Update the database in place from TWFY and GOV, returning a summary of changes."""
+        summary = refresh_archipelago(self._db_url)
+        self.session.expire_all()
+        if self._query_cache is not None:
+            self._query_cache.invalidate()
+        self._graph_checked = 0
+        return summary
+
+    def freeze(self):
+        """Load the whole database into a FrozenArchipelago: immutable records with 
+        hash indexes, answering the same queries without touching the database."""
+        return FrozenArchipelago.from_connectable(self._engine)
+
+    def twitter_resolver(self):
+        """Return this database's TwitterResolver: screen name (or '@handle', or 
+        twitter url, in any case) to MPRecord, from a map kept in memory and 
+        reloaded when the database changes."""
+        if self._twitter_resolver is None:
+            self._twitter_resolver = TwitterResolver(self._engine)
+        return self._twitter_resolver
+
+    def office_graph(self):
+        """Return the OfficeGraph of MPs and the committees they currently sit on,
+        built on first use and kept until the db generation changes, which is
+        checked at most every graph_check_interval seconds. After a refresh only
+        the rows of people and committees whose offices changed are rebuilt."""
+        graph = self._office_graph
+        if graph is not None and time.time() - self._graph_checked < self.graph_check_interval:
+            return graph
+
+        if graph is None:
+            graph = OfficeGraph.from_connectable(self._engine)
+        else:
+            generation = self.generation()
+            if graph.generation != generation:
+                graph = graph.updated(office_pairs(self._engine), people(self._engine), 
+                                      generation)
+        self._office_graph = graph
+        self._graph_checked = time.time()
+        return graph
+
+    def get_committee_neighbours(self, person_id):
+        """Return [(PersonId, committees shared)] for every MP sharing a committee 
+        or department with person_id, most shared first."""
+        return self.office_graph().neighbours(person_id)
+
+    def get_co_membership(self, person_a, person_b):
+        """Return the number of committees and departments both MPs sit on."""
+        return self.office_graph().co_membership(person_a, person_b)
+
+    def get_party_co_membership(self):
+        """Return {(party, party): pairs of MPs sitting on a committee together}."""
+        return self.office_graph().party_co_membership()
+
+    def get_committee_path(self, person_a, person_b):
+        """Return the shortest chain of shared committees linking two MPs, as
+        [PersonId, committee, PersonId, ...], or None if they are not linked."""
+        return self.office_graph().shortest_path(person_a, person_b)
+
+    def export_columns(self, directory, compressed=False):
+        """Write MPCommons, Offices and Addresses to directory as numpy columns, for 
+        columnar.load_columns to memory map. Needs numpy."""
+        return columnar.export_columns(self._engine, directory, compressed)
+
+    def rollback(self):
+        """Put back the database the last setup replaced. Returns False if there is none."""
+        self.close()
+        if self._query_cache is not None:
+            self._query_cache.invalidate()
+        self._graph_checked = 0
+        return rollback_archipelago(self._db_url)
+
+    @cached_query
     def get_constituencies(self):
         """Return a python list of constituencies in the archipelago database.""" 
 
         return [constit[0] for constit in self.session.query(MPCommons.Constituency).all()]
 
+    @cached_query
     def get_twitter_users(self):
         """Return a python list of constituencies in the archipelago database.""" 
         
@@ -57,24 +209,73 @@ class Archipelago(object):
                     "constituency":MP.Constituency,
                     "o_id":MP.OfficialId, 
                     "twitter_url":twitter_url, 
-                    "handle":twitter_url[20:] 
+                    "handle":MP.TwitterHandle 
                     } for MP, twitter_url in results 
                 ]
 
-    def get_all_mps(self):
-        return self.session.query(MPCommons).order_by(MPCommons.Name).all()
+    def _mp_records(self, statement, as_records):
+        # column level Core query: no ORM instances, no identity map
+        return build_records(self.session.execute(statement), as_records)
+
+    @cached_query
+    def get_all_mps(self, as_records=False, load=(), strategy='subquery'):
+        """Return every MP ordered by name. With as_records=True (or 'dict') return 
+        lightweight MPRecord namedtuples (or dicts) instead of MPCommons objects.
+        load=('addresses', 'offices') loads those relationships eagerly, using 
+        the 'subquery' or 'joined' strategy."""
+        if as_records:
+            table = MPCommons.__table__
+            return self._mp_records(select([table]).order_by(table.c.Name), as_records)
 
-    def get_all_tweeting_mps(self):
-        return self.session.query(MPCommons).\
+        return self._mp_query(load, strategy).order_by(MPCommons.Name).all()
+
+    @cached_query
+    def get_all_tweeting_mps(self, as_records=False, load=(), strategy='subquery'):
+        if as_records:
+            table, addresses = MPCommons.__table__, Address.__table__
+            return self._mp_records(
+                select([table]).\
+                    select_from(table.join(addresses, addresses.c.OfficialId==table.c.OfficialId)).\
+                    where(addresses.c.AddressType=='twitter').\
+                    order_by(table.c.Name), as_records)
+
+        return self._mp_query(load, strategy).\
             join(MPCommons.Addresses).\
             filter(Address.AddressType=='twitter').\
             order_by(MPCommons.Name).all()
 
 
-    def get_mps_by_official_id(self, o_id_list):
-        return self.session.query(MPCommons).filter(MPCommons.OfficialId.in_(o_id_list)).order_by(MPCommons.Name).all()
-
-
+    @cached_query
+    def get_mps_by_official_id(self, o_id_list, as_records=False, load=(), strategy='subquery'):
+        if as_records:
+            table = MPCommons.__table__
+            return self._mp_records(
+                select([table]).where(table.c.OfficialId.in_(o_id_list)).order_by(table.c.Name),
+                as_records)
 
+        return self._mp_query(load, strategy).filter(MPCommons.OfficialId.in_(o_id_list)).order_by(MPCommons.Name).all()
 
+    def lookup_mps(self, keys, by='OfficialId', as_columns=False):
+        """Look MPs up by a list of keys of any length: OfficialIds, or PersonIds, 
+        MemberIds or TwitterHandles with by=. Returns a list aligned with keys of 
+        MPRecords, with None for each key which matched nothing. as_columns=True
+        returns numpy masked arrays instead, one per column, masked on misses, 
+        and a boolean 'found' array. Needs numpy."""
+        records = lookups.lookup_mps(self.session, keys, by)
+        if as_columns:
+            return columnar.aligned_columns(MPCommons.__table__, records)
+        return records
 
+    @cached_query
+    def get_current_offices(self, person_id=None, department=None):
+        """Return the Offices currently held, optionally by one person (PersonId) or 
+        in one department or committee, ordered by person. Served from the IsCurrent 
+        indexes rather than comparing dates. IsCurrent is worked out by each setup and
+        refresh, so an office whose EndDate has passed since is still listed until
+        the next refresh (which updates it, even if nothing else changed)."""
+        query = self.session.query(Office).filter(Office.IsCurrent==True)
+        if person_id is not None:
+            query = query.filter(Office.PersonId==person_id)
+        if department is not None:
+            query = query.filter(Office.Office==department)
+        return query.order_by(Office.PersonId, Office.Office, Office.Title).all()
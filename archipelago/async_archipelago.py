@@ -0,0 +1,217 @@
+import sys
+import threading
+import traceback
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from archipelago import Archipelago
+from setup import setup_archipelago
+
+
+class Future(object):
+    """ The pending result of an AsyncArchipelago call. Block on result(), or register
+    a callback, eg. to hand the result back to an event loop:
+
+        future.add_done_callback(lambda f: ioloop.add_callback(handle, f))
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._finished = False
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError()
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """ fn(future) runs on the worker which completes the future, or straight away
+        if it already has. Keep it short: hand off to your own loop. """
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            self._result, self._exc_info = result, exc_info
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        # callbacks run before result() returns to anyone waiting
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+        self._done.set()
+
+
+def _records_mode(as_records):
+    # ORM objects belong to the worker's session: only records may cross threads
+    if as_records not in (True, 'dict'):
+        raise ValueError("as_records must be True or 'dict', not %r: ORM objects can't "
+                         "leave the worker's session" % (as_records,))
+    return as_records
+
+
+class AsyncArchipelago(object):
+    """ Non-blocking counterpart of Archipelago. Every method returns a Future at once;
+    the queries run on a small pool of workers, each with its own Archipelago session.
+
+    Results are records (MPRecord namedtuples, or dicts with as_records='dict'), never
+    ORM objects, which belong to the worker's session. Concurrent calls are merged:
+    identical calls in flight share one query, and get_mps_by_official_id lookups
+    waiting for a worker are answered together by a single IN (...) query. So a burst
+    of lookups costs a few queries, rather than a place each in the pool's queue. """
+
+    def __init__(self, database=None, workers=4):
+        self.database = database
+        self._pool = ThreadPool(workers)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._lookups = []
+        self._lookup_scheduled = False
+
+    def _archipelago(self):
+        # made lazily on each worker, so even building a missing db happens off the caller's thread
+        if getattr(self._local, 'archipelago', None) is None:
+            self._local.archipelago = Archipelago(self.database)
+        return self._local.archipelago
+
+    def _run(self, fn, *args):
+        # on a worker: hand the connection back between calls, so no session outlives its job
+        try:
+            return fn(*args)
+        finally:
+            if getattr(self._local, 'archipelago', None) is not None:
+                self._local.archipelago.close()
+
+    def _submit(self, fn, *args):
+        future = Future()
+        def run():
+            try:
+                future.set_result(self._run(fn, *args))
+            except Exception:
+                future.set_exception(sys.exc_info())
+        self._pool.apply_async(run)
+        return future
+
+    def _shared(self, key, fn, *args):
+        # one query for every identical call made while it is in flight
+        with self._lock:
+            if key in self._in_flight:
+                return self._in_flight[key]
+            future = self._in_flight[key] = self._submit(fn, *args)
+
+        def forget(done):
+            with self._lock:
+                self._in_flight.pop(key, None)
+        future.add_done_callback(forget)
+        return future
+
+    def setup(self, **kwargs):
+        """ (Re)build the database in the background, eg. setup(pipelined=True).
+        Takes the same arguments as setup_archipelago. """
+        def build():
+            setup_archipelago(self.database or 'sqlite:///parl.db', **kwargs)
+            return self._archipelago().generation()
+        return self._submit(build)
+
+    def refresh(self):
+        return self._submit(lambda: self._archipelago().refresh())
+
+    def generation(self):
+        return self._submit(lambda: self._archipelago().generation())
+
+    def search(self, query, limit=10):
+        return self._shared(('search', query, limit),
+                            lambda: self._archipelago().search(query, limit))
+
+    def get_constituencies(self):
+        return self._shared(('get_constituencies',),
+                            lambda: self._archipelago().get_constituencies())
+
+    def get_twitter_users(self):
+        return self._shared(('get_twitter_users',),
+                            lambda: self._archipelago().get_twitter_users())
+
+    def get_all_mps(self, as_records=True):
+        as_records = _records_mode(as_records)
+        return self._shared(('get_all_mps', as_records),
+                            lambda: self._archipelago().get_all_mps(as_records=as_records))
+
+    def get_all_tweeting_mps(self, as_records=True):
+        as_records = _records_mode(as_records)
+        return self._shared(('get_all_tweeting_mps', as_records),
+                            lambda: self._archipelago().get_all_tweeting_mps(as_records=as_records))
+
+    def get_mps_by_official_id(self, o_id_list, as_records=True):
+        as_records = _records_mode(as_records)
+        future = Future()
+        with self._lock:
+            self._lookups.append((list(o_id_list), as_records, future))
+            schedule = not self._lookup_scheduled
+            self._lookup_scheduled = True
+        if schedule:
+            self._pool.apply_async(self._run, (self._run_lookups,))
+        return future
+
+    def lookup_mps(self, keys, by='OfficialId', as_columns=False):
+        keys = list(keys)
+        return self._submit(lambda: self._archipelago().lookup_mps(keys, by, as_columns))
+
+    def _run_lookups(self):
+        with self._lock:
+            lookups, self._lookups = self._lookups, []
+            self._lookup_scheduled = False
+
+        try:
+            ids = sorted(set(o_id for o_ids, _, _ in lookups for o_id in o_ids))
+            records = [r for r in self._archipelago().lookup_mps(ids) if r is not None]
+            # sorted by name, as the sync accessor is
+            records.sort(key=lambda record: record.Name)
+        except Exception:
+            exc_info = sys.exc_info()
+            for _, _, future in lookups:
+                future.set_exception(exc_info)
+            return
+
+        for o_ids, as_records, future in lookups:
+            wanted = set(o_ids)
+            found = [r for r in records if r.OfficialId in wanted]
+            if as_records == 'dict':
+                found = [r._asdict() for r in found]
+            future.set_result(found)
+
+    def close(self):
+        """ Finish the calls already made, then release the workers """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,216 @@
+import os
+import json
+
+from sqlalchemy import select, Integer, Boolean, Date
+
+from setup.models import MPCommons, Office, Address
+from setup.generation import read_generation
+
+
+# one .npy file per column, described by a json manifest. Low cardinality strings are
+# dictionary encoded: int32 codes (-1 for None) into an array of the distinct values.
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+TABLES = [MPCommons.__table__, Office.__table__, Address.__table__]
+DICTIONARY_COLUMNS = {
+    MPCommons.__tablename__:('Party',),
+    Office.__tablename__:('Office', 'Title'),
+    Address.__tablename__:('AddressType',),
+}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Columnar snapshots need numpy installed")
+    return numpy
+
+def _encode(np, table, column, values):
+    """ Return {role: array} for a column: values (+ mask), or codes + dictionary """
+    nulls = [v is None for v in values]
+
+    if column.name in DICTIONARY_COLUMNS.get(table.name, ()):
+        dictionary = sorted(set(v for v in values if v is not None))
+        index = dict((v, i) for i, v in enumerate(dictionary))
+        return {'codes':np.array([index.get(v, -1) for v in values], dtype=np.int32),
+                'dictionary':np.array(dictionary, dtype=np.unicode_)}
+
+    arrays = {'values':_values(np, column, values)}
+    if any(nulls):
+        arrays['mask'] = np.array(nulls, dtype=np.bool_)
+    return arrays
+
+def _values(np, column, values):
+    # None becomes 0, False, NaT or u'': the mask says which were None
+    if isinstance(column.type, Integer):
+        return np.array([0 if v is None else v for v in values], dtype=np.int64)
+    if isinstance(column.type, Boolean):
+        return np.array([bool(v) for v in values], dtype=np.bool_)
+    if isinstance(column.type, Date):
+        return np.array(values, dtype='datetime64[D]')
+    # fixed width unicode, so the file can be memory mapped
+    return np.array([u'' if v is None else v for v in values], dtype=np.unicode_)
+
+def aligned_columns(table, rows):
+    """ rows (tuples of table's columns, or None for a miss) as {column name: numpy
+    masked array}, masked where the value is None, and a boolean 'found' array. 
+    Row i of every array is rows[i], so the columns line up with the input. """
+    np = _numpy()
+    # each distinct row (by identity) is encoded once, then gathered by index: a
+    # miss points at a last row of Nones
+    positions = {}
+    distinct = []
+    index = []
+    for row in rows:
+        if row is None:
+            index.append(-1)
+            continue
+        if id(row) not in positions:
+            positions[id(row)] = len(distinct)
+            distinct.append(row)
+        index.append(positions[id(row)])
+    index = np.array(index, dtype=np.int64)
+    found = index >= 0
+    index[~found] = len(distinct)
+
+    columns = {'found':found}
+    for i, column in enumerate(table.columns):
+        values = [row[i] for row in distinct] + [None]
+        columns[column.name] = np.ma.array(_values(np, column, values)[index],
+                                           mask=np.array([v is None for v in values])[index])
+    return columns
+
+def export_columns(connectable, directory, compressed=False):
+    """ Write MPCommons, Offices and Addresses as columns under directory: a .npy file
+    per column, which load_columns can memory map, or with compressed=True a single
+    compressed .npz per table, which is smaller but must be read into memory.
+    Returns the manifest. """
+    np = _numpy()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    manifest = {'format':FORMAT_VERSION, 'generation':read_generation(connectable),
+                'compressed':compressed, 'tables':{}}
+    for table in TABLES:
+        rows = connectable.execute(select([table])).fetchall()
+        columns = {}
+        arrays = {}
+        for i, column in enumerate(table.columns):
+            encoded = _encode(np, table, column, [row[i] for row in rows])
+            columns[column.name] = dict((role, '%s.%s' % (column.name, role)) for role in encoded)
+            arrays.update(('%s.%s' % (column.name, role), array)
+                            for role, array in encoded.items())
+
+        if compressed:
+            np.savez_compressed(os.path.join(directory, table.name + '.npz'), **arrays)
+        else:
+            for name, array in arrays.items():
+                np.save(os.path.join(directory, '%s.%s.npy' % (table.name, name)), array)
+        manifest['tables'][table.name] = {'rows':len(rows), 'columns':columns,
+                                          'order':[c.name for c in table.columns]}
+
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class DictionaryColumn(object):
+    """ A dictionary encoded column: codes index into dictionary, -1 is None """
+
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code(self, value):
+        """ The code for value, -1 if it never occurs: filter with column.codes == code """
+        matches = (self.dictionary == value).nonzero()[0]
+        return int(matches[0]) if len(matches) else -1
+
+    def decode(self):
+        return [None if c < 0 else self.dictionary[c] for c in self.codes.tolist()]
+
+
+class ColumnTable(object):
+    """ The columns of one exported table, each opened on first use. table['Name'] is 
+    a numpy array (of values, with a mask where nulls occur: see table.mask), or a 
+    DictionaryColumn. """
+
+    def __init__(self, name, rows, order, files, load):
+        self.name = name
+        self.rows = rows
+        self.order = order
+        self._files = files
+        self._load = load
+        self._columns = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            files = self._files[column]
+            if 'codes' in files:
+                self._columns[column] = DictionaryColumn(self._load(files['codes']),
+                                                         self._load(files['dictionary']))
+            else:
+                self._columns[column] = self._load(files['values'])
+        return self._columns[column]
+
+    def mask(self, column):
+        """ Boolean array, True where column is None, or None if it has no nulls """
+        if 'mask' not in self._files[column]:
+            return None
+        return self._load(self._files[column]['mask'])
+
+    def records(self):
+        """ The rows as dicts, eg. for pandas.DataFrame(table.records()) """
+        decoded = {}
+        for name in self.order:
+            column = self[name]
+            if isinstance(column, DictionaryColumn):
+                decoded[name] = column.decode()
+            else:
+                values = column.tolist()
+                mask = self.mask(name)
+                if mask is not None:
+                    values = [None if null else v for v, null in zip(values, mask.tolist())]
+                decoded[name] = values
+        return [dict((name, decoded[name][i]) for name in self.order) for i in range(self.rows)]
+
+
+def _load_npy(np, path, mmap):
+    if mmap:
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # an empty array: there is nothing to map
+            pass
+    return np.load(path)
+
+def load_columns(directory, mmap=True):
+    """ Open a snapshot written by export_columns, as {table name: ColumnTable}. Plain
+    snapshots are memory mapped read only, a column at a time as they are used, so 
+    opening one reads almost nothing. """
+    np = _numpy()
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest['format'] != FORMAT_VERSION:
+        raise ValueError("Unsupported columnar snapshot format %r" % manifest['format'])
+
+    tables = {}
+    for table_name, spec in manifest['tables'].items():
+        tables[table_name] = ColumnTable(table_name, spec['rows'], spec['order'], 
+                                spec['columns'], _loader(np, directory, table_name, 
+                                                         manifest['compressed'], mmap))
+    return tables
+
+def _loader(np, directory, table_name, compressed, mmap):
+    if compressed:
+        archive = np.load(os.path.join(directory, table_name + '.npz'))
+        return lambda name: archive[name]
+    return lambda name: _load_npy(np, os.path.join(directory, '%s.%s.npy' % (table_name, name)),
+                                  mmap)
@@ -0,0 +1,130 @@
+import os
+import threading
+
+from sqlalchemy import inspect, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from setup.sqlite_profile import tuned_engine, sqlite_path
+
+
+###########################
+# pool for server databases
+pool_options = {'pool_size':5, 'max_overflow':10, 'pool_recycle':3600, 'pool_timeout':30}
+# pool for SQLite files: a pooled connection keeps its page cache and mmap, and
+# skips the profile's PRAGMAs, between sessions
+file_pool_options = {'pool_size':5, 'max_overflow':10, 'pool_timeout':30}
+###########################
+
+# sqlite profile by read_only flag: True opens the file read only, but still sees
+# what a refresh writes to it; 'replica' is for copies nothing writes to at all
+READ_ONLY_PROFILES = {False:'serve', True:'read_only', 'replica':'replica'}
+
+
+class EngineRegistry(object):
+    """ One engine and one session factory per database url (and read only flag), shared
+    by every Archipelago on that url, plus a cache of which databases have been checked
+    for the tables archipelago needs. """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._engines = {}
+        self._factories = {}
+        self._checked = set()
+        self._schema_locks = {}
+
+    def engine(self, db_url, read_only=False):
+        with self._lock:
+            if (db_url, read_only) not in self._engines:
+                engine = tuned_engine(db_url, READ_ONLY_PROFILES[read_only], 
+                                      **engine_options(db_url))
+                if sqlite_path(db_url):
+                    watch_replacement(engine, sqlite_path(db_url))
+                self._engines[(db_url, read_only)] = engine
+            return self._engines[(db_url, read_only)]
+
+    def session_factory(self, db_url, read_only=False):
+        with self._lock:
+            if (db_url, read_only) not in self._factories:
+                self._factories[(db_url, read_only)] = sessionmaker(
+                                                bind=self.engine(db_url, read_only))
+            return self._factories[(db_url, read_only)]
+
+    def _schema_lock(self, db_url):
+        with self._lock:
+            if db_url not in self._schema_locks:
+                self._schema_locks[db_url] = threading.RLock()
+            return self._schema_locks[db_url]
+
+    def ensure_schema(self, db_url, build, upgrade, tables):
+        """ Run build() if any of tables is missing, otherwise upgrade(), at most once
+        per schema (for SQLite, a file replaced or altered since is checked again).
+        Only callers on the same database wait for a build: the registry lock is
+        not held while it runs. """
+        engine = self.engine(db_url)
+        if schema_key(engine) in self._checked:
+            return
+        with self._schema_lock(db_url):
+            if schema_key(engine) in self._checked:
+                return
+            existing = set(inspect(engine).get_table_names())
+            if not set(tables) <= existing:
+                build()
+            else:
+                upgrade()
+            key = schema_key(engine)
+            with self._lock:
+                self._checked.add(key)
+
+    def dispose(self, db_url=None):
+        """ Close the pooled connections and forget the engines, for db_url or all of them """
+        with self._lock:
+            for key in list(self._engines):
+                if db_url is None or key[0] == db_url:
+                    self._factories.pop(key, None)
+                    self._engines.pop(key).dispose()
+            self._checked = set(k for k in self._checked if db_url is not None and k[0] != db_url)
+
+
+def engine_options(db_url):
+    if sqlite_path(db_url):
+        # the pool hands each connection to one thread at a time
+        return dict(file_pool_options, poolclass=QueuePool, 
+                    connect_args={'check_same_thread':False})
+    if make_url(db_url).drivername.startswith('sqlite'):
+        # in memory: the dialect's own single connection pool
+        return {}
+    return dict(pool_options)
+
+def _inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+def watch_replacement(engine, path):
+    """ Drop pooled connections to a SQLite file which has since been replaced, eg.
+    by a setup renaming its build over it: they would go on reading the old file.
+    Costs a stat per checkout. """
+    @event.listens_for(engine, 'connect')
+    def remember_file(dbapi_connection, connection_record):
+        connection_record.info['inode'] = _inode(path)
+
+    @event.listens_for(engine, 'checkout')
+    def check_file(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get('inode') != _inode(path):
+            # the pool reconnects, to whatever file now has the name
+            raise DisconnectionError('%s was replaced' % path)
+
+def schema_key(engine):
+    db_url = str(engine.url)
+    path = sqlite_path(db_url)
+    if path is None or not os.path.exists(path):
+        return (db_url, None, None)
+    # the schema cookie, which sqlite bumps on every change of schema
+    return (db_url, os.stat(path).st_ino, engine.scalar('PRAGMA schema_version'))
+
+
+registry = EngineRegistry()
@@ -0,0 +1,185 @@
+import cPickle as pickle
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from setup.models import MPCommons, Office, Address
+from setup.generation import read_generation
+
+
+class FrozenRecord(object):
+    """ An immutable row. Subclasses list their fields in __slots__, so a record is
+    one small fixed layout object, without a __dict__. """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is frozen" % type(self).__name__)
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, f) for f in self.__slots__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__reduce__())
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.__slots__))
+
+    def _asdict(self):
+        return dict((f, getattr(self, f)) for f in self.__slots__)
+
+
+class FrozenOffice(FrozenRecord):
+    __slots__ = tuple(c.name for c in Office.__table__.columns)
+
+    @property
+    def is_current(self):
+        return bool(self.IsCurrent)
+
+class FrozenAddress(FrozenRecord):
+    __slots__ = tuple(c.name for c in Address.__table__.columns)
+
+class FrozenMP(FrozenRecord):
+    # the MPCommons columns, plus its Offices and Addresses as tuples, named like the
+    # ORM relationships so code written against MPCommons objects reads these too
+    __slots__ = tuple(c.name for c in MPCommons.__table__.columns) + ('Offices', 'Addresses')
+
+    def __hash__(self):
+        return hash(self.Constituency)
+
+
+class FrozenArchipelago(object):
+    """ The whole database loaded once into immutable records, with hash indexes by
+    OfficialId, PersonId, MemberId, Constituency and TwitterHandle, and by party and
+    current office. The query methods of Archipelago, without a DB round trip.
+
+    Picklable: build it once (Archipelago.freeze()), dump it, and load it in each
+    worker, or build it before forking so workers share the pages. """
+
+    def __init__(self, mps, generation=None):
+        self.generation = generation
+        self.mps = tuple(sorted(mps, key=lambda mp: (mp.Name, mp.Constituency)))
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self.by_constituency = {}
+        self.by_official_id = {}
+        self.by_person_id = {}
+        self.by_member_id = {}
+        self.by_twitter_handle = {}
+        by_party = defaultdict(list)
+        by_office = defaultdict(list)
+
+        for mp in self.mps:
+            self.by_constituency[mp.Constituency] = mp
+            for index, key in [(self.by_official_id, mp.OfficialId),
+                               (self.by_person_id, mp.PersonId),
+                               (self.by_member_id, mp.MemberId),
+                               (self.by_twitter_handle, mp.TwitterHandle)]:
+                if key is not None:
+                    index[key] = mp
+            if mp.MP:
+                by_party[mp.Party].append(mp)
+            for office in set(o.Office for o in mp.Offices if o.is_current):
+                by_office[office].append(mp)
+
+        self.by_party = dict((party, tuple(mps)) for party, mps in by_party.items())
+        self.by_office = dict((office, tuple(mps)) for office, mps in by_office.items())
+        self._tweeting = tuple(mp for mp in self.mps
+                                if any(a.AddressType == 'twitter' for a in mp.Addresses))
+
+    def __getstate__(self):
+        # the indexes are rebuilt on load: smaller pickles, and one copy of each record
+        return {'generation':self.generation, 'mps':self.mps}
+
+    def __setstate__(self, state):
+        self.generation = state['generation']
+        self.mps = state['mps']
+        self._build_indexes()
+
+    @classmethod
+    def from_connectable(cls, connectable):
+        """ Load every MP, office and address with three Core queries """
+        offices = defaultdict(list)
+        for row in connectable.execute(select([Office.__table__])):
+            offices[row.PersonId].append(FrozenOffice(*row))
+        addresses = defaultdict(list)
+        for row in connectable.execute(select([Address.__table__])):
+            addresses[row.OfficialId].append(FrozenAddress(*row))
+
+        mps = [FrozenMP(*(tuple(row) + (tuple(offices.get(row.PersonId, ())),
+                                        tuple(addresses.get(row.OfficialId, ())))))
+                for row in connectable.execute(select([MPCommons.__table__]))]
+        return cls(mps, read_generation(connectable))
+
+    def dump(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def get_constituencies(self):
+        return [mp.Constituency for mp in self.mps]
+
+    def get_twitter_users(self):
+        return [{"name":mp.Name, "party":mp.Party, "constituency":mp.Constituency,
+                 "o_id":mp.OfficialId, "twitter_url":address.Address, "handle":mp.TwitterHandle}
+                    for mp in self._tweeting for address in mp.Addresses
+                    if address.AddressType == 'twitter']
+
+    def get_all_mps(self):
+        return list(self.mps)
+
+    def get_all_tweeting_mps(self):
+        return list(self._tweeting)
+
+    def get_mps_by_official_id(self, o_id_list):
+        found = [self.by_official_id[o_id] for o_id in set(o_id_list)
+                    if o_id in self.by_official_id]
+        return sorted(found, key=lambda mp: (mp.Name, mp.Constituency))
+
+    def get_mp_by_official_id(self, o_id):
+        return self.by_official_id.get(o_id)
+
+    def get_mp_by_person_id(self, person_id):
+        return self.by_person_id.get(person_id)
+
+    def get_mp_by_member_id(self, member_id):
+        return self.by_member_id.get(member_id)
+
+    def get_mp_by_constituency(self, constituency):
+        return self.by_constituency.get(constituency)
+
+    def get_mp_by_twitter_handle(self, handle):
+        return self.by_twitter_handle.get(handle)
+
+    def get_mps_by_party(self, party):
+        return list(self.by_party.get(party, ()))
+
+    def get_current_offices(self, person_id=None, department=None):
+        """ FrozenOffices currently held, optionally by one person or in one department:
+        as of the last setup or refresh, like Archipelago.get_current_offices """
+        if person_id is None:
+            mps = self.mps
+        else:
+            mps = [self.by_person_id[person_id]] if person_id in self.by_person_id else []
+        return sorted((o for mp in mps for o in mp.Offices 
+                        if o.is_current and department in (None, o.Office)),
+                      key=lambda o: (o.PersonId, o.Office, o.Title))
+
+    def get_mps_by_office(self, office):
+        """ MPs currently holding a post in office (a department or committee) """
+        return list(self.by_office.get(office, ()))
@@ -0,0 +1,215 @@
+from array import array
+from collections import defaultdict, deque
+
+from sqlalchemy import select, and_
+
+from setup.models import MPCommons, Office
+from setup.generation import read_generation
+
+
+###########################
+# seconds between checks of the db generation by Archipelago.office_graph: a query
+# in between uses the graph in memory without touching the db
+graph_check_interval = 5.0
+###########################
+
+
+def _csr(rows, count):
+    """ Compressed sparse rows: the targets of row i are targets[offsets[i]:offsets[i+1]] """
+    offsets = array('i', [0])
+    targets = array('i')
+    for i in range(count):
+        targets.extend(rows.get(i, ()))
+        offsets.append(len(targets))
+    return offsets, targets
+
+def _splice(offsets, targets, changed, count):
+    """ CSR arrays with the rows in changed replaced and count rows in all. Untouched
+    rows are copied a slice at a time, rather than an edge at a time. """
+    new_offsets = array('i', [0])
+    new_targets = array('i')
+    old_count = len(offsets) - 1
+    for i in range(count):
+        if i in changed:
+            new_targets.extend(changed[i])
+        elif i < old_count:
+            new_targets.extend(targets[offsets[i]:offsets[i+1]])
+        new_offsets.append(len(new_targets))
+    return new_offsets, new_targets
+
+def office_pairs(connectable):
+    """ (PersonId, department) for every current office with a department: the edges """
+    offices = Office.__table__
+    return [tuple(row) for row in connectable.execute(
+                select([offices.c.PersonId, offices.c.Office]).\
+                    where(and_(offices.c.IsCurrent==True, offices.c.Office != u'')))]
+
+def people(connectable):
+    """ {PersonId: (Name, Party)} for the MPs """
+    table = MPCommons.__table__
+    return dict((person_id, (name, party)) for person_id, name, party in
+                connectable.execute(select([table.c.PersonId, table.c.Name, table.c.Party]).\
+                    where(table.c.PersonId != None)))
+
+
+class OfficeGraph(object):
+    """ The bipartite graph of MPs and the departments and committees they currently
+    sit on, as CSR adjacency arrays both ways: person -> committees and committee ->
+    members. Immutable: updated() returns a new graph, sharing what did not change. """
+
+    def __init__(self, pairs, people=None, generation=None):
+        self.generation = generation
+        self.people = people or {}
+        self.pairs = frozenset((p, c) for p, c in pairs)
+
+        self.person_ids = sorted(set(p for p, c in self.pairs))
+        self.committees = sorted(set(c for p, c in self.pairs))
+        self._index_nodes()
+
+        by_person = defaultdict(list)
+        by_committee = defaultdict(list)
+        for person_id, committee in self.pairs:
+            by_person[self._person[person_id]].append(self._committee[committee])
+            by_committee[self._committee[committee]].append(self._person[person_id])
+        self.person_offsets, self.person_committees = _csr(
+            dict((i, sorted(row)) for i, row in by_person.items()), len(self.person_ids))
+        self.committee_offsets, self.committee_members = _csr(
+            dict((i, sorted(row)) for i, row in by_committee.items()), len(self.committees))
+
+    def _index_nodes(self):
+        self._person = dict((p, i) for i, p in enumerate(self.person_ids))
+        self._committee = dict((c, i) for i, c in enumerate(self.committees))
+
+    @classmethod
+    def from_connectable(cls, connectable):
+        return cls(office_pairs(connectable), people(connectable), read_generation(connectable))
+
+    def updated(self, pairs, people=None, generation=None):
+        """ The graph with edges pairs. Only the rows of the people and committees
+        whose offices changed are rebuilt; nodes are never renumbered, so those
+        left with no offices stay, as empty rows. """
+        pairs = frozenset((p, c) for p, c in pairs)
+        added, removed = pairs - self.pairs, self.pairs - pairs
+
+        graph = object.__new__(OfficeGraph)
+        graph.__dict__.update(self.__dict__)
+        graph.generation = generation
+        graph.people = self.people if people is None else people
+        graph.pairs = pairs
+        if not added and not removed:
+            return graph
+
+        graph.person_ids = self.person_ids + sorted(set(p for p, c in added) - set(self._person))
+        graph.committees = self.committees + sorted(set(c for p, c in added) - set(self._committee))
+        graph._index_nodes()
+
+        people_changed = defaultdict(lambda: ([], []))
+        committees_changed = defaultdict(lambda: ([], []))
+        for edges, side in [(added, 0), (removed, 1)]:
+            for person_id, committee in edges:
+                p, c = graph._person[person_id], graph._committee[committee]
+                people_changed[p][side].append(c)
+                committees_changed[c][side].append(p)
+
+        graph.person_offsets, graph.person_committees = _splice(
+            self.person_offsets, self.person_committees,
+            self._changed_rows(self.person_offsets, self.person_committees, people_changed),
+            len(graph.person_ids))
+        graph.committee_offsets, graph.committee_members = _splice(
+            self.committee_offsets, self.committee_members,
+            self._changed_rows(self.committee_offsets, self.committee_members, committees_changed),
+            len(graph.committees))
+        return graph
+
+    @staticmethod
+    def _changed_rows(offsets, targets, changes):
+        rows = {}
+        for i, (added, removed) in changes.items():
+            old = set(targets[offsets[i]:offsets[i+1]]) if i < len(offsets) - 1 else set()
+            rows[i] = sorted((old - set(removed)) | set(added))
+        return rows
+
+    def _committees_of(self, p):
+        return self.person_committees[self.person_offsets[p]:self.person_offsets[p+1]]
+
+    def _members_of(self, c):
+        return self.committee_members[self.committee_offsets[c]:self.committee_offsets[c+1]]
+
+    def committees_of(self, person_id):
+        if person_id not in self._person:
+            return []
+        return [self.committees[c] for c in self._committees_of(self._person[person_id])]
+
+    def members_of(self, committee):
+        if committee not in self._committee:
+            return []
+        return [self.person_ids[p] for p in self._members_of(self._committee[committee])]
+
+    def neighbours(self, person_id):
+        """ [(PersonId, committees shared)] for everyone sharing a committee with
+        person_id, most shared first """
+        if person_id not in self._person:
+            return []
+        p = self._person[person_id]
+        shared = defaultdict(int)
+        for c in self._committees_of(p):
+            for member in self._members_of(c):
+                shared[member] += 1
+        shared.pop(p, None)
+        return sorted(((self.person_ids[q], n) for q, n in shared.items()),
+                      key=lambda (person, n): (-n, person))
+
+    def co_membership(self, person_a, person_b):
+        """ The number of committees person_a and person_b both sit on """
+        if person_a not in self._person or person_b not in self._person:
+            return 0
+        return len(set(self._committees_of(self._person[person_a])) &
+                   set(self._committees_of(self._person[person_b])))
+
+    def party_co_membership(self):
+        """ {(party, party): pairs of MPs sitting on a committee together}, summed over
+        the committees, with each party pair in sorted order """
+        strength = defaultdict(int)
+        for c in range(len(self.committees)):
+            parties = defaultdict(int)
+            for p in self._members_of(c):
+                parties[self.people.get(self.person_ids[p], (None, None))[1]] += 1
+            parties = sorted(parties.items())
+            for i, (party, n) in enumerate(parties):
+                if n > 1:
+                    strength[(party, party)] += n*(n-1)/2
+                for other, m in parties[i+1:]:
+                    strength[(party, other)] += n*m
+        return dict(strength)
+
+    def shortest_path(self, person_a, person_b):
+        """ The shortest chain of shared committees from person_a to person_b, as
+        [PersonId, committee, PersonId, ..., PersonId], or None if there is none """
+        if person_a not in self._person or person_b not in self._person:
+            return None
+        start, goal = self._person[person_a], self._person[person_b]
+        # breadth first over people, a committee being one step between its members.
+        # Each committee is expanded once, so the search is linear in the edges.
+        came_from = {start:None}
+        expanded = set()
+        frontier = deque([start])
+        while frontier and goal not in came_from:
+            p = frontier.popleft()
+            for c in self._committees_of(p):
+                if c in expanded:
+                    continue
+                expanded.add(c)
+                for q in self._members_of(c):
+                    if q not in came_from:
+                        came_from[q] = (p, c)
+                        frontier.append(q)
+        if goal not in came_from:
+            return None
+
+        path = [self.person_ids[goal]]
+        step = came_from[goal]
+        while step is not None:
+            p, c = step
+            path[:0] = [self.person_ids[p], self.committees[c]]
+            step = came_from[p]
+        return path
@@ -0,0 +1,32 @@
+import threading
+from sqlalchemy import event
+
+
+class QueryCounter(object):
+    """ Count the SQL statements an engine executes inside a with block:
+
+        with QueryCounter(engine) as counter:
+            ...
+        counter.count, counter.statements
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return False
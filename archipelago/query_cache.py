@@ -0,0 +1,111 @@
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+
+###########################
+# seconds between checks of the db generation: hits in between don't touch the db
+cache_check_interval = 1.0
+###########################
+
+
+class QueryCache(object):
+    """ A size and TTL bounded LRU cache of query results, tied to a db generation stamp.
+    When the stamp changes (setup or refresh wrote to the db) every entry is dropped.
+    The stamp is read at most every check_interval seconds. """
+
+    def __init__(self, maxsize=128, ttl=None, check_interval=cache_check_interval):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.generation = None
+        self._checked = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits':0, 'misses':0, 'evictions':0, 'invalidations':0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def due(self):
+        """ True if the generation should be read again """
+        return time.time() - self._checked >= self.check_interval
+
+    def invalidate(self):
+        """ Read the generation again on the next call, eg. after a refresh """
+        self._checked = 0
+
+    def validate(self, generation):
+        """ Drop every entry if the db generation has moved on. Returns True if it had. """
+        with self._lock:
+            self._checked = time.time()
+            if generation == self.generation:
+                return False
+            self.generation = generation
+            if self._entries:
+                self._stats['invalidations'] += 1
+            self._entries.clear()
+            return True
+
+    def get(self, key):
+        """ Return (True, value) on a hit, (False, None) on a miss """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (self.ttl is None or time.time() - entry[0] < self.ttl):
+                self._entries[key] = entry
+                self._stats['hits'] += 1
+                return True, entry[1]
+            self._stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+
+def cached_query(method):
+    """ Memoize an Archipelago accessor in the instance's QueryCache, if it has one.
+    Lists are copied on the way out, so callers can't change the cached result.
+    Only plain data is cached: ORM objects belong to the calling thread's session,
+    so those results (eg. get_all_mps() without as_records) are never stored. """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self._query_cache
+        if cache is None:
+            return method(self, *args, **kwargs)
+
+        if cache.due() and cache.validate(self.generation()):
+            # rows in the identity map may be stale too
+            self.session.expire_all()
+
+        key = (method.__name__, _freeze(args), _freeze(sorted(kwargs.items())))
+        hit, result = cache.get(key)
+        if not hit:
+            result = method(self, *args, **kwargs)
+            if _holds_orm_objects(result):
+                return result
+            cache.put(key, result)
+        return list(result) if isinstance(result, list) else result
+
+    return wrapper
+
+def _holds_orm_objects(result):
+    values = result if isinstance(result, (list, tuple)) else [result]
+    return any(hasattr(value, '_sa_instance_state') for value in values)
+
+def _freeze(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    return value
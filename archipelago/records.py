@@ -0,0 +1,16 @@
+from collections import namedtuple
+
+from setup.models import MPCommons
+
+
+# compact, immutable rows for bulk reads. namedtuples have empty __slots__, so a 
+# record costs one tuple, against an ORM instance with its own dict and instance state.
+MPRecord = namedtuple('MPRecord', [c.name for c in MPCommons.__table__.columns])
+
+
+def build_records(rows, as_records):
+    """ Turn rows of MPCommons columns into MPRecords (as_records=True or 'tuple')
+    or plain dicts (as_records='dict') """
+    if as_records == 'dict':
+        return [dict(zip(MPRecord._fields, row)) for row in rows]
+    return [MPRecord._make(row) for row in rows]
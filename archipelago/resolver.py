@@ -0,0 +1,83 @@
+import threading
+import time
+
+from sqlalchemy import select
+
+from setup.models import MPCommons
+from setup.generation import read_generation
+from setup.parl_init_GOV import fold_handle
+from records import MPRecord
+
+
+###########################
+# seconds between checks of the db generation: a lookup in between is one dict get
+resolver_check_interval = 5.0
+###########################
+
+
+def load_accounts(connectable):
+    """ {case folded handle: MPRecord} from MPCommons.TwitterHandle """
+    table = MPCommons.__table__
+    rows = connectable.execute(select([table]).where(table.c.TwitterHandle != None))
+    return dict((row.TwitterHandle.lower(), MPRecord._make(row)) for row in rows)
+
+
+class TwitterResolver(object):
+    """ Maps the screen names on tweets to MPs: an in memory dict of the case folded
+    handles in MPCommons. It is reloaded when the db generation changes, which
+    is checked at most every check_interval seconds. Thread safe.
+
+        resolver = arch.twitter_resolver()
+        mp = resolver.resolve(tweet['user']['screen_name'])
+    """
+
+    def __init__(self, engine, check_interval=resolver_check_interval):
+        self._engine = engine
+        self.check_interval = check_interval
+        self.generation = None
+        self._accounts = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def accounts(self):
+        """ The current {case folded handle: MPRecord} map """
+        accounts = self._accounts
+        if accounts is None or time.time() - self._checked >= self.check_interval:
+            with self._lock:
+                accounts = self._accounts
+                if accounts is None or time.time() - self._checked >= self.check_interval:
+                    generation = read_generation(self._engine)
+                    if accounts is None or generation != self.generation:
+                        accounts = self._accounts = load_accounts(self._engine)
+                        self.generation = generation
+                    self._checked = time.time()
+        return accounts
+
+    def reload(self):
+        """ Reload now, rather than at the next generation check """
+        with self._lock:
+            self._checked = 0
+            self._accounts = None
+        return self.accounts()
+
+    def resolve(self, handle):
+        """ The MPRecord for a screen name, '@handle' or twitter url, in any case,
+        or None if no MP uses it """
+        if not handle:
+            return None
+        accounts = self.accounts()
+        mp = accounts.get(handle.lower())
+        if mp is None and ('/' in handle or '@' in handle):
+            mp = accounts.get(fold_handle(handle))
+        return mp
+
+    def resolve_many(self, handles):
+        """ A list of MPRecords or None, aligned with handles """
+        resolve = self.resolve
+        return [resolve(handle) for handle in handles]
+
+    def __len__(self):
+        return len(self.accounts())
+
+    def __contains__(self, handle):
+        return self.resolve(handle) is not None
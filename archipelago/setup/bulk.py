@@ -0,0 +1,72 @@
+#batched writes for the setup loaders: one executemany per table instead of one round trip per row
+import sqlite3
+from sqlalchemy import bindparam, text, and_
+
+
+def bulk_update(session, model, key_column, rows):
+    """ UPDATE model SET ... WHERE key_column=..., as a single executemany.
+    rows are dicts of column name to value, and must all have the same columns. """
+    if not rows:
+        return 0
+    # like query().update(), make pending objects (eg. new constituencies) visible first
+    session.flush()
+    table = model.__table__
+    statement = table.update().where(table.c[key_column]==bindparam('_key'))
+
+    params = []
+    for row in rows:
+        values = dict((column, value) for column, value in row.items() if column != key_column)
+        values['_key'] = row[key_column]
+        params.append(values)
+
+    session.execute(statement, params)
+    return len(rows)
+
+def _supports_on_conflict(dialect):
+    if dialect.name == 'postgresql':
+        return dialect.server_version_info >= (9, 5)
+    if dialect.name == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 24)
+    return False
+
+def _on_conflict_statement(dialect, table):
+    preparer = dialect.identifier_preparer
+    columns = [c.name for c in table.columns]
+    keys = [c.name for c in table.primary_key.columns]
+    others = [c for c in columns if c not in keys]
+
+    on_conflict = 'DO NOTHING'
+    if others:
+        on_conflict = 'DO UPDATE SET ' + ', '.join('%s=excluded.%s' % (
+                            preparer.quote(c), preparer.quote(c)) for c in others)
+
+    return text('INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) %s' % (
+        preparer.format_table(table),
+        ', '.join(preparer.quote(c) for c in columns),
+        ', '.join(':%s' % c for c in columns),
+        ', '.join(preparer.quote(c) for c in keys),
+        on_conflict))
+
+def bulk_upsert(session, model, rows):
+    """ Insert rows, replacing any with the same primary key, as a single executemany.
+    Uses INSERT .. ON CONFLICT on SQLite (3.24+) and PostgreSQL (9.5+), INSERT OR REPLACE
+    on older SQLite, and a batched delete then insert elsewhere. """
+    if not rows:
+        return 0
+    session.flush()
+    table = model.__table__
+    dialect = session.get_bind().dialect
+    columns = [c.name for c in table.columns]
+    params = [dict((c, row.get(c)) for c in columns) for row in rows]
+
+    if _supports_on_conflict(dialect):
+        session.execute(_on_conflict_statement(dialect, table), params)
+    elif dialect.name == 'sqlite':
+        session.execute(table.insert().prefix_with('OR REPLACE'), params)
+    else:
+        keys = [c.name for c in table.primary_key.columns]
+        statement = table.delete().where(and_(*[table.c[k]==bindparam('_key_'+k) for k in keys]))
+        session.execute(statement, [dict(('_key_'+k, p[k]) for k in keys) for p in params])
+        session.execute(table.insert(), params)
+
+    return len(rows)
@@ -0,0 +1,22 @@
+#a stamp which changes whenever setup or refresh writes to the db, so readers can drop caches
+import uuid
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models import Metadata
+
+
+def bump_generation(session):
+    """ Give the db a new generation stamp. Does not commit. """
+    generation = uuid.uuid4().hex
+    session.merge(Metadata(Key='generation', Value=generation))
+    return generation
+
+def read_generation(connectable):
+    """ The current generation stamp, or None for a db built before stamps existed """
+    table = Metadata.__table__
+    try:
+        return connectable.execute(
+            select([table.c.Value]).where(table.c.Key=='generation')).scalar()
+    except (OperationalError, ProgrammingError):
+        return None
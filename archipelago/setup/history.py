@@ -0,0 +1,163 @@
+#membership and office intervals, recorded from each setup and refresh so that
+#"who held this seat on date X" is answered from the db rather than a re-scrape
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import select, inspect, and_
+
+from models import MPCommons, Office, Membership, OfficeTerm
+import bulk
+
+###########################
+# EndDate of an interval still running: TWFY's end date for an office still held
+OPEN_END = datetime.date(9999, 12, 31)
+###########################
+
+HISTORY_TABLES = [Membership.__table__, OfficeTerm.__table__]
+
+MembershipRecord = namedtuple('MembershipRecord', [c.name for c in Membership.__table__.columns])
+OfficeTermRecord = namedtuple('OfficeTermRecord', [c.name for c in OfficeTerm.__table__.columns])
+
+
+def to_date(value, default=None):
+    """ A datetime.date from a date, or a 'YYYY-MM-DD' string (anything after the
+    day, eg. a time, is ignored). default if value is None or not a date. """
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return default
+
+def _close(start, today):
+    # seen up to yesterday: an interval which opened and closed the same day keeps a day
+    return max(start, today - datetime.timedelta(days=1))
+
+
+def record_memberships(session, today):
+    members = session.query(MPCommons.PersonId, MPCommons.Constituency, MPCommons.Party,
+                            MPCommons.Name).\
+                    filter(MPCommons.MP==1, MPCommons.PersonId != None).all()
+    current = dict(((person_id, seat, party), name) for person_id, seat, party, name in members)
+
+    still_open = set()
+    closed = []
+    for membership in session.query(Membership).filter(Membership.EndDate==OPEN_END):
+        key = (membership.PersonId, membership.Constituency, membership.Party)
+        if key in current:
+            still_open.add(key)
+            membership.Name = current[key]
+        else:
+            membership.EndDate = _close(membership.StartDate, today)
+            closed.append(key)
+
+    opened = [{'PersonId':person_id, 'Constituency':seat, 'Party':party,
+               'Name':current[(person_id, seat, party)], 'StartDate':today, 'EndDate':OPEN_END}
+                for person_id, seat, party in set(current) - still_open]
+    session.flush()
+    if opened:
+        session.execute(Membership.__table__.insert(), opened)
+    return {'opened':len(opened), 'closed':len(closed)}
+
+def record_office_terms(session, today):
+    terms = {}
+    for office in session.query(Office):
+        start = to_date(office.StartDate, today)
+        terms[(office.PersonId, office.Office, office.Title, start)] = {
+            'PersonId':office.PersonId, 'Office':office.Office, 'Title':office.Title,
+            'StartDate':start, 'EndDate':to_date(office.EndDate, OPEN_END), 'Name':office.Name}
+
+    closed = 0
+    for term in session.query(OfficeTerm).filter(OfficeTerm.EndDate >= today):
+        if (term.PersonId, term.Office, term.Title, term.StartDate) not in terms:
+            term.EndDate = _close(term.StartDate, today)
+            closed += 1
+
+    bulk.bulk_upsert(session, OfficeTerm, terms.values())
+    return {'recorded':len(terms), 'closed':closed}
+
+def record_history(session, today=None):
+    """ Bring the intervals up to date with MPCommons and Offices: open a membership
+    for each new (person, seat, party), close those no longer current, and upsert
+    every office term. Incremental: run it after each setup or refresh. Membership
+    dates are when a change was first seen, office dates are TWFY's own.
+    Does not commit. """
+    today = to_date(today) or datetime.date.today()
+    return {Membership.__tablename__:record_memberships(session, today),
+            OfficeTerm.__tablename__:record_office_terms(session, today)}
+
+def copy_history(source, session):
+    """ Copy the intervals from source (an engine on the live db) into session's
+    db: a rebuild starts from the live history, rather than losing it. """
+    existing = set(inspect(source).get_table_names())
+    copied = 0
+    for table in HISTORY_TABLES:
+        if table.name not in existing:
+            continue
+        rows = [dict(row) for row in source.execute(select([table]))]
+        if rows:
+            session.execute(table.insert(), rows)
+            copied += len(rows)
+    return copied
+
+
+def _overlapping(table, since, until):
+    # [StartDate, EndDate] meets [since, until]: each bound is one indexed range
+    conditions = []
+    if until is not None:
+        conditions.append(table.c.StartDate <= to_date(until))
+    if since is not None:
+        conditions.append(table.c.EndDate >= to_date(since))
+    return conditions
+
+def memberships(session, since=None, until=None, constituency=None, person_id=None):
+    """ MembershipRecords for the intervals overlapping since..until (dates or
+    'YYYY-MM-DD', either open), optionally for one seat or person, by StartDate """
+    table = Membership.__table__
+    conditions = _overlapping(table, since, until)
+    if constituency is not None:
+        conditions.append(table.c.Constituency==constituency)
+    if person_id is not None:
+        conditions.append(table.c.PersonId==person_id)
+    statement = select([table]).where(and_(*conditions)).\
+                    order_by(table.c.StartDate, table.c.Name)
+    return [MembershipRecord._make(row) for row in session.execute(statement)]
+
+def office_terms(session, since=None, until=None, person_id=None, office=None):
+    """ OfficeTermRecords for the terms overlapping since..until, like memberships """
+    table = OfficeTerm.__table__
+    conditions = _overlapping(table, since, until)
+    if person_id is not None:
+        conditions.append(table.c.PersonId==person_id)
+    if office is not None:
+        conditions.append(table.c.Office==office)
+    statement = select([table]).where(and_(*conditions)).\
+                    order_by(table.c.StartDate, table.c.Office, table.c.Title)
+    return [OfficeTermRecord._make(row) for row in session.execute(statement)]
+
+
+class AsOf(object):
+    """ The history as it stood on one date """
+
+    def __init__(self, session, date):
+        self.session = session
+        self.date = to_date(date)
+        if self.date is None:
+            raise ValueError("Not a date: %r" % (date,))
+
+    def get_all_mps(self):
+        """ MembershipRecords of the MPs sitting on the date, by name """
+        return sorted(memberships(self.session, self.date, self.date),
+                      key=lambda m: (m.Name, m.Constituency))
+
+    def get_mp_by_constituency(self, constituency):
+        """ The MembershipRecord for whoever held constituency on the date, or None """
+        held = memberships(self.session, self.date, self.date, constituency=constituency)
+        return held[-1] if held else None
+
+    def get_memberships(self, person_id):
+        return memberships(self.session, self.date, self.date, person_id=person_id)
+
+    def get_offices(self, person_id=None, office=None):
+        """ OfficeTermRecords for the offices held on the date """
+        return office_terms(self.session, self.date, self.date, person_id, office)
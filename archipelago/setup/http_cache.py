@@ -0,0 +1,159 @@
+#persistent on-disk cache of HTTP responses for the setup fetchers
+import os
+import time
+import json
+import hashlib
+import threading
+import tempfile
+from urlparse import urlsplit, urlunsplit, parse_qsl
+from urllib import urlencode
+
+
+# query parameters which identify the caller rather than the resource
+PRIVATE_PARAMS = ('key',)
+
+
+class CacheMiss(Exception):
+    """ Raised in offline mode when a url has never been cached """
+    pass
+
+
+def cache_url(url):
+    """ The url with private parameters (the TWFY key) removed, used to key the cache """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = [(k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+                if k not in PRIVATE_PARAMS]
+    return urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+
+
+class ResponseCache(object):
+    """ Response bodies stored on disk, keyed by url. Entries younger than ttl seconds are
+    served without touching the network, older ones are revalidated with a conditional GET
+    (ETag / Last-Modified). Least recently used entries are evicted past max_bytes.
+    With offline=True everything is served from the cache, whatever its age. """
+
+    def __init__(self, directory='.archipelago_cache', ttl=24*60*60,
+                 max_bytes=256*1024*1024, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _paths(self, url):
+        digest = hashlib.sha1(cache_url(url)).hexdigest()
+        base = os.path.join(self.directory, digest)
+        return base + '.body', base + '.json'
+
+    def lookup(self, url):
+        """ Return (meta, body) for a cached url, or None """
+        entry = self.open(url)
+        if entry is None:
+            return None
+        meta, body = entry
+        with body:
+            return meta, body.read()
+
+    def is_fresh(self, meta):
+        return self.offline or time.time() - meta['fetched_at'] < self.ttl
+
+    def open(self, url):
+        """ Return (meta, open body file) for a cached url, or None """
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            body = open(body_path, 'rb')
+        except (IOError, ValueError):
+            return None
+
+        # the body mtime doubles as the LRU clock
+        os.utime(body_path, None)
+        return meta, body
+
+    def writer(self, url, headers):
+        """ Return a CacheWriter, to store a body as it streams past """
+        return CacheWriter(self, url, headers)
+
+    def store(self, url, response):
+        writer = self.writer(url, response.headers)
+        writer.write(response.content)
+        writer.commit()
+
+    def touch(self, url, meta):
+        """ Mark a revalidated entry as fresh again """
+        body_path, meta_path = self._paths(url)
+        meta['fetched_at'] = time.time()
+        self._write(meta_path, json.dumps(meta))
+
+    def _new_entry(self, url, body_tmp_path, headers):
+        body_path, meta_path = self._paths(url)
+        meta = {
+            'url':cache_url(url),
+            'fetched_at':time.time(),
+            'headers':dict((h, headers[h]) for h in
+                            ('content-type', 'etag', 'last-modified') if h in headers)
+        }
+        os.rename(body_tmp_path, body_path)
+        self._write(meta_path, json.dumps(meta))
+        self.evict()
+
+    def _write(self, path, data):
+        # write then rename, so a concurrent reader never sees half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.directory, f))
+                    for f in os.listdir(self.directory) if f.endswith('.body'))
+
+    def evict(self):
+        with self._lock:
+            bodies = [os.path.join(self.directory, f)
+                        for f in os.listdir(self.directory) if f.endswith('.body')]
+            entries = sorted((os.path.getmtime(b), os.path.getsize(b), b) for b in bodies)
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, body_path in entries:
+                if total <= self.max_bytes:
+                    break
+                for path in (body_path, body_path[:-len('.body')] + '.json'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+    def clear(self):
+        for f in os.listdir(self.directory):
+            if f.endswith('.body') or f.endswith('.json'):
+                os.remove(os.path.join(self.directory, f))
+
+
+class CacheWriter(object):
+    """ Writes a body to a temporary file, which only becomes a cache entry on commit """
+
+    def __init__(self, cache, url, headers):
+        self.cache = cache
+        self.url = url
+        self.headers = headers
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        self.cache._new_entry(self.url, self.tmp_path, self.headers)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
@@ -0,0 +1,162 @@
+#parallel, resumable sync of the official MP photos into a content addressed store
+import os
+import json
+import time
+import hashlib
+import tempfile
+import requests
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+
+from models import MPCommons
+import transport
+import bulk
+
+###########################
+image_site = 'http://www.theyworkforyou.com/images/mps/'
+chunk_size = 64*1024
+thumbnail_size = (60, 80)
+###########################
+
+
+def load_manifest(directory):
+    """ The manifest maps PersonId to the etag, last-modified and sha1 of its image """
+    try:
+        with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+            return dict((int(k), v) for k, v in json.load(f).items())
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(directory, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp_path, os.path.join(directory, 'manifest.json'))
+
+def content_path(directory, sha1, folder=''):
+    return os.path.join(directory, folder, sha1[:2], sha1 + '.jpg')
+
+def image_url(person_id):
+    """ What MPCommons.ImageUrl holds: the image's path on TWFY, relative to its site """
+    return 'images/mps/%d.jpg' % person_id
+
+def image_path(directory, person_id, manifest=None):
+    """ The stored copy of person_id's image, or None if it has not been synced """
+    entry = (manifest if manifest is not None else load_manifest(directory)).get(person_id)
+    return content_path(directory, entry['sha1']) if entry else None
+
+def fetch_image(person_id, directory, entry=None):
+    """ Download the image for person_id, streaming it to disk in chunks. Returns the new
+    manifest entry, the old one if unchanged (304), or None if there is no image. """
+    headers = {}
+    if entry and os.path.isfile(content_path(directory, entry['sha1'])):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    response = transport.get(image_site + '%d.jpg' % person_id, cache=False,
+                             stream=True, headers=headers)
+    try:
+        if response.status_code == 304:
+            return entry
+        if response.status_code != 200:
+            return None
+
+        sha1 = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as img:
+                for chunk in response.iter_content(chunk_size):
+                    sha1.update(chunk)
+                    img.write(chunk)
+        except:
+            os.remove(tmp_path)
+            raise
+    finally:
+        response.close()
+
+    sha1 = sha1.hexdigest()
+    path = content_path(directory, sha1)
+    if os.path.isfile(path):
+        os.remove(tmp_path)
+    else:
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # made by another worker
+        os.rename(tmp_path, path)
+
+    return {'sha1':sha1, 'etag':response.headers.get('etag'),
+            'last_modified':response.headers.get('last-modified')}
+
+def make_thumbnail(directory, sha1, size=thumbnail_size):
+    """ Write a downscaled copy of an image next to the store. Needs PIL / Pillow. """
+    from PIL import Image
+
+    path = content_path(directory, sha1, folder='thumbnails')
+    if os.path.isfile(path):
+        return path
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    image = Image.open(content_path(directory, sha1))
+    image.thumbnail(size)
+    image.save(path, 'JPEG')
+    return path
+
+def sync_images(session, directory='profile_images', workers=8, thumbnails=False,
+                only_missing=False):
+    """ Bring the image store up to date for every MP with a PersonId and set
+    MPCommons.ImageUrl for those with an image, in one batched update. ImageUrl is
+    the served url (image_url); image_path finds the stored copy. Unchanged images
+    are skipped with conditional requests. Progress is saved to the manifest as it
+    goes, so an interrupted sync resumes where it stopped. Does not commit. """
+    start = time.time()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    if thumbnails:
+        try:
+            import PIL
+        except ImportError:
+            print "WARNING: thumbnails need PIL / Pillow installed. Skipping them."
+            thumbnails = False
+
+    manifest = load_manifest(directory)
+    query = session.query(MPCommons.Constituency, MPCommons.PersonId, MPCommons.ImageUrl).\
+                filter(MPCommons.PersonId!=None)
+    if only_missing:
+        query = query.filter(MPCommons.ImageUrl==None)
+    mps = query.order_by(MPCommons.Constituency).all()
+
+    def job(mp):
+        try:
+            return mp, fetch_image(mp.PersonId, directory, manifest.get(mp.PersonId))
+        except (requests.ConnectionError, requests.Timeout):
+            print "ERROR: Could not download image for %s" % mp.Constituency
+            return mp, manifest.get(mp.PersonId)
+
+    pool = ThreadPool(workers)
+    image_urls = []
+    try:
+        for i, (mp, entry) in enumerate(tqdm(pool.imap(job, mps), total=len(mps))):
+            if entry is None:
+                continue
+            manifest[mp.PersonId] = entry
+            if thumbnails:
+                make_thumbnail(directory, entry['sha1'])
+
+            url = image_url(mp.PersonId)
+            if url != mp.ImageUrl:
+                image_urls.append({'Constituency':mp.Constituency, 'ImageUrl':url})
+            if i % 50 == 0:
+                save_manifest(directory, manifest)
+    finally:
+        pool.terminate()
+        pool.join()
+        save_manifest(directory, manifest)
+
+    bulk.bulk_update(session, MPCommons, 'Constituency', image_urls)
+    print 'Images synced in %ds (%d updated)' % (time.time()-start, len(image_urls))
+    return len(image_urls)
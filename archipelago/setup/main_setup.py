@@ -5,30 +5,112 @@ import os
 
 import parl_init_TWFY as pi_TWFY
 import parl_init_GOV as pi_GOV
+import transport
+import refresh
+import generation
+import migrations
+import search_index
+import pipeline
+import sqlite_profile
+import staging
+import history
 from models import Base
 
-from sqlalchemy import create_engine 
+from sqlalchemy import inspect
 from sqlalchemy.orm import sessionmaker   
 
 
 def create_database(db_url='sqlite:///parl.db'):
-    engine = create_engine(db_url, echo=False)
-    Base.metadata.drop_all(engine, checkfirst=True)
+    """ An engine on db_url, with the tables (re)created empty. Only SQLite files,
+    which setup builds aside, may already hold an archipelago database. """
+    engine = sqlite_profile.tuned_engine(db_url, 'load')
+    if sqlite_profile.sqlite_path(db_url) is None:
+        existing = set(inspect(engine).get_table_names())
+        if any(t.name in existing for t in Base.metadata.sorted_tables
+                if t not in history.HISTORY_TABLES):
+            engine.dispose()
+            raise ValueError("%s already holds an archipelago database, which setup would "
+                             "drop in place. Use refresh_archipelago to update it." % db_url)
+    # everything but the history, which outlives rebuilds
+    Base.metadata.drop_all(engine, checkfirst=True, tables=[t for t in Base.metadata.sorted_tables
+                                                            if t not in history.HISTORY_TABLES])
     Base.metadata.create_all(engine)
     return engine
 
-def setup_archipelago(db_url='sqlite:///parl.db'):
+def setup_archipelago(db_url='sqlite:///parl.db', gov_workers=pi_GOV.default_workers,
+                      load_images=False, gov_mode=pi_GOV.default_mode, pipelined=False,
+                      constituencies=staging.expected_constituencies):
+    """ Build the database from TWFY and GOV. A SQLite file is built aside, validated
+    and only then renamed over the live one, whose last version is kept for 
+    rollback_archipelago. A failed or invalid build leaves the live file as it was.
+    The membership and office history carries over, and is brought up to date.
+    Other databases can't be built aside, so are only built when empty: bring one
+    up to date with refresh_archipelago. Pass constituencies=None to skip the
+    seat count check. """
+    path = sqlite_profile.sqlite_path(db_url)
+    build_url = db_url
+    if path is not None:
+        staging.remove_sqlite_files(staging.staging_path(path))
+        build_url = 'sqlite:///' + staging.staging_path(path)
+
+    engine = None
     try:
-        engine = create_database(db_url)
+        engine = create_database(build_url)
         session_factory = sessionmaker(bind=engine) 
 
-        pi_TWFY.TWFY_setup(session_factory)
-        pi_GOV.GOV_setup(session_factory)
-        return (engine, session_factory)
-    except: #bad
-        if os.path.isfile('parl.db'):
-            os.remove('parl.db')
-            raise
+        if pipelined:
+            # TWFY and GOV fetched at once, loading as the data arrives
+            pipeline.pipelined_setup(session_factory, gov_workers=gov_workers, 
+                                     gov_mode=gov_mode, load_images=load_images)
+        else:
+            pi_TWFY.TWFY_setup(session_factory, load_images=load_images)
+            pi_GOV.GOV_setup(session_factory, workers=gov_workers, mode=gov_mode)
+
+        session = session_factory()
+        problems = staging.validate(session, constituencies)
+        if problems:
+            raise staging.ValidationError(problems)
+        if path is not None and os.path.isfile(path):
+            live = sqlite_profile.tuned_engine(db_url, 'serve')
+            history.copy_history(live, session)
+            live.dispose()
+        history.record_history(session)
+        search_index.build_search_index(session)
+        generation.bump_generation(session)
+        session.commit()
+        session.close()
+        print 'HTTP: %s' % transport.get_transport().summary()
+    except Exception:
+        if path is not None:
+            if engine is not None:
+                engine.dispose()
+            staging.remove_sqlite_files(staging.staging_path(path))
+        raise
+
+    if path is not None:
+        staging.promote(engine, path)
+        engine = sqlite_profile.tuned_engine(db_url, 'serve')
+        session_factory = sessionmaker(bind=engine)
+    return (engine, session_factory)
+
+def rollback_archipelago(db_url='sqlite:///parl.db'):
+    """ Put back the SQLite file the last setup replaced. Returns False if there is none. """
+    path = sqlite_profile.sqlite_path(db_url)
+    if path is None:
+        raise ValueError("Only SQLite files keep a previous snapshot, not %s" % db_url)
+    return staging.rollback(path)
+
+def refresh_archipelago(db_url='sqlite:///parl.db', gov_workers=pi_GOV.default_workers,
+                        gov_mode=pi_GOV.default_mode):
+    """ Bring an existing database up to date in one transaction, instead of 
+    dropping and rebuilding it. Returns a per table summary of the changes. """
+    engine = sqlite_profile.tuned_engine(db_url, 'load')
+    session_factory = sessionmaker(bind=engine)
+    migrations.migrate(engine, session_factory)
+
+    summary = refresh.refresh(session_factory, gov_workers=gov_workers, gov_mode=gov_mode)
+    print 'HTTP: %s' % transport.get_transport().summary()
+    return summary
 
 def is_arch_setup_local():
     return os.path.isfile('parl.db') 
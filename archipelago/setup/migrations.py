@@ -0,0 +1,217 @@
+#bring the schema of an existing archipelago database up to date in place
+import datetime
+
+from sqlalchemy import inspect, select, or_, Date, Table, MetaData
+
+from models import Base, MPCommons, Address, Office, SearchTrigram, Membership, Metadata
+import parl_init_GOV as pi_GOV
+import search_index
+import bulk
+import history
+
+
+def backfill_twitter_handles(session):
+    """ Fill MPCommons.TwitterHandle from the twitter Addresses """
+    addresses = Address.__table__
+    rows = session.execute(select([addresses.c.OfficialId, addresses.c.Address]).\
+                where(addresses.c.AddressType=='twitter'))
+    handles = [{'OfficialId':official_id, 'TwitterHandle':pi_GOV.handle_from_twitter_url(url)}
+                for official_id, url in rows]
+    bulk.bulk_update(session, MPCommons, 'OfficialId', handles)
+
+def backfill_current_offices(session):
+    """ Set Offices.IsCurrent from EndDate """
+    offices = Office.__table__
+    session.execute(offices.update().values(IsCurrent=or_(offices.c.EndDate==None,
+                                            offices.c.EndDate >= datetime.date.today())))
+
+# tables (column None) and columns added after the first release, and how to fill
+# them in for existing rows
+BACKFILLS = {
+    (MPCommons.__tablename__, 'TwitterHandle'):backfill_twitter_handles,
+    (Office.__tablename__, 'IsCurrent'):backfill_current_offices,
+    (SearchTrigram.__tablename__, None):search_index.build_search_index,
+    # the history starts from what the db holds now
+    (Membership.__tablename__, None):history.record_history,
+}
+
+def backfill_key(table_name, column_name):
+    """ The Metadata key marking the backfill for a table or column as pending """
+    return 'backfill:%s' % (table_name if column_name is None 
+                            else '%s.%s' % (table_name, column_name))
+
+def mark_backfill(connection, table_name, column_name=None):
+    """ Record that the table or column needs its backfill, if it has one. Run it
+    before the DDL which adds it: pysqlite commits first, so the mark outlives a
+    failure anywhere after. """
+    if (table_name, column_name) not in BACKFILLS:
+        return
+    table = Metadata.__table__
+    key = backfill_key(table_name, column_name)
+    if connection.execute(select([table.c.Key]).where(table.c.Key==key)).scalar() is None:
+        connection.execute(table.insert(), Key=key, Value='pending')
+
+def pending_backfills(connection):
+    """ (key, backfill) for each backfill marked pending, in table order """
+    table = Metadata.__table__
+    pending = set(key for (key,) in connection.execute(
+                    select([table.c.Key]).where(table.c.Key.like('backfill:%'))))
+    return [(backfill_key(t.name, c), BACKFILLS[(t.name, c)])
+                for t in Base.metadata.sorted_tables
+                for c in [None] + [column.name for column in t.columns]
+                if (t.name, c) in BACKFILLS and backfill_key(t.name, c) in pending]
+
+
+def add_column(connection, table, column):
+    dialect = connection.dialect
+    connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        dialect.identifier_preparer.format_table(table),
+        dialect.identifier_preparer.quote(column.name),
+        column.type.compile(dialect=dialect)))
+
+def retyped_columns(inspector, table):
+    """ Columns the model declares Date but the db holds as another type, eg. the
+    'YYYY-MM-DD' strings of the first Offices schema """
+    reflected = dict((c['name'], c['type']) for c in inspector.get_columns(table.name))
+    return [c.name for c in table.columns if isinstance(c.type, Date)
+                and c.name in reflected and not isinstance(reflected[c.name], Date)]
+
+def retyping_name(table):
+    return table.name + '_retyping'
+
+def retype_table(connection, inspector, table, columns):
+    """ Rebuild table as the model declares it, converting the values of columns to
+    dates: SQLite can't change a column's type in place. pysqlite commits before
+    each DDL statement, so nothing here is one transaction: the new table is built
+    and filled aside, and only once it is complete is the old one dropped and the
+    new renamed into place (resume_retyping finishes an interrupted run). Rows
+    left without a primary key by a value which is not a date are dropped.
+    Returns the columns which are new to the table. """
+    new_name = retyping_name(table)
+    old = Table(table.name, MetaData(), autoload=True, autoload_with=connection)
+
+    copies = []
+    for column in table.columns:
+        copy = column.copy()
+        copy.index = None # the model's indexes are made once the table has its name
+        copies.append(copy)
+    new = Table(new_name, MetaData(), *copies)
+    new.drop(connection, checkfirst=True)
+    new.create(connection)
+
+    kept = [c.name for c in old.columns if c.name in table.columns]
+    key = [c.name for c in table.primary_key.columns]
+    rows = []
+    skipped = 0
+    for row in connection.execute(select([old.c[name] for name in kept])):
+        values = dict(zip(kept, row))
+        for column in columns:
+            values[column] = history.to_date(values[column])
+        if any(values.get(name) is None for name in key if name in columns):
+            skipped += 1
+            continue
+        rows.append(values)
+    if skipped:
+        print "WARNING: Dropped %d rows of %s with no valid date in their key" % (
+                skipped, table.name)
+    if rows:
+        connection.execute(new.insert(), rows)
+
+    # the copy is complete: only now does the old table go
+    old.drop(connection)
+    _rename_into_place(connection, table)
+    return [c.name for c in table.columns if c.name not in kept]
+
+def _rename_into_place(connection, table):
+    preparer = connection.dialect.identifier_preparer
+    connection.execute('ALTER TABLE %s RENAME TO %s' % (
+        preparer.quote(retyping_name(table)), preparer.format_table(table)))
+    for index in table.indexes:
+        index.create(connection)
+
+def resume_retyping(connection, inspector, existing_tables):
+    """ Finish or undo a retype_table which was interrupted. A copy on its own is
+    complete, as the old table is only dropped after it is filled: it is renamed
+    into place. A copy beside the old table may be partial: it is dropped, and the
+    table retyped again. Earlier versions renamed the old table aside instead, so
+    one left with the old column types is put back in place of the new table.
+    Returns the changes made. """
+    quote = connection.dialect.identifier_preparer.quote
+    changes = []
+    for table in Base.metadata.sorted_tables:
+        aside = retyping_name(table)
+        if aside not in existing_tables:
+            continue
+        if table.name not in existing_tables:
+            _rename_into_place(connection, table)
+            changes.append('resumed retyping %s' % table.name)
+        elif retyped_columns(inspector, Table(aside, MetaData(), 
+                                *[c.copy() for c in table.columns])):
+            connection.execute('DROP TABLE %s' % quote(table.name))
+            connection.execute('ALTER TABLE %s RENAME TO %s' % (quote(aside), quote(table.name)))
+            changes.append('restored %s from %s' % (table.name, aside))
+        else:
+            connection.execute('DROP TABLE %s' % quote(aside))
+            changes.append('dropped partial %s' % aside)
+    return changes
+
+def migrate(engine, session_factory):
+    """ Create missing tables, add missing columns, create missing indexes, convert
+    columns now typed as dates and run the backfills for any columns added. Safe to run on an up to date database.
+    Each backfill is marked pending in the Metadata table along with its DDL, and
+    only cleared in the commit which fills it in, so one which fails is run again
+    by the next migrate. Returns a list of the changes made. """
+    changes = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        changes.extend(resume_retyping(connection, inspector, existing_tables))
+        # the pending backfills are recorded in it, so it comes first
+        if Metadata.__tablename__ not in existing_tables:
+            Metadata.__table__.create(connection)
+            changes.append('created table %s' % Metadata.__tablename__)
+
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                mark_backfill(connection, table.name)
+                table.create(connection)
+                changes.append('created table %s' % table.name)
+                continue
+
+            columns = set(c['name'] for c in inspector.get_columns(table.name))
+            retyped = retyped_columns(inspector, table)
+            if retyped:
+                for column in table.columns:
+                    if column.name not in columns:
+                        mark_backfill(connection, table.name, column.name)
+                added = retype_table(connection, inspector, table, retyped)
+                changes.extend('retyped column %s.%s' % (table.name, c) for c in retyped)
+                changes.extend('added column %s.%s' % (table.name, c) for c in added)
+                continue
+
+            for column in table.columns:
+                if column.name not in columns:
+                    mark_backfill(connection, table.name, column.name)
+                    add_column(connection, table, column)
+                    changes.append('added column %s.%s' % (table.name, column.name))
+
+            indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    changes.append('created index %s' % index.name)
+
+    # each backfill commits with its mark cleared, so one failing leaves the rest pending
+    for key, backfill in pending_backfills(engine):
+        session = session_factory()
+        try:
+            backfill(session)
+            session.execute(Metadata.__table__.delete().where(Metadata.__table__.c.Key==key))
+            session.commit()
+        finally:
+            session.close()
+
+    return changes
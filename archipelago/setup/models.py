@@ -1,7 +1,7 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import  Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import  Column, Integer, String, Boolean, Date, ForeignKey, Index
 
 Base = declarative_base()
 
@@ -10,14 +10,15 @@ Base = declarative_base()
 class MPCommons(Base):
     __tablename__ = 'MPCommons'
 
-    Name = Column(String)
+    Name = Column(String, index=True)
     Constituency = Column(String, primary_key=True)
-    MP = Column(Integer, default=0)
-    Party = Column(String)
+    MP = Column(Integer, default=0, index=True)
+    Party = Column(String, index=True)
     ImageUrl = Column(String)
     MemberId = Column(Integer, unique=True, nullable=True)
     PersonId = Column(Integer, unique=True, nullable=True)
     OfficialId = Column(Integer, index=True, unique=True, nullable=True)
+    TwitterHandle = Column(String, index=True, nullable=True)
     Addresses = relationship("Address",
                             backref="mp",
                             primaryjoin="Address.OfficialId==MPCommons.OfficialId")
@@ -33,10 +34,16 @@ class Office(Base):
 
     PersonId = Column(Integer, ForeignKey(MPCommons.PersonId), primary_key=True)
     Office = Column(String, primary_key=True)
-    StartDate = Column(String, primary_key=True)
-    EndDate = Column(String)
+    StartDate = Column(Date, primary_key=True)
+    EndDate = Column(Date, index=True)
     Name = Column(String)
     Title = Column(String, primary_key=True)
+    # EndDate not passed when loaded: TWFY gives an office still held 9999-12-31
+    IsCurrent = Column(Boolean, default=False)
+
+    # "current jobs" by person or department, without scanning the dates
+    __table_args__ = (Index('ix_Offices_IsCurrent_PersonId', 'IsCurrent', 'PersonId'),
+                      Index('ix_Offices_IsCurrent_Office', 'IsCurrent', 'Office'))
 
     def __repr__(self):
         return "<Office Type ( Name:'%s', Title:'%s', Office:'%s', StartDate'%s', EndDate:'%s')>" % (
@@ -49,9 +56,61 @@ class Address(Base):
     AddressType = Column(String)
     Address = Column(String, primary_key=True) 
 
+    # covers the AddressType=='twitter' filters and their join back to MPCommons
+    __table_args__ = (Index('ix_Addresses_AddressType_OfficialId', 'AddressType', 'OfficialId'),)
+
     # def __repr__(self):
     #     pass
 
+class SearchTrigram(Base):
+    # n-gram index behind Archipelago.search: fuzzy matching, and the fallback for
+    # engines without SQLite's FTS5. Rebuilt by setup/search_index.py.
+    __tablename__ = 'SearchTrigrams'
+
+    Trigram = Column(String, primary_key=True)
+    Constituency = Column(String, primary_key=True)
+
+class Membership(Base):
+    # one row per interval a person sat for a seat (and party), kept across rebuilds. 
+    # EndDate is history.OPEN_END while it lasts. Written by setup/history.py.
+    __tablename__ = 'Memberships'
+
+    Id = Column(Integer, primary_key=True)
+    PersonId = Column(Integer, nullable=False)
+    Constituency = Column(String, nullable=False)
+    Name = Column(String)
+    Party = Column(String)
+    StartDate = Column(Date, nullable=False)
+    EndDate = Column(Date, nullable=False)
+
+    # interval lookups: by seat or person, and both ends for "held on date X", so
+    # the planner can range scan whichever end is more selective
+    __table_args__ = (Index('ix_Memberships_Constituency_StartDate', 'Constituency', 'StartDate'),
+                      Index('ix_Memberships_PersonId_StartDate', 'PersonId', 'StartDate'),
+                      Index('ix_Memberships_StartDate_EndDate', 'StartDate', 'EndDate'),
+                      Index('ix_Memberships_EndDate_StartDate', 'EndDate', 'StartDate'))
+
+class OfficeTerm(Base):
+    # every office interval ever seen in Offices, kept across rebuilds
+    __tablename__ = 'OfficeTerms'
+
+    PersonId = Column(Integer, primary_key=True)
+    Office = Column(String, primary_key=True)
+    Title = Column(String, primary_key=True)
+    StartDate = Column(Date, primary_key=True)
+    EndDate = Column(Date, nullable=False)
+    Name = Column(String)
+
+    __table_args__ = (Index('ix_OfficeTerms_Office_StartDate', 'Office', 'StartDate'),
+                      Index('ix_OfficeTerms_StartDate_EndDate', 'StartDate', 'EndDate'),
+                      Index('ix_OfficeTerms_EndDate_StartDate', 'EndDate', 'StartDate'))
+
+class Metadata(Base):
+    __tablename__ = 'ArchipelagoMeta'
+
+    Key = Column(String, primary_key=True)
+    Value = Column(String)
+
 if __name__ == '__main__':
     from sqlalchemy import create_engine
     from sqlalchemy.orm import sessionmaker
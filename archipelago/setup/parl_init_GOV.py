@@ -4,33 +4,72 @@ from lxml import etree
 import os
 import time
 import json
+import itertools
+from urlparse import urlsplit
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
 from models import Office, Address, MPCommons
+import transport
+import bulk
+from text import normalise
 
 ###########################
 site = 'http://data.parliament.uk/membersdataplatform/services/mnis/'
+# number of constituencies fetched in parallel by GOV_setup. DB writes always
+# happen on a single thread, in constituency order.
+default_workers = 8
+# 'per_constituency' makes one MNIS request per seat, 'bulk' one request for 
+# the whole house, parsed as it streams in, falling back to per seat requests
+# for any constituency it could not match
+default_mode = 'bulk'
+bulk_request = 'House=Commons|IsEligible=true/'
 ###########################
 
 
 def fetch_xml_online(request, api='members/query/', output=''):
     url = site + api + request + output
 
-    data_request = requests.get(url)
+    data_request = transport.get(url)
     data_req_string = data_request.content
     data_xml = etree.fromstring(data_req_string)
 
     return data_xml
 
+def iter_members_online(request, api='members/query/', output=''):
+    """ Yield each <Member> element of an MNIS query as it is parsed off the response 
+    stream. Elements are cleared once the caller moves on, so memory stays flat 
+    however many members the document holds: use each one before asking for the next. """
+    url = site + api + request + output
+
+    with transport.open_stream(url) as stream:
+        for event, member_xml in etree.iterparse(stream, events=('end',), tag='Member'):
+            yield member_xml
+            # drop the member, and the references the root keeps to those before it
+            member_xml.clear()
+            while member_xml.getprevious() is not None:
+                del member_xml.getparent()[0]
+
+def iter_member_addresses(request=bulk_request):
+    """ Yield the addresses of every member matching an MNIS query, one at a time """
+    for member_xml in iter_members_online(request, output='Addresses/'):
+        yield build_mp_addresses_from_member(member_xml)
+
 def build_mp_addresses_from_constituency(addresses_request_xml):
     """ Build a python object containing addresses about an MP """
     # print etree.tostring(addresses_request_xml, pretty_print=True)
     #ERROR HANDLING
+    return build_mp_addresses_from_member(addresses_request_xml[0])
+
+def build_mp_addresses_from_member(member_xml):
+    """ Build the addresses object from a single <Member> element """
     mp_address = {}
-    mp_address["official_ID"] = addresses_request_xml[0].get('Member_Id')
-    mp_address["name"] = addresses_request_xml[0].find('DisplayAs').text
-    mp_address["constituency"] = addresses_request_xml[0].find('MemberFrom').text
+    mp_address["official_ID"] = member_xml.get('Member_Id')
+    mp_address["name"] = member_xml.find('DisplayAs').text
+    mp_address["constituency"] = member_xml.find('MemberFrom').text
     mp_address["addresses"] = {}
-    addresses_xml = addresses_request_xml[0].find('Addresses')
+    addresses_xml = member_xml.find('Addresses')
+    if addresses_xml is None:
+        return mp_address
 
     for address_xml in addresses_xml:
         a_type = address_xml.get('Type_Id')
@@ -42,19 +81,63 @@ def build_mp_addresses_from_constituency(addresses_request_xml):
 
     return mp_address
 
-def load_addresses_from_constituency(constituency, session):
+def fetch_mp_addresses(constituency):
+    """ Fetch and build the addresses for a constituency. Safe to call from worker threads """
+    addresses_xml = fetch_xml_online('constituency='+constituency+'/', output='Addresses/')
+    return build_mp_addresses_from_constituency(addresses_xml)
+
+def handle_from_twitter_url(twitter_url):
+    """ 'https://twitter.com/mark4ceredigion' -> 'mark4ceredigion'. Copes with www., 
+    missing schemes, trailing slashes, #!/ urls and bare '@handles'. """
+    url = twitter_url.strip()
+    if '://' not in url and '/' in url:
+        url = 'http://' + url
+    if '://' in url:
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        url = fragment[1:] if fragment.startswith('!/') else path
+
+    segments = [segment for segment in url.split('/') if segment]
+    return segments[0].lstrip('@') if segments else None
+
+def fold_handle(handle):
+    """ The canonical form of a handle, '@handle' or twitter url: the bare handle, 
+    lower cased, as twitter matches handles regardless of case """
+    handle = handle_from_twitter_url(handle)
+    return handle.lower() if handle else None
+
+def twitter_handle(mp_addresses):
+    if "twitter" not in mp_addresses["addresses"]:
+        return None
+    return handle_from_twitter_url(mp_addresses["addresses"]["twitter"])
+
+def address_rows(mp_addresses):
+    official_ID = int(mp_addresses["official_ID"])
+    return [{'OfficialId':official_ID, 'AddressType':a_type, 'Address':address}
+                for a_type, address in mp_addresses["addresses"].items()]
+
+def write_addresses_batch(batch, session):
+    """ Write a list of (constituency, mp_addresses) in two batched statements """
     #note: this function could be used to populate many fields: name, party, etc. can update later
     #      right now, leave the TWFY data in place: INPUT --> Official Id, Address
-    addresses_xml = fetch_xml_online('constituency='+constituency+'/', output='Addresses/')
-    mp_addresses = build_mp_addresses_from_constituency(addresses_xml)
-    official_ID = mp_addresses["official_ID"]
- 
-    session.query(MPCommons).filter(MPCommons.Constituency==constituency).\
-                update({MPCommons.OfficialId:official_ID})
+    bulk.bulk_update(session, MPCommons, 'Constituency', 
+        [{'Constituency':c, 'OfficialId':int(mp_addresses["official_ID"]),
+          'TwitterHandle':twitter_handle(mp_addresses)} for c, mp_addresses in batch])
+    bulk.bulk_upsert(session, Address, 
+        [row for c, mp_addresses in batch for row in address_rows(mp_addresses)])
 
-    for a_type, address in mp_addresses["addresses"].items():
-        address = Address(OfficialId=official_ID, AddressType=a_type, Address=address)
-        session.add(address)
+def write_mp_addresses(constituency, mp_addresses, session):
+    write_addresses_batch([(constituency, mp_addresses)], session)
+
+def load_addresses_from_constituency(constituency, session):
+    mp_addresses = fetch_mp_addresses(constituency)
+    write_mp_addresses(constituency, mp_addresses, session)
+
+def _fetch_mp_addresses_job(constituency):
+    # runs on the pool: hand IndexErrors back so the writer can report them in order
+    try:
+        return constituency, fetch_mp_addresses(constituency), None
+    except IndexError as error:
+        return constituency, None, error
 
 def get_constituencies(session):
     """Return a python list of constituencies in the archipelago database.""" 
@@ -65,20 +148,78 @@ def get_constituencies(session):
 
 
 
-def GOV_setup(session_factory):
+def iter_mp_addresses(constituencies, workers=1):
+    """ Yield (constituency, mp_addresses, error) for each constituency, in order.
+    With workers > 1 the MNIS requests are fetched and parsed on a thread pool. """
+    pool = None
+    if workers > 1:
+        pool = ThreadPool(workers)
+        fetched = pool.imap(_fetch_mp_addresses_job, constituencies)
+    else:
+        fetched = itertools.imap(_fetch_mp_addresses_job, constituencies)
+
+    try:
+        for result in fetched:
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def constituency_key(constituency):
+    """ Key to join MNIS and TWFY constituency names, which differ in accents, 
+    punctuation and '&' against 'and': u'Ynys M\xf4n' -> u'ynys mon' """
+    words = normalise(constituency).split()
+    return u' '.join(word for word in words if word != u'and')
+
+def match_members(constituencies, members):
+    """ Join streamed member addresses to constituencies in memory. Returns 
+    {constituency: mp_addresses} for the constituencies matched. """
+    keys = dict((constituency_key(c), c) for c in constituencies)
+    matched = {}
+    for mp_addresses in members:
+        c = keys.get(constituency_key(mp_addresses["constituency"]))
+        if c is not None and c not in matched:
+            matched[c] = mp_addresses
+    return matched
+
+def fetch_addresses(constituencies, workers=1, mode=default_mode):
+    """ Return {constituency: mp_addresses} and a list of constituencies which could
+    not be loaded. In 'bulk' mode one request is joined to the constituencies, and 
+    only those left unmatched are fetched seat by seat, on workers threads. """
+    if mode == 'bulk':
+        addresses = match_members(constituencies, iter_member_addresses())
+        remaining = [c for c in constituencies if c not in addresses]
+    elif mode == 'per_constituency':
+        addresses, remaining = {}, constituencies
+    else:
+        raise ValueError("Unknown GOV setup mode %r" % mode)
+
+    failed = []
+    fetched = iter_mp_addresses(remaining, workers)
+    for c, mp_addresses, error in tqdm(fetched, total=len(remaining)):
+        if error is not None:
+            failed.append(c)
+        else:
+            addresses[c] = mp_addresses
+    return addresses, failed
+
+def GOV_setup(session_factory, workers=1, mode=default_mode):
+    """ Load addresses for every constituency. Fetching may happen on a pool of workers, 
+    but this thread remains the only writer. Writes happen in constituency order, so 
+    they are the same whichever mode or number of workers fetched them. """
     start = time.time()
     session = session_factory()
     constituencies = get_constituencies(session)
-    for c in tqdm(constituencies):
-        try:
-            load_addresses_from_constituency(c, session)
-        except IndexError:
-            print "ERROR: Could not load %s! Please check data " % c
-            continue
+
+    addresses, failed = fetch_addresses(constituencies, workers, mode)
+    for c in failed:
+        print "ERROR: Could not load %s! Please check data " % c
+    batch = [(c, addresses[c]) for c in constituencies if c in addresses]
+
+    write_addresses_batch(batch, session)
+
     session.commit()
     session.close()
     print 'GOV Setup in %ds'%(time.time()-start)
 
-    
-
-
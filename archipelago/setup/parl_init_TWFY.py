@@ -6,9 +6,14 @@ from lxml import etree
 import os
 import time
 import json
+import datetime
 from tqdm import tqdm
 
 from models import Office, Address, MPCommons
+import transport
+import bulk
+import images
+from history import to_date, OPEN_END
 
 
 def load_TWFY_key():
@@ -40,7 +45,7 @@ base_template = 'api/%s?key=%s&output=%s'
 def fetch_data_online(request_type, bonus_arg='', output='json'):
     url = site + base_template%(request_type, key, output) + bonus_arg
 
-    data_request = requests.get(url)
+    data_request = transport.get(url)
     data_req_string = data_request.text
     
     fetched_data = None
@@ -50,9 +55,11 @@ def fetch_data_online(request_type, bonus_arg='', output='json'):
     return fetched_data
 
 
+def fetch_constituency_names():
+    return [c["name"] for c in fetch_data_online('getConstituencies')]
+
 def load_constituencies(session):
-    constituencies_json = fetch_data_online('getConstituencies')
-    mp_list = [MPCommons(Constituency=c["name"]) for c in constituencies_json]
+    mp_list = [MPCommons(Constituency=c) for c in fetch_constituency_names()]
 
     session.add_all(mp_list)
     
@@ -85,14 +92,14 @@ def build_mp_and_office_lists(mp_details_json):
 
     return (mp_details, office_details)
 
-def load_mp_details(session):  
+parties = ['conservative', 'labour', 'liberal', 'green', 'independent',
+    'ukip', 'DUP', 'sinn fein', 'sdlp', 'plaid', 'scottish']
+
+def fetch_party_mp_and_office_lists():
     mps_list = []
     offices_list = []
 
-    parties = ['conservative', 'labour', 'liberal', 'green', 'independent',
-        'ukip', 'DUP', 'sinn fein', 'sdlp', 'plaid', 'scottish']
-    
-    #collate details from major parties & insert names into db
+    #collate details from major parties
     for party in parties:
         mps_and_offices_json = fetch_data_online("getMPs", "&party=%s"%party)
         party_mps, party_offices = build_mp_and_office_lists(mps_and_offices_json)
@@ -100,75 +107,100 @@ def load_mp_details(session):
         mps_list.extend(party_mps)
         offices_list.extend(party_offices)
 
-    for mp in mps_list:
-        session.query(MPCommons).filter(MPCommons.Constituency==mp['constituency']).\
-            update({
-                MPCommons.Name:mp['name'], 
-                MPCommons.Party:mp['party'],
-                MPCommons.MP:1,  
-                MPCommons.MemberId:mp['member_id'],
-                MPCommons.PersonId:mp['person_id']
-            })
+    return (mps_list, offices_list)
 
+def fetch_seat_mp_and_office_lists(seats):
+    """ Fall back to one getMP call per seat, for MPs missed by the party lists """
+    mps_list = []
+    offices_list = []
 
-    remaining_mp_list = []
-
-    for seat in session.query(MPCommons.Constituency).filter(MPCommons.MP==0):
+    for seat in seats:
         seat_json = fetch_data_online('getMP', '&constituency=%s'%seat)
-        
-        if "error" in seat_json.keys():
-            print seat_json["error"]
-            print "***WARNING***: Check by-election for: %s" % seat
-            continue
-        seat_json["name"] = seat_json["full_name"]
-        mp, office = build_mp_and_office_lists([seat_json])
-
-        remaining_mp_list.extend(mp)
+        mp, office = build_seat_mp_and_office_lists(seat, seat_json)
+
+        mps_list.extend(mp)
         offices_list.extend(office)
 
-    for mp in remaining_mp_list:
-        session.query(MPCommons).filter(MPCommons.Constituency==mp['constituency']).\
-            update({
-                MPCommons.Name:mp['name'], 
-                MPCommons.Party:mp['party'],
-                MPCommons.MP:1,  
-                MPCommons.MemberId:mp['member_id'],
-                MPCommons.PersonId:mp['person_id']
-            })
+    return (mps_list, offices_list)
+
+def build_seat_mp_and_office_lists(seat, seat_json):
+    """ Build the MP and offices from a getMP response, or empty lists for a vacant seat """
+    if "error" in seat_json.keys():
+        print seat_json["error"]
+        print "***WARNING***: Check by-election for: %s" % seat
+        return ([], [])
+    seat_json["name"] = seat_json["full_name"]
+    return build_mp_and_office_lists([seat_json])
+
+def fetch_mp_and_office_lists(constituencies):
+    """ Fetch every MP and office for the given constituencies, without touching the db """
+    mps_list, offices_list = fetch_party_mp_and_office_lists()
+
+    found = set(mp['constituency'] for mp in mps_list)
+    remaining_mp_list, remaining_offices = fetch_seat_mp_and_office_lists(
+                                [c for c in constituencies if c not in found])
 
+    return (mps_list + remaining_mp_list, unique_offices(offices_list + remaining_offices))
+
+def unique_offices(offices_list):
     # filter unique list of offices
     unique_office_tuple_set = set([ tuple(o_dict.items()) for o_dict in offices_list])
-    unique_offices = [dict(unique_tuple) for unique_tuple in unique_office_tuple_set]
+    return [dict(unique_tuple) for unique_tuple in unique_office_tuple_set]
+
+def mp_columns(mp):
+    return {'Constituency':mp['constituency'], 'Name':mp['name'], 'Party':mp['party'], 
+            'MP':1, 'MemberId':mp['member_id'], 'PersonId':mp['person_id']}
+
+def is_current(end_date, today=None):
+    return end_date is None or end_date >= (today or datetime.date.today())
+
+def office_columns(office):
+    end_date = to_date(office['end_date'], OPEN_END)
+    return {'PersonId':office['person_id'], 'Office':office['department'], 
+            'StartDate':to_date(office['start_date']), 'EndDate':end_date,
+            'Name':office['name'], 'Title':office['title'], 'IsCurrent':is_current(end_date)}
+
+def office_rows(offices_list):
+    """ office_columns for each office, less those without a valid start date, which
+    is part of the key """
+    rows = [office_columns(o) for o in offices_list]
+    undated = [row for row in rows if row['StartDate'] is None]
+    for row in undated:
+        print "WARNING: Skipping %s's office in %s, with no valid start date" % (
+                row['Name'], row['Office'])
+    return [row for row in rows if row['StartDate'] is not None]
+
+def update_mps(mps_list, session):
+    bulk.bulk_update(session, MPCommons, 'Constituency', [mp_columns(mp) for mp in mps_list])
 
+def load_mp_details(session):  
+    mps_list, offices_list = fetch_party_mp_and_office_lists()
+    update_mps(mps_list, session)
 
-    offices= [ Office(PersonId=o['person_id'], Office=o['department'], 
-                    StartDate=o['start_date'], EndDate=o['end_date'],
-                    Name=o['name'], Title=o['title']
-                      ) for o in unique_offices ]   
+    seats = [seat for (seat,) in session.query(MPCommons.Constituency).filter(MPCommons.MP==0)]
+    remaining_mp_list, remaining_offices = fetch_seat_mp_and_office_lists(seats)
+    update_mps(remaining_mp_list, session)
 
-    session.add_all(set(offices))
+    bulk.bulk_upsert(session, Office, 
+        office_rows(unique_offices(offices_list + remaining_offices)))
 
 def download_images_from_person_id(person_id):
-    image_req = requests.get(site+'images/mps/%d.jpg'%person_id)
-    with open('profile_images/%d.jpg'%person_id, 'w') as img:
+    image_req = transport.get(site+'images/mps/%d.jpg'%person_id, cache=False)
+    with open('profile_images/%d.jpg'%person_id, 'wb') as img:
         img.write(image_req.content)
         img.close()
 
-def load_images_for_imageless_mps(session):
-    if not os.path.exists('profile_images'):
-        os.makedirs('profile_images')
-    
-    for no_image_mp in tqdm(session.query(MPCommons).filter(MPCommons.ImageUrl==None)):
-        download_images_from_person_id(no_image_mp.PersonId)
-        no_image_mp.ImageUrl = 'images/mps/%s.jpg'%no_image_mp.PersonId
+def load_images_for_imageless_mps(session, thumbnails=False):
+    images.sync_images(session, 'profile_images', only_missing=True, thumbnails=thumbnails)
 
 
-def TWFY_setup(session_factory):
+def TWFY_setup(session_factory, load_images=False):
     start = time.time()
     session = session_factory()
     load_constituencies(session)
     load_mp_details(session)
-    # load_images_for_imageless_mps(session)
+    if load_images:
+        load_images_for_imageless_mps(session)
     session.commit()
     session.close()
     print 'TWFY Setup in %ds'%(time.time()-start)
@@ -0,0 +1,354 @@
+#staged setup: TWFY and GOV fetched side by side, with building and DB loading
+#overlapping the network I/O. Stages are threads joined by bounded queues.
+import sys
+import time
+import Queue
+import threading
+from collections import OrderedDict
+
+import parl_init_TWFY as pi_TWFY
+import parl_init_GOV as pi_GOV
+from models import MPCommons, Office
+import bulk
+
+###########################
+# items a queue holds before its producers block
+default_queue_size = 32
+# addresses written per statement by the loader
+address_batch_size = 100
+###########################
+
+
+_DONE = object()
+
+class PipelineAborted(Exception):
+    """ Raised inside a stage when another stage has failed """
+    pass
+
+
+class Pipeline(object):
+    """ Sources (generators) feed a chain of stages, each a thread applying a handler
+    to the items from the previous one. Every queue is bounded, so a fast producer
+    waits for a slow consumer rather than filling memory. The first error in any
+    thread stops the others and is raised again from run(). """
+
+    def __init__(self, queue_size=default_queue_size):
+        self.queue_size = queue_size
+        self.sources = []
+        self.stages = []
+        self.stats = OrderedDict()
+        self._failed = threading.Event()
+        self._error = None
+
+    def source(self, name, produce):
+        """ produce() returns an iterable of items for the first stage """
+        self.sources.append((name, produce))
+        return self
+
+    def stage(self, name, handle, finish=None, abort=None):
+        """ handle(item) returns an iterable of items for the next stage (or None).
+        finish(), if given, runs on the stage's thread once its input is exhausted;
+        abort(), if given, runs on it instead when the pipeline fails. """
+        self.stages.append((name, handle, finish, abort))
+        return self
+
+    def run(self):
+        queues = [Queue.Queue(self.queue_size) for _ in self.stages]
+        threads = []
+        for name, produce in self.sources:
+            self.stats[name] = {'items':0, 'busy':0.0, 'wall':0.0}
+            threads.append(threading.Thread(target=self._run_source,
+                                            args=(name, produce, queues[0])))
+
+        producers = len(self.sources)
+        for i, (name, handle, finish, abort) in enumerate(self.stages):
+            self.stats[name] = {'items':0, 'busy':0.0, 'wall':0.0, 'max_depth':0, 'mean_depth':0.0}
+            output = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._run_stage,
+                args=(name, handle, finish, abort, queues[i], producers, output)))
+            producers = 1
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self.stats
+
+    def aborted(self):
+        return self._failed.is_set()
+
+    def _fail(self):
+        if not self._failed.is_set():
+            self._error = sys.exc_info()
+            self._failed.set()
+
+    def _put(self, queue, item):
+        while True:
+            if self._failed.is_set():
+                raise PipelineAborted()
+            try:
+                return queue.put(item, timeout=0.1)
+            except Queue.Full:
+                pass
+
+    def _get(self, queue):
+        while True:
+            if self._failed.is_set():
+                raise PipelineAborted()
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+    def _run_source(self, name, produce, output):
+        stats = self.stats[name]
+        start = time.time()
+        try:
+            for item in produce():
+                self._put(output, item)
+                stats['items'] += 1
+            self._put(output, _DONE)
+        except PipelineAborted:
+            pass
+        except Exception:
+            self._fail()
+        finally:
+            stats['wall'] = stats['busy'] = time.time() - start
+
+    def _abort_stage(self, abort):
+        if abort is None:
+            return
+        try:
+            abort()
+        except Exception:
+            self._fail()
+
+    def _run_stage(self, name, handle, finish, abort, input, producers, output):
+        stats = self.stats[name]
+        start = time.time()
+        depth_total = 0
+        try:
+            while producers:
+                depth = input.qsize()
+                item = self._get(input)
+                if item is _DONE:
+                    producers -= 1
+                    continue
+
+                stats['max_depth'] = max(stats['max_depth'], depth)
+                depth_total += depth
+                stats['items'] += 1
+
+                busy = time.time()
+                results = handle(item) or ()
+                stats['busy'] += time.time() - busy
+                if output is not None:
+                    for result in results:
+                        self._put(output, result)
+
+            if finish is not None:
+                busy = time.time()
+                finish()
+                stats['busy'] += time.time() - busy
+            if output is not None:
+                self._put(output, _DONE)
+        except PipelineAborted:
+            self._abort_stage(abort)
+        except Exception:
+            self._fail()
+            self._abort_stage(abort)
+        finally:
+            stats['wall'] = time.time() - start
+            if stats['items']:
+                stats['mean_depth'] = float(depth_total)/stats['items']
+
+
+def format_stats(stats):
+    lines = []
+    for name, s in stats.items():
+        line = '%-8s %5d items  busy %6.2fs  wall %6.2fs' % (name, s['items'], s['busy'], s['wall'])
+        if 'max_depth' in s:
+            line += '  queue max %d mean %.1f' % (s['max_depth'], s['mean_depth'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def twfy_source(constituencies_known):
+    """ TWFY: the constituency list, then the party lists, then getMP for seats missed """
+    def produce():
+        constituencies = pi_TWFY.fetch_constituency_names()
+        constituencies_known(constituencies)
+        yield ('constituencies', constituencies)
+
+        found = set()
+        for party in pi_TWFY.parties:
+            mps_json = pi_TWFY.fetch_data_online('getMPs', '&party=%s'%party)
+            found.update(mp["constituency"] for mp in mps_json)
+            yield ('twfy_mps', mps_json)
+
+        for seat in constituencies:
+            if seat not in found:
+                yield ('twfy_seat', (seat, pi_TWFY.fetch_data_online('getMP', '&constituency=%s'%seat)))
+    return produce
+
+def gov_source(constituencies, workers=1, mode=pi_GOV.default_mode):
+    """ GOV: one streamed bulk query, or one request per seat once the constituencies
+    are known. iterparse clears members as it goes, so they are built here. """
+    def produce():
+        if mode == 'bulk':
+            for mp_addresses in pi_GOV.iter_member_addresses():
+                yield ('addresses', (None, mp_addresses))
+        elif mode == 'per_constituency':
+            for c, mp_addresses, error in pi_GOV.iter_mp_addresses(constituencies(), workers):
+                if error is not None:
+                    yield ('gov_failed', c)
+                else:
+                    yield ('addresses', (c, mp_addresses))
+        else:
+            raise ValueError("Unknown GOV setup mode %r" % mode)
+    return produce
+
+def build(item):
+    kind, payload = item
+    if kind == 'twfy_mps':
+        mps_list, offices_list = pi_TWFY.build_mp_and_office_lists(payload)
+    elif kind == 'twfy_seat':
+        mps_list, offices_list = pi_TWFY.build_seat_mp_and_office_lists(*payload)
+    else:
+        return [item]
+    return [('mps', mps_list), ('offices', pi_TWFY.unique_offices(offices_list))]
+
+
+class SetupLoader(object):
+    """ The only writer. Rows which arrive before their constituencies are loaded are
+    held back; seats GOV's bulk query did not match are fetched one by one at the end. """
+
+    def __init__(self, session_factory, gov_workers=1):
+        self.session_factory = session_factory
+        self.gov_workers = gov_workers
+        self.session = None
+        self.constituencies = None
+        self.keys = {}
+        self.pending = []
+        self.addresses = []
+        self.loaded = set()
+        self.attempted = set()
+
+    def handle(self, item):
+        if self.session is None:
+            # made on the loader's thread, which is the only one to use it
+            self.session = self.session_factory()
+
+        kind, payload = item
+        if kind == 'constituencies':
+            self.load_constituencies(payload)
+        elif self.constituencies is None:
+            self.pending.append(item)
+        elif kind == 'mps':
+            pi_TWFY.update_mps(payload, self.session)
+        elif kind == 'offices':
+            bulk.bulk_upsert(self.session, Office, pi_TWFY.office_rows(payload))
+        elif kind == 'addresses':
+            self.add_addresses(*payload)
+        elif kind == 'gov_failed':
+            self.attempted.add(payload)
+
+    def load_constituencies(self, constituencies):
+        self.constituencies = constituencies
+        self.keys = dict((pi_GOV.constituency_key(c), c) for c in constituencies)
+        self.session.add_all([MPCommons(Constituency=c) for c in constituencies])
+        self.session.flush()
+
+        pending, self.pending = self.pending, []
+        for item in pending:
+            self.handle(item)
+
+    def add_addresses(self, constituency, mp_addresses):
+        if constituency is None:
+            constituency = self.keys.get(pi_GOV.constituency_key(mp_addresses["constituency"]))
+        if constituency is None or constituency in self.loaded:
+            return
+
+        self.loaded.add(constituency)
+        self.attempted.add(constituency)
+        self.addresses.append((constituency, mp_addresses))
+        if len(self.addresses) >= address_batch_size:
+            self.write_addresses()
+
+    def write_addresses(self):
+        pi_GOV.write_addresses_batch(self.addresses, self.session)
+        self.addresses = []
+
+    def finish(self):
+        if self.session is None:
+            self.session = self.session_factory()
+
+        missing = [c for c in self.constituencies or [] if c not in self.attempted]
+        for c, mp_addresses, error in pi_GOV.iter_mp_addresses(missing, self.gov_workers):
+            if error is not None:
+                self.attempted.add(c)
+            else:
+                self.add_addresses(c, mp_addresses)
+
+        for c in self.constituencies or []:
+            if c not in self.loaded:
+                print "ERROR: Could not load %s! Please check data " % c
+        self.write_addresses()
+
+        self.session.commit()
+        self.close()
+
+    def close(self):
+        """ Roll back anything uncommitted and close the session. Safe to call twice. """
+        if self.session is not None:
+            session, self.session = self.session, None
+            session.rollback()
+            session.close()
+
+
+def pipelined_setup(session_factory, gov_workers=1, gov_mode=pi_GOV.default_mode,
+                    load_images=False, queue_size=default_queue_size):
+    """ Populate a fresh database from TWFY and GOV at once. Takes about as long as
+    the slowest source, rather than the sum of them. Returns the per stage stats. """
+    start = time.time()
+    known = threading.Event()
+    constituencies = []
+
+    def constituencies_known(names):
+        constituencies.extend(names)
+        known.set()
+
+    def wait_for_constituencies():
+        # a failed TWFY source must not leave GOV waiting forever
+        while not known.wait(0.1):
+            if pipeline.aborted():
+                raise PipelineAborted()
+        return constituencies
+
+    loader = SetupLoader(session_factory, gov_workers)
+    pipeline = Pipeline(queue_size).\
+        source('twfy', twfy_source(constituencies_known)).\
+        source('gov', gov_source(wait_for_constituencies, gov_workers, gov_mode)).\
+        stage('build', build).\
+        stage('load', loader.handle, loader.finish, loader.close)
+
+    try:
+        stats = pipeline.run()
+    except:
+        # the load stage has closed its session already, unless it never started
+        loader.close()
+        raise
+
+    if load_images:
+        session = session_factory()
+        pi_TWFY.load_images_for_imageless_mps(session)
+        session.commit()
+        session.close()
+
+    print 'Pipelined Setup in %ds' % (time.time() - start)
+    print format_stats(stats)
+    return stats
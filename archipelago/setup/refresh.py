@@ -0,0 +1,148 @@
+#refresh an existing archipelago database in place, writing only the rows that changed
+import time
+
+import parl_init_TWFY as pi_TWFY
+import parl_init_GOV as pi_GOV
+from models import MPCommons, Office, Address
+import generation
+import search_index
+import history
+
+
+def fetch_parliament(gov_workers=pi_GOV.default_workers, gov_mode=pi_GOV.default_mode):
+    """ Fetch the current TWFY and GOV data, without touching the db """
+    constituencies = pi_TWFY.fetch_constituency_names()
+    mps_list, offices_list = pi_TWFY.fetch_mp_and_office_lists(constituencies)
+
+    addresses, failed = pi_GOV.fetch_addresses(constituencies, gov_workers, gov_mode)
+    for c in failed:
+        print "ERROR: Could not load %s! Please check data " % c
+
+    return build_parliament_rows(constituencies, mps_list, offices_list, addresses, failed)
+
+def build_parliament_rows(constituencies, mps_list, offices_list, addresses, failed=()):
+    """ Build the rows a fresh setup would write, as {primary key: {column: value}}
+    dicts for each table. addresses maps constituency to the output of
+    build_mp_addresses_from_constituency. The GOV data of the failed seats is
+    unknown, rather than gone: their rows leave out OfficialId and TwitterHandle,
+    which apply_parliament_rows then keeps, along with their Addresses. """
+    mps = dict((c, {'Name':None, 'Party':None, 'MP':0, 'MemberId':None,
+                    'PersonId':None, 'OfficialId':None, 'TwitterHandle':None})
+                for c in constituencies)
+    for c in failed:
+        if c in mps:
+            del mps[c]['OfficialId'], mps[c]['TwitterHandle']
+
+    for mp in mps_list:
+        if mp['constituency'] in mps:
+            mps[mp['constituency']].update({'Name':mp['name'], 'Party':mp['party'], 'MP':1,
+                        'MemberId':mp['member_id'], 'PersonId':mp['person_id']})
+
+    address_rows = {}
+    for c, mp_addresses in addresses.items():
+        if c not in mps:
+            continue
+        official_id = int(mp_addresses["official_ID"])
+        mps[c]['OfficialId'] = official_id
+        mps[c]['TwitterHandle'] = pi_GOV.twitter_handle(mp_addresses)
+        for a_type, address in mp_addresses["addresses"].items():
+            address_rows[(official_id, address)] = {'AddressType':a_type}
+
+    office_rows = {}
+    for row in pi_TWFY.office_rows(offices_list):
+        office_rows[(row.pop('PersonId'), row.pop('Office'), row.pop('StartDate'), 
+                     row.pop('Title'))] = row
+
+    return {
+        MPCommons:dict(((c,), row) for c, row in mps.items()),
+        Office:office_rows,
+        Address:address_rows
+    }
+
+def _sync_table(session, model, desired, unique_columns=(), keep=None):
+    """ Make the rows of model match desired, returning counts of the changes.
+    Values of unique columns which change hands are cleared first, so that
+    eg. an MP moving seat does not collide with themselves. Rows missing from
+    desired are deleted, unless keep(row) is true. """
+    key_columns = [c.name for c in model.__table__.primary_key.columns]
+    existing = dict((tuple(getattr(row, k) for k in key_columns), row)
+                        for row in session.query(model))
+    counts = {'inserted':0, 'updated':0, 'deleted':0}
+
+    for key in set(existing) - set(desired):
+        if keep is not None and keep(existing[key]):
+            continue
+        session.delete(existing[key])
+        counts['deleted'] += 1
+    session.flush()
+
+    changed = []
+    for key in set(existing) & set(desired):
+        row, values = existing[key], desired[key]
+        differences = dict((column, value) for column, value in values.items()
+                            if getattr(row, column) != value)
+        if differences:
+            changed.append((row, differences))
+
+    for row, differences in changed:
+        for column in unique_columns:
+            if column in differences:
+                setattr(row, column, None)
+    session.flush()
+
+    for row, differences in changed:
+        for column, value in differences.items():
+            setattr(row, column, value)
+        counts['updated'] += 1
+
+    for key in sorted(set(desired) - set(existing)):
+        values = dict(zip(key_columns, key))
+        values.update(desired[key])
+        session.add(model(**values))
+        counts['inserted'] += 1
+    session.flush()
+
+    return counts
+
+def apply_parliament_rows(session, rows):
+    """ Apply the difference between rows and the db to session. Does not commit. """
+    unknown = [c for (c,), row in rows[MPCommons].items() if 'OfficialId' not in row]
+    kept = set(o_id for (o_id,) in session.query(MPCommons.OfficialId).\
+                    filter(MPCommons.Constituency.in_(unknown), MPCommons.OfficialId != None)) \
+                if unknown else set()
+    return {
+        MPCommons.__tablename__:_sync_table(session, MPCommons, rows[MPCommons],
+                                    unique_columns=('MemberId', 'PersonId', 'OfficialId')),
+        Office.__tablename__:_sync_table(session, Office, rows[Office]),
+        Address.__tablename__:_sync_table(session, Address, rows[Address],
+                                    keep=lambda address: address.OfficialId in kept)
+    }
+
+def format_summary(summary):
+    return ', '.join('%s: +%d ~%d -%d' % (table, counts['inserted'], counts['updated'],
+                        counts['deleted']) for table, counts in sorted(summary.items()))
+
+def refresh(session_factory, gov_workers=pi_GOV.default_workers, gov_mode=pi_GOV.default_mode):
+    """ Fetch fresh data and apply only the needed inserts, updates and deletes,
+    in a single transaction, which also holds the history, the search index and
+    the new generation stamp. Returns a summary of the changes per table. """
+    start = time.time()
+    rows = fetch_parliament(gov_workers, gov_mode)
+
+    session = session_factory()
+    try:
+        summary = apply_parliament_rows(session, rows)
+        if any(sum(counts.values()) for counts in summary.values()):
+            history.record_history(session)
+            # no DDL, which sqlite would commit early: the index is refilled in place
+            search_index.build_search_index(session, create=False)
+            generation.bump_generation(session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    print 'Refresh in %ds (%s)' % (time.time()-start, format_summary(summary))
+    return summary
@@ -0,0 +1,130 @@
+#full text & fuzzy search over MPs, constituencies, parties and offices
+import math
+from collections import defaultdict
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from models import MPCommons, Office, SearchTrigram
+import bulk
+from text import normalise
+
+###########################
+fts_table = 'MPSearch'
+# bm25 weights for the Name, Constituency, Party and Offices columns
+fts_weights = (10.0, 5.0, 1.0, 2.0)
+# share of the query's trigrams a fuzzy match needs
+min_similarity = 0.3
+###########################
+
+
+def trigrams(text):
+    grams = set()
+    for word in normalise(text).split():
+        padded = u'  %s ' % word
+        grams.update(padded[i:i+3] for i in range(len(padded) - 2))
+    return grams
+
+def search_documents(session):
+    """ One document per constituency: (Constituency, Name, Party, offices text) """
+    offices = defaultdict(list)
+    for person_id, office, title in session.query(Office.PersonId, Office.Office, Office.Title):
+        offices[person_id].append(u' '.join(t for t in (title, office) if t))
+
+    return [(c, name or u'', party or u'', u' ; '.join(sorted(offices.get(person_id, []))))
+            for c, name, party, person_id in session.query(MPCommons.Constituency,
+                                MPCommons.Name, MPCommons.Party, MPCommons.PersonId)]
+
+def _build_fts(session, documents):
+    session.execute('DROP TABLE IF EXISTS %s' % fts_table)
+    try:
+        session.execute('CREATE VIRTUAL TABLE %s USING fts5(Name, Constituency, Party, Offices)'
+                        % fts_table)
+    except OperationalError:
+        # sqlite built without FTS5: the trigram index does all the work
+        return False
+    return _fill_fts(session, documents)
+
+def _has_fts(session):
+    return session.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name",
+                           {'name':fts_table}).scalar() is not None
+
+def _fill_fts(session, documents):
+    # DML only: pysqlite commits any open transaction before DDL, but not before this
+    session.execute('DELETE FROM %s' % fts_table)
+    if not documents:
+        return True
+    session.execute('INSERT INTO %s (Name, Constituency, Party, Offices) '
+                    'VALUES (:name, :constituency, :party, :offices)' % fts_table,
+                    [{'name':name, 'constituency':c, 'party':party, 'offices':offices}
+                        for c, name, party, offices in documents])
+    return True
+
+def build_search_index(session, create=True):
+    """ Rebuild the FTS5 table (SQLite) and the trigram index. Does not commit.
+    create=False refills an existing FTS5 table rather than recreating it, so the
+    rebuild stays inside the caller's transaction (a db without one is searched
+    by trigrams alone). """
+    documents = search_documents(session)
+
+    fts = False
+    if session.get_bind().dialect.name == 'sqlite':
+        if create:
+            fts = _build_fts(session, documents)
+        elif _has_fts(session):
+            fts = _fill_fts(session, documents)
+
+    session.query(SearchTrigram).delete(synchronize_session=False)
+    bulk.bulk_upsert(session, SearchTrigram,
+        [{'Trigram':gram, 'Constituency':c} for c, name, party, offices in documents
+            for gram in trigrams(u' '.join((c, name, party, offices)))])
+    return fts
+
+def _fts_query(query):
+    # every word must match, as a prefix, so results narrow as the user types
+    words = normalise(query).split()
+    return u' '.join(u'"%s"*' % word for word in words)
+
+def _fts_search(session, query, limit):
+    match = _fts_query(query)
+    if not match:
+        return []
+    try:
+        rows = session.execute(
+            'SELECT Constituency, Name, Party, bm25(%s, %s) AS rank FROM %s '
+            'WHERE %s MATCH :match ORDER BY rank LIMIT :limit' % (
+                fts_table, ', '.join(str(w) for w in fts_weights), fts_table, fts_table),
+            {'match':match, 'limit':limit}).fetchall()
+    except OperationalError:
+        return None
+    # bm25 is negative, better matches more so
+    return [{'constituency':c, 'name':name, 'party':party, 'score':-rank}
+                for c, name, party, rank in rows]
+
+def _fuzzy_search(session, query, limit):
+    grams = trigrams(query)
+    if not grams:
+        return []
+
+    shared = func.count(SearchTrigram.Trigram)
+    matches = session.query(SearchTrigram.Constituency, shared).\
+                filter(SearchTrigram.Trigram.in_(grams)).\
+                group_by(SearchTrigram.Constituency).\
+                having(shared >= max(1, int(math.ceil(min_similarity*len(grams))))).\
+                order_by(shared.desc(), SearchTrigram.Constituency).limit(limit).all()
+    if not matches:
+        return []
+
+    details = dict((c, (name, party)) for c, name, party in
+                    session.query(MPCommons.Constituency, MPCommons.Name, MPCommons.Party).\
+                    filter(MPCommons.Constituency.in_([c for c, _ in matches])))
+    return [{'constituency':c, 'name':details[c][0], 'party':details[c][1],
+             'score':float(count)/len(grams)} for c, count in matches if c in details]
+
+def search(session, query, limit=10):
+    """ Ranked matches for query: FTS5 prefix matches (SQLite), or when there are
+    none, fuzzy trigram matches, which catch misspellings and serve other engines.
+    An exact query is answered by FTS alone, rather than padded with near misses. """
+    results = _fts_search(session, query, limit)
+    if not results:
+        results = _fuzzy_search(session, query, limit)
+    return results[:limit]
@@ -0,0 +1,101 @@
+#performance profiles for SQLite files: WAL, page cache and mmap sizes, read only replicas
+import os
+import sqlite3
+import urllib
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+###########################
+# page cache per connection, in KiB (a negative cache_size is KiB, not pages)
+cache_size_kb = 64*1024
+# bytes of the file read through mmap rather than read() calls
+mmap_size = 256*1024*1024
+# tries at emptying the WAL before a file is copied or renamed, each waiting up to
+# checkpoint_timeout seconds for readers to move off older snapshots
+checkpoint_attempts = 3
+checkpoint_timeout = 5.0
+###########################
+
+# PRAGMAs run on every new connection. journal_mode=WAL is stored in the file, so
+# readers need not (and read only ones cannot) set it.
+PROFILES = {
+    # building or refreshing: readers carry on during the writes, and commits don't fsync
+    'load':[('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+            ('cache_size', -cache_size_kb), ('temp_store', 'MEMORY')],
+    # serving from the live file, which a refresh may write to
+    'serve':[('synchronous', 'NORMAL'), ('cache_size', -cache_size_kb),
+             ('mmap_size', mmap_size)],
+    # serving read only from a file which a refresh may still write to
+    'read_only':[('query_only', 'ON'), ('cache_size', -cache_size_kb),
+                 ('mmap_size', mmap_size)],
+    # serving a replica copy which nothing writes to, so it needn't be locked
+    'replica':[('query_only', 'ON'), ('cache_size', -cache_size_kb),
+               ('mmap_size', mmap_size)],
+}
+
+
+class CheckpointError(Exception):
+    """ Raised when readers or writers keep the WAL from being folded back into the file """
+    def __init__(self, path, result):
+        Exception.__init__(self, 'Could not checkpoint %s: (busy, log, checkpointed) = %r' % (
+                                    path, result))
+        self.result = result
+
+
+def sqlite_path(db_url):
+    """ The file behind a SQLite url, or None for other databases and :memory: """
+    url = make_url(db_url)
+    if url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:'):
+        return url.database
+    return None
+
+def uri_filenames_supported():
+    # python 2's sqlite3 can't ask for URI filenames: the library must be built to accept them
+    options = sqlite3.connect(':memory:').execute('PRAGMA compile_options').fetchall()
+    return any(option.startswith('USE_URI') for (option,) in options)
+
+def read_only_uri(path, immutable=False):
+    """ file: URI opening path read only. immutable=1 also skips locking and the WAL,
+    so only use it for replica copies which are never written, in place or otherwise. """
+    uri = 'file:%s?mode=ro' % urllib.quote(os.path.abspath(path))
+    return uri + '&immutable=1' if immutable else uri
+
+def apply_profile(engine, profile):
+    pragmas = PROFILES[profile]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+        cursor.close()
+
+    return engine
+
+def tuned_engine(db_url, profile='serve', **kwargs):
+    """ create_engine, with the profile's PRAGMAs for SQLite files. The 'read_only'
+    and 'replica' profiles open the file through a read only URI, where sqlite
+    supports them; only 'replica' marks it immutable. """
+    path = sqlite_path(db_url)
+    if path is None:
+        return create_engine(db_url, echo=False, **kwargs)
+
+    if profile in ('read_only', 'replica') and uri_filenames_supported():
+        uri = read_only_uri(path, immutable=(profile == 'replica'))
+        kwargs['creator'] = lambda: sqlite3.connect(uri)
+    return apply_profile(create_engine(db_url, echo=False, **kwargs), profile)
+
+def checkpoint(engine):
+    """ Fold the WAL back into the database file, eg. before it is copied or renamed.
+    Tried checkpoint_attempts times, as a reader on an older snapshot holds part of
+    the WAL back; raises CheckpointError if it is still not all in the file. """
+    path = sqlite_path(str(engine.url))
+    if path is None:
+        return
+    for attempt in range(checkpoint_attempts):
+        # busy is 1 if the checkpoint couldn't finish; log is -1 outside WAL mode
+        busy, log, checkpointed = engine.execute('PRAGMA wal_checkpoint(TRUNCATE)').first()
+        if not busy and log == checkpointed:
+            return
+    raise CheckpointError(path, (busy, log, checkpointed))
@@ -0,0 +1,106 @@
+#build a SQLite database aside, check it, then promote it over the live one,
+#keeping the file it replaced for rollback
+import os
+
+from sqlalchemy import func
+
+from models import MPCommons
+import sqlite_profile
+
+###########################
+# seats in the House of Commons
+expected_constituencies = 650
+###########################
+
+
+class ValidationError(Exception):
+    """ Raised when a finished build fails its checks, and so is not promoted """
+    def __init__(self, problems):
+        Exception.__init__(self, 'Build failed validation: %s' % '; '.join(problems))
+        self.problems = problems
+
+
+def staging_path(path):
+    """ Where setup builds a SQLite file, next to the live one so it can be renamed over it """
+    return path + '.building'
+
+def previous_path(path):
+    """ The snapshot a promotion replaced, which rollback puts back """
+    return path + '.previous'
+
+def remove_sqlite_files(path):
+    for f in (path, path + '-wal', path + '-shm', path + '-journal'):
+        if os.path.isfile(f):
+            os.remove(f)
+
+def validate(session, constituencies=expected_constituencies):
+    """ Return a list of the problems with a build: the wrong number of constituencies,
+    no MPs, or an OfficialId on more than one seat. Empty if it is fit to promote. """
+    problems = []
+    count = session.query(func.count(MPCommons.Constituency)).scalar()
+    if constituencies is not None and count != constituencies:
+        problems.append('%d constituencies, expected %d' % (count, constituencies))
+
+    if not session.query(MPCommons).filter(MPCommons.MP==1).count():
+        problems.append('no MPs loaded')
+
+    duplicates = session.query(MPCommons.OfficialId).\
+                    filter(MPCommons.OfficialId != None).\
+                    group_by(MPCommons.OfficialId).\
+                    having(func.count(MPCommons.OfficialId) > 1).all()
+    if duplicates:
+        problems.append('duplicate OfficialIds %s' % ', '.join(str(o) for (o,) in duplicates))
+    return problems
+
+def _checkpoint_file(path):
+    # a live file's WAL must be empty before the file is replaced: it would be
+    # applied to whichever file next takes that name
+    engine = sqlite_profile.tuned_engine('sqlite:///' + path, 'load', 
+                        connect_args={'timeout':sqlite_profile.checkpoint_timeout})
+    try:
+        sqlite_profile.checkpoint(engine)
+    finally:
+        engine.dispose()
+
+def _swap(path, replacement, keep_as):
+    """ Atomically rename replacement over path, first hard linking the file at path
+    to keep_as. There is never a moment without a file at path. Raises CheckpointError,
+    having moved nothing, if the WAL of the file at path can't be emptied. """
+    live = os.path.isfile(path)
+    if live:
+        _checkpoint_file(path)
+    remove_sqlite_files(keep_as)
+    if live:
+        os.link(path, keep_as)
+    os.rename(replacement, path)
+
+def promote(build_engine, path):
+    """ Rename the finished build over the live SQLite file, keeping the old one. If
+    either WAL can't be emptied the build is removed and CheckpointError raised. """
+    try:
+        try:
+            sqlite_profile.checkpoint(build_engine)
+        finally:
+            build_engine.dispose()
+        _swap(path, staging_path(path), previous_path(path))
+    except sqlite_profile.CheckpointError:
+        remove_sqlite_files(staging_path(path))
+        raise
+
+def rollback(path):
+    """ Put the previous snapshot back live. The snapshot becomes the file it replaced,
+    so a second rollback undoes the first. Returns False if there is no snapshot. """
+    previous = previous_path(path)
+    if not os.path.isfile(previous):
+        return False
+
+    _checkpoint_file(previous)
+    swapping = path + '.rollback'
+    remove_sqlite_files(swapping)
+    os.rename(previous, swapping)
+    try:
+        _swap(path, swapping, previous)
+    except sqlite_profile.CheckpointError:
+        os.rename(swapping, previous)
+        raise
+    return True
@@ -0,0 +1,10 @@
+#text helpers shared by the loaders and the search index
+import re
+import unicodedata
+
+
+def normalise(text):
+    """ lower case, accents removed, punctuation to spaces: u'Ynys M\xf4n' -> u'ynys mon' """
+    text = unicodedata.normalize('NFKD', unicode(text or u''))
+    text = u''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return re.sub(r'[^\w]+', u' ', text, flags=re.UNICODE).strip()
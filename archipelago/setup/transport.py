@@ -0,0 +1,228 @@
+#shared HTTP transport used by all the setup fetchers (TWFY, MNIS, images)
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from http_cache import ResponseCache, CacheMiss
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Transport(object):
+    """ A pooled requests.Session with timeouts, exponential backoff retries and an
+    optional client side rate limit (requests per second). Keeps counters for
+    requests, retries, bytes and latency, so slow setups can be diagnosed.
+    If given a ResponseCache, non-streamed GETs are served from / stored in it. """
+
+    def __init__(self, pool_size=10, timeout=30, retries=3, backoff=0.5, rate_limit=None,
+                 cache=None):
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limit = rate_limit
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests':0, 'retries':0, 'errors':0, 'bytes':0, 'latency':0.0,
+                           'cache_hits':0, 'revalidated':0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mean_latency'] = stats['latency']/stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+    def summary(self):
+        return '%(requests)d requests, %(retries)d retries, %(errors)d errors, '\
+               '%(bytes)d bytes, %(mean_latency).3fs mean latency, '\
+               '%(cache_hits)d cache hits, %(revalidated)d revalidated' % self.stats()
+
+    def _count(self, **increments):
+        with self._lock:
+            for counter, value in increments.items():
+                self._stats[counter] += value
+
+    def _wait_for_slot(self):
+        if not self.rate_limit:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + 1.0/self.rate_limit
+        if wait > 0:
+            time.sleep(wait)
+
+    def get(self, url, cache=True, **kwargs):
+        """ GET a url through the cache (if there is one). Pass cache=False to bypass it. """
+        if self.cache is None or not cache or kwargs.get('stream'):
+            return self._fetch(url, **kwargs)
+
+        cached = self.cache.lookup(url)
+        if cached is not None and self.cache.is_fresh(cached[0]):
+            self._count(cache_hits=1)
+            return self._cached_response(url, *cached)
+        if self.cache.offline:
+            raise CacheMiss(url)
+
+        if cached is not None:
+            headers = dict(kwargs.pop('headers', None) or {})
+            if 'etag' in cached[0]['headers']:
+                headers['If-None-Match'] = cached[0]['headers']['etag']
+            if 'last-modified' in cached[0]['headers']:
+                headers['If-Modified-Since'] = cached[0]['headers']['last-modified']
+            kwargs['headers'] = headers
+
+        try:
+            response = self._fetch(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if cached is None:
+                raise
+            # a stale copy beats no copy
+            self._count(cache_hits=1)
+            return self._cached_response(url, *cached)
+
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(url, cached[0])
+            self._count(revalidated=1)
+            return self._cached_response(url, *cached)
+        if response.status_code == 200:
+            self.cache.store(url, response)
+        return response
+
+    def _cached_response(self, url, meta, body):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response._content = body
+        response.from_cache = True
+        return response
+
+    def open_stream(self, url, cache=True, **kwargs):
+        """ GET a url as a file-like object, to be read incrementally (eg. by iterparse) 
+        without holding the whole body in memory. Fresh cache entries are read from disk,
+        other bodies are written to the cache as they stream past. Raises HTTPError
+        for error responses. """
+        use_cache = self.cache is not None and cache
+        if use_cache:
+            cached = self.cache.open(url)
+            if cached is not None:
+                if self.cache.is_fresh(cached[0]):
+                    self._count(cache_hits=1)
+                    return cached[1]
+                cached[1].close()
+            if self.cache.offline:
+                raise CacheMiss(url)
+
+        response = self._fetch(url, stream=True, **kwargs)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        sink = self.cache.writer(url, response.headers) if use_cache else None
+        return StreamReader(self, response, sink)
+
+    def _fetch(self, url, **kwargs):
+        """ GET a url, retrying connection errors, timeouts and 429/5xx responses.
+        The last response is returned once retries are exhausted, as requests.get would. """
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count(retries=1)
+                time.sleep(self.backoff * 2**(attempt-1))
+
+            self._wait_for_slot()
+            start = time.time()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._count(requests=1, errors=1, latency=time.time()-start)
+                if attempt == self.retries:
+                    raise
+                continue
+
+            received = 0 if kwargs.get('stream') else len(response.content)
+            self._count(requests=1, bytes=received, latency=time.time()-start)
+
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            self._count(errors=1)
+
+        return response
+
+
+class StreamReader(object):
+    """ File-like view of a streamed response, counting bytes as they are read and
+    copying them to a CacheWriter, which is committed once the body is complete. """
+
+    def __init__(self, transport, response, sink=None):
+        self.transport = transport
+        self.response = response
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.response.raw.read(size) if size >= 0 else self.response.raw.read()
+        self.transport._count(bytes=len(data))
+        if self.sink is not None:
+            if data:
+                self.sink.write(data)
+            else:
+                self.sink.commit()
+                self.sink = None
+        return data
+
+    def close(self):
+        if self.sink is not None:
+            # never cache half a body
+            self.sink.abort()
+            self.sink = None
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def configure(**kwargs):
+    """ Replace the shared transport, eg. configure(pool_size=20, rate_limit=10) """
+    global _transport
+    with _transport_lock:
+        _transport = Transport(**kwargs)
+    return _transport
+
+def get_transport():
+    """ The shared transport. Setting ARCHIPELAGO_HTTP_CACHE to a directory turns on the
+    response cache, and ARCHIPELAGO_OFFLINE=1 serves every request from it. """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            cache = None
+            if os.getenv('ARCHIPELAGO_HTTP_CACHE'):
+                cache = ResponseCache(os.getenv('ARCHIPELAGO_HTTP_CACHE'),
+                                      offline=os.getenv('ARCHIPELAGO_OFFLINE') == '1')
+            _transport = Transport(cache=cache)
+    return _transport
+
+def get(url, **kwargs):
+    return get_transport().get(url, **kwargs)
+
+def open_stream(url, **kwargs):
+    return get_transport().open_stream(url, **kwargs)
@@ -0,0 +1,423 @@
+from archipelago import archipelago, lookups
+from archipelago.setup import main_setup, parl_init_TWFY, parl_init_GOV, transport
+from archipelago.setup import bulk, search_index, history, generation
+from archipelago.setup.models import MPCommons, Office
+from archipelago.graph import office_pairs
+
+from sqlalchemy import select, func, and_
+from sqlalchemy.orm import sessionmaker
+import requests
+from requests.adapters import BaseAdapter
+from urllib import unquote
+
+import io
+import random
+import datetime
+import os
+import sys
+import time
+import tempfile
+
+
+# ---------------------------  ARCHIPELAGO BENCHMARKS ---------------------------
+#
+# Offline benchmarks over synthetic data the size of the Commons. Not collected
+# by the test runner: run with
+#
+#     python -m archipelago.tests.benchmark_archipelago [name ...]
+#
+# ==============================================================================
+
+N_MPS = 650
+
+
+def synthetic_mps(n=N_MPS):
+    return [{'name':'MP %03d' % i, 'party':['Labour', 'Conservative', 'SNP'][i % 3],
+             'member_id':40000 + i, 'person_id':10000 + i,
+             'constituency':u'Constituency %03d' % i} for i in range(n)]
+
+def synthetic_offices(n=N_MPS):
+    return [{'person_id':10000 + i, 'department':'Committee %d' % (i % 40),
+             'start_date':'2015-07-13', 'end_date':'9999-12-31',
+             'name':'MP %03d' % i, 'title':'Member'} for i in range(n)]
+
+def fresh_database():
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    engine = main_setup.create_database('sqlite:///' + path)
+    session = sessionmaker(bind=engine)()
+    session.add_all([MPCommons(Constituency=mp['constituency']) for mp in synthetic_mps()])
+    session.commit()
+    return path, session
+
+def commons_database():
+    '''A temporary db holding a full synthetic Commons: 650 MPs, offices and twitter addresses'''
+    path, session = fresh_database()
+    parl_init_TWFY.update_mps(synthetic_mps(), session)
+    bulk.bulk_update(session, MPCommons, 'Constituency', 
+        [{'Constituency':mp['constituency'], 'OfficialId':1000 + i} 
+            for i, mp in enumerate(synthetic_mps())])
+    bulk.bulk_upsert(session, Office, 
+        [parl_init_TWFY.office_columns(o) for o in synthetic_offices()])
+    bulk.bulk_upsert(session, archipelago.Address, 
+        [{'OfficialId':1000 + i, 'AddressType':'twitter', 
+          'Address':'https://twitter.com/mp%03d' % i} for i in range(N_MPS)])
+    session.commit()
+    session.close()
+    return path
+
+def per_call(label, fn, repeat=20, records=N_MPS):
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.time() - start)/repeat
+    print '%-40s %8.2fms/call %8.2fus/record' % (label, elapsed*1e3, elapsed*1e6/records)
+    return elapsed
+
+def timed(label, rows, fn):
+    path, session = fresh_database()
+    try:
+        start = time.time()
+        fn(session)
+        session.commit()
+        elapsed = time.time() - start
+    finally:
+        session.close()
+        os.remove(path)
+    print '%-40s %6d rows %8.3fs %10.0f rows/s' % (label, rows, elapsed, rows/elapsed)
+    return elapsed
+
+
+def per_row_loader(session):
+    # the loader as it was: one query().update() / session.add per row
+    for mp in synthetic_mps():
+        session.query(MPCommons).filter(MPCommons.Constituency==mp['constituency']).\
+            update({
+                MPCommons.Name:mp['name'],
+                MPCommons.Party:mp['party'],
+                MPCommons.MP:1,
+                MPCommons.MemberId:mp['member_id'],
+                MPCommons.PersonId:mp['person_id']
+            })
+    session.add_all([Office(**parl_init_TWFY.office_columns(o)) for o in synthetic_offices()])
+
+def bulk_loader(session):
+    parl_init_TWFY.update_mps(synthetic_mps(), session)
+    bulk.bulk_upsert(session, Office,
+        [parl_init_TWFY.office_columns(o) for o in synthetic_offices()])
+
+def bench_bulk_load():
+    '''MPCommons updates + Offices inserts: per row ORM loader against batched loader'''
+    rows = N_MPS*2
+    slow = timed('per row query().update()', rows, per_row_loader)
+    fast = timed('bulk executemany / upsert', rows, bulk_loader)
+    print '%-40s %.1fx' % ('speedup', slow/fast)
+
+
+def bench_records():
+    '''get_all_mps for the full Commons: ORM hydration against records and dicts'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+
+        def orm():
+            arch.session.expunge_all()
+            return arch.get_all_mps()
+
+        slow = per_call('ORM MPCommons objects', orm)
+        fast = per_call('as_records=True (namedtuples)', lambda: arch.get_all_mps(as_records=True))
+        per_call("as_records='dict'", lambda: arch.get_all_mps(as_records='dict'))
+        print '%-40s %.1fx' % ('speedup (records)', slow/fast)
+    finally:
+        os.remove(path)
+
+
+def bench_search():
+    '''Archipelago.search over the full Commons: FTS5 prefix queries and fuzzy fallback'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        search_index.build_search_index(arch.session)
+        arch.session.commit()
+
+        exact = per_call("search('constituency 123') (exact)", 
+                         lambda: arch.search('constituency 123'), repeat=1000, records=1)
+        per_call("search('constituency 12')", lambda: arch.search('constituency 12'), 
+                 repeat=1000, records=1)
+        per_call("search('committee 7', limit=5)", lambda: arch.search('committee 7', limit=5), 
+                 repeat=1000, records=1)
+        fuzzy = per_call("search('constitunecy') (fuzzy)", lambda: arch.search('constitunecy'), 
+                         repeat=100, records=1)
+        # an exact hit is answered by FTS alone, without a trigram scan to pad it out
+        assert [r['constituency'] for r in arch.search('constituency 123')] == [u'Constituency 123']
+        assert exact < fuzzy / 10, (exact, fuzzy)
+    finally:
+        os.remove(path)
+
+
+def member_xml(i, mp):
+    return ('<Member Member_Id="%d"><DisplayAs>%s</DisplayAs><MemberFrom>%s</MemberFrom>'
+            '<Party>%s</Party><Addresses><Address Type_Id="7"><Address1>'
+            'https://twitter.com/mp%03d</Address1></Address></Addresses></Member>' % (
+                1000 + i, mp['name'], mp['constituency'], mp['party'], i))
+
+def recorded_mnis():
+    '''MNIS responses for the synthetic Commons, by request: one per seat and the bulk query'''
+    members = [member_xml(i, mp) for i, mp in enumerate(synthetic_mps())]
+    fixtures = dict(('constituency=%s/' % mp['constituency'], '<Members>%s</Members>' % m)
+                        for mp, m in zip(synthetic_mps(), members))
+    fixtures[parl_init_GOV.bulk_request] = '<Members>%s</Members>' % ''.join(members)
+    return fixtures
+
+class RecordedAdapter(BaseAdapter):
+    '''Serves recorded MNIS responses after a fixed round trip time'''
+    def __init__(self, fixtures, latency):
+        super(RecordedAdapter, self).__init__()
+        self.fixtures = fixtures
+        self.latency = latency
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        query = unquote(request.url[len(parl_init_GOV.site + 'members/query/'):])
+        body = self.fixtures[query[:query.rindex('/', 0, -1) + 1]]
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(body.encode('utf-8'))
+        response.raw.release_conn = lambda: None
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+def bench_gov_setup(latency=0.05):
+    '''GOV_setup over recorded MNIS responses, 50ms a round trip: per seat against bulk'''
+    fixtures = recorded_mnis()
+    real_transport = transport._transport
+
+    def loader(mode, workers):
+        def load(session):
+            transport.configure(backoff=0).session.mount('http://', 
+                                                  RecordedAdapter(fixtures, latency))
+            parl_init_GOV.GOV_setup(lambda: session, workers=workers, mode=mode)
+        return load
+
+    try:
+        serial = timed('per_constituency, 1 worker', N_MPS, loader('per_constituency', 1))
+        pooled = timed('per_constituency, %d workers' % parl_init_GOV.default_workers, N_MPS,
+                       loader('per_constituency', parl_init_GOV.default_workers))
+        single = timed('bulk, one streamed request', N_MPS, loader('bulk', 1))
+    finally:
+        transport._transport = real_transport
+    print '%-40s %.1fx' % ('speedup against 1 worker', serial/single)
+    print '%-40s %.1fx' % ('speedup against %d workers' % parl_init_GOV.default_workers, 
+                           pooled/single)
+
+
+def bench_columnar():
+    '''Loading the Commons for analysis: ORM get_all_mps against a memory mapped snapshot'''
+    from archipelago import columnar
+    import shutil
+
+    path = commons_database()
+    snapshot = tempfile.mkdtemp()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        arch.export_columns(snapshot)
+
+        def orm():
+            arch.session.expunge_all()
+            return [(mp.Name, mp.Party, mp.OfficialId) for mp in arch.get_all_mps()]
+
+        def columns():
+            mps = columnar.load_columns(snapshot)['MPCommons']
+            return mps['Name'], mps['Party'].codes, mps['OfficialId']
+
+        slow = per_call('ORM get_all_mps', orm)
+        fast = per_call('load_columns (mmap)', columns)
+        per_call('load_columns + records()', 
+                 lambda: columnar.load_columns(snapshot)['MPCommons'].records())
+        print '%-40s %.1fx' % ('speedup (columns)', slow/fast)
+    finally:
+        os.remove(path)
+        shutil.rmtree(snapshot)
+
+
+def bench_frozen():
+    '''Single MP lookups by OfficialId: SQL against a FrozenArchipelago'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        frozen = arch.freeze()
+
+        slow = per_call('get_mps_by_official_id (SQL)', 
+                        lambda: arch.get_mps_by_official_id([1300]), repeat=1000, records=1)
+        fast = per_call('frozen.get_mp_by_official_id', 
+                        lambda: frozen.get_mp_by_official_id(1300), repeat=100000, records=1)
+        per_call('arch.freeze()', arch.freeze, repeat=10)
+        print '%-40s %.0fx' % ('speedup (lookup)', slow/fast)
+    finally:
+        os.remove(path)
+
+
+def bench_history(rounds=80):
+    '''Point in time queries: the Commons with every seat changing hands each half year'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        session = arch.session
+        start_day = datetime.date(1976, 1, 1)
+        timings = []
+        for r in range(rounds):
+            bulk.bulk_update(session, MPCommons, 'Constituency',
+                [{'Constituency':mp['constituency'], 'PersonId':100000*(r+1) + i} 
+                    for i, mp in enumerate(synthetic_mps())])
+            start = time.time()
+            history.record_history(session, start_day + datetime.timedelta(days=182*r))
+            session.commit()
+            timings.append(time.time() - start)
+        rows = len(arch.get_memberships())
+        print '%-40s %6d rows, %.1fms first, %.1fms last' % ('record_history per round', 
+                                rows, timings[0]*1e3, timings[-1]*1e3)
+
+        day = start_day + datetime.timedelta(days=182*rounds/2 + 30)
+        per_call('as_of().get_mp_by_constituency', lambda: arch.as_of(day).\
+                    get_mp_by_constituency(u'Constituency 300'), repeat=1000, records=1)
+        per_call('as_of().get_all_mps', lambda: arch.as_of(day).get_all_mps(), repeat=20)
+        per_call('get_memberships(constituency)', lambda: arch.get_memberships(
+                    constituency=u'Constituency 300'), repeat=1000, records=rounds)
+        arch.close()
+    finally:
+        os.remove(path)
+
+
+def bench_graph():
+    '''Committee network queries over the Commons, 3 committees an MP: SQL self join against OfficeGraph'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        session = arch.session
+        extra = [dict(o, department='Committee %d' % ((i + shift) % 40)) 
+                    for i, o in enumerate(synthetic_offices()) for shift in (13, 27)]
+        bulk.bulk_upsert(session, Office, [parl_init_TWFY.office_columns(o) for o in extra])
+        session.commit()
+
+        a, b = archipelago.Office.__table__.alias(), archipelago.Office.__table__.alias()
+        self_join = select([b.c.PersonId, func.count()]).\
+                        select_from(a.join(b, a.c.Office==b.c.Office)).\
+                        where(and_(a.c.PersonId==10300, b.c.PersonId!=10300,
+                                   a.c.IsCurrent==True, b.c.IsCurrent==True)).\
+                        group_by(b.c.PersonId)
+        slow = per_call('neighbours (SQL self join)', 
+                        lambda: session.execute(self_join).fetchall(), repeat=200, records=1)
+        graph = arch.office_graph()
+        fast = per_call('graph.neighbours', lambda: graph.neighbours(10300), 
+                        repeat=200, records=1)
+        print '%-40s %.0fx' % ('speedup (neighbours)', slow/fast)
+
+        per_call('graph.shortest_path', lambda: graph.shortest_path(10000, 10649), 
+                 repeat=200, records=1)
+        per_call('graph.party_co_membership', graph.party_co_membership, repeat=20, records=1)
+        per_call('OfficeGraph.from_connectable', 
+                 lambda: archipelago.OfficeGraph.from_connectable(arch._engine), repeat=20)
+
+        pairs = set(office_pairs(arch._engine))
+        changed = (pairs - set([(10000, 'Committee 0')])) | set([(10000, 'Committee 1')])
+        per_call('graph.updated (one office moved)', 
+                 lambda: graph.updated(changed, graph.people), repeat=20)
+        arch.close()
+    finally:
+        os.remove(path)
+
+
+def bench_lookups(n=100000):
+    '''Batch lookups of 10^5 OfficialIds (a tweet stream's worth): hits, misses and columns'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        random.seed(0)
+        # 650 distinct ids, repeated: the chunked IN (...) path
+        repeated = [random.randrange(1000, 1000 + N_MPS) for _ in range(n)]
+        # mostly distinct, mostly misses: the single scan path
+        distinct = [random.randrange(0, 10*n) for _ in range(n)]
+
+        def keys_per_second(label, fn, keys, repeat=5):
+            start = time.time()
+            for _ in range(repeat):
+                fn()
+            elapsed = (time.time() - start)/repeat
+            print '%-40s %8.2fms/call %10.0f keys/s' % (label, elapsed*1e3, len(keys)/elapsed)
+
+        keys_per_second('lookup_mps (650 distinct)', lambda: arch.lookup_mps(repeated), repeated)
+        keys_per_second('lookup_mps (10^5 distinct, scan)', 
+                        lambda: arch.lookup_mps(distinct), distinct)
+        threshold = lookups.lookup_scan_threshold
+        lookups.lookup_scan_threshold = 10*n
+        keys_per_second('lookup_mps (10^5 distinct, chunked)', 
+                        lambda: arch.lookup_mps(distinct), distinct)
+        lookups.lookup_scan_threshold = threshold
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            keys_per_second('lookup_mps(as_columns=True)', 
+                            lambda: arch.lookup_mps(repeated, as_columns=True), repeated)
+        arch.close()
+    finally:
+        os.remove(path)
+
+
+def bench_resolver(n=1000000):
+    '''Resolving tweets' screen names to MPs: get_twitter_users per batch against TwitterResolver'''
+    path = commons_database()
+    try:
+        arch = archipelago.Archipelago('sqlite:///' + path)
+        session = arch.session
+        bulk.bulk_update(session, MPCommons, 'OfficialId', 
+            [{'OfficialId':1000 + i, 'TwitterHandle':'mp%03d' % i} for i in range(N_MPS)])
+        generation.bump_generation(session)
+        session.commit()
+
+        random.seed(0)
+        names = [random.choice(['mp%03d', 'MP%03d', '@Mp%03d', 'nobody%d']) % random.randrange(N_MPS)
+                    for _ in range(n)]
+
+        def url_slices():
+            # the way Twirps matched before: twitter_url[20:] against the screen name
+            users = dict((u['twitter_url'][20:], u) for u in arch.get_twitter_users())
+            return [users.get(name) for name in names[:10000]]
+        per_call('get_twitter_users + url slices (10^4)', url_slices, repeat=5, records=10000)
+
+        resolver = arch.twitter_resolver()
+        start = time.time()
+        resolver.resolve_many(names)
+        elapsed = time.time() - start
+        print '%-40s %8.2fs %10.0f lookups/s (%.0fM/minute)' % ('resolver.resolve_many (10^6)', 
+                    elapsed, n/elapsed, n/elapsed*60/1e6)
+        per_call('resolver.reload', resolver.reload, repeat=20)
+        arch.close()
+    finally:
+        os.remove(path)
+
+
+BENCHMARKS = [
+    ('bulk_load', bench_bulk_load),
+    ('records', bench_records),
+    ('search', bench_search),
+    ('gov_setup', bench_gov_setup),
+    ('columnar', bench_columnar),
+    ('frozen', bench_frozen),
+    ('history', bench_history),
+    ('graph', bench_graph),
+    ('lookups', bench_lookups),
+    ('resolver', bench_resolver),
+]
+
+if __name__ == '__main__':
+    wanted = sys.argv[1:]
+    for name, bench in BENCHMARKS:
+        if not wanted or name in wanted:
+            print '== %s: %s' % (name, bench.__doc__)
+            bench()
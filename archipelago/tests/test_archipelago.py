@@ -1,14 +1,29 @@
-from archipelago import archipelago
-from archipelago.setup import main_setup, parl_init_TWFY, parl_init_GOV
+from archipelago import archipelago, query_cache, async_archipelago, columnar, frozen, records
+from archipelago.setup import main_setup, parl_init_TWFY, parl_init_GOV, transport, http_cache
+from archipelago.setup import refresh, bulk, images, generation, migrations, search_index
+from archipelago.setup import pipeline, staging, history, sqlite_profile
 
-from sqlalchemy import create_engine 
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker  
+import requests
+from requests.adapters import BaseAdapter
 
 import unittest
 import sqlite3
 import json
+import io
 from lxml import etree
 import os
+import shutil
+import tempfile
+import hashlib
+import threading
+import datetime
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # -----------------------------  ARCHIPELAGO TESTS -----------------------------
@@ -167,6 +182,131 @@ class TestFetchDataMethods(unittest.TestCase):
         self.assertEqual(test_reference, returned_string)
 
 
+class ReplayRaw(object):
+    '''Stands in for the urllib3 response, so replies can be streamed too'''
+    def __init__(self, body=''):
+        self.body = io.BytesIO(body)
+        self.decode_content = False
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+    def release_conn(self):
+        pass
+
+
+class ReplayAdapter(BaseAdapter):
+    '''A requests adapter which replays (status, body[, headers]) instead of hitting the network'''
+    def __init__(self, replies):
+        super(ReplayAdapter, self).__init__()
+        self.replies = list(replies)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        reply = self.replies.pop(0)
+        response = requests.Response()
+        response.status_code = reply[0]
+        response._content = reply[1]
+        response._content_consumed = True
+        response.raw = ReplayRaw(reply[1])
+        if len(reply) > 2:
+            response.headers.update(reply[2])
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class TestTransportMethods(unittest.TestCase):
+    def test_transport_retries_transient_errors(self):
+        '''FETCH:: Test the transport retries 5xx responses with backoff and counts them'''
+        shared = transport.Transport(retries=2, backoff=0)
+        adapter = ReplayAdapter([(503, 'busy'), (502, 'busy'), (200, '{"ok": 1}')])
+        shared.session.mount('http://', adapter)
+
+        response = shared.get('http://example.com/api')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '{"ok": 1}')
+        stats = shared.stats()
+        self.assertEqual((stats['requests'], stats['retries'], stats['errors']), (3, 2, 2))
+        self.assertEqual(stats['bytes'], len('busy')*2 + len('{"ok": 1}'))
+
+    def test_transport_gives_up_after_retries(self):
+        '''FETCH:: Test the transport returns the last response once retries are exhausted'''
+        shared = transport.Transport(retries=1, backoff=0)
+        shared.session.mount('http://', ReplayAdapter([(500, ''), (500, 'still down')]))
+
+        response = shared.get('http://example.com/api')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(shared.stats()['retries'], 1)
+
+
+class TestResponseCacheMethods(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.real_transport = transport._transport
+
+    def tearDown(self):
+        transport._transport = self.real_transport
+        shutil.rmtree(self.cache_dir)
+
+    def recorded_response(self, body, **headers):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response.headers.update(headers)
+        return response
+
+    def test_cache_revalidates_stale_entries(self):
+        '''FETCH:: Test stale cache entries are revalidated with a conditional GET'''
+        cache = http_cache.ResponseCache(self.cache_dir, ttl=0)
+        cache.store('http://example.com/api?key=abc', 
+                    self.recorded_response('cached body', etag='"v1"'))
+        adapter = ReplayAdapter([(304, '')])
+        shared = transport.Transport(cache=cache)
+        shared.session.mount('http://', adapter)
+
+        response = shared.get('http://example.com/api?key=xyz')
+
+        self.assertEqual(adapter.sent[0].headers['If-None-Match'], '"v1"')
+        self.assertEqual(response.content, 'cached body')
+        self.assertEqual(shared.stats()['revalidated'], 1)
+
+    def test_fetch_data_replays_from_offline_cache(self):
+        '''FETCH:: Test fetch_data_online replays a recorded response when offline, 
+        whatever TWFY key recorded it'''
+        cache = http_cache.ResponseCache(self.cache_dir, offline=True)
+        cache.store(parl_init_TWFY.site + parl_init_TWFY.base_template % (
+                        'getConstituencies', 'recording-key', 'json'),
+                    self.recorded_response('[{"name": "Aberavon"}]', 
+                        **{'content-type':'application/json; charset=utf-8'}))
+        transport.configure(cache=cache)
+
+        request_data = parl_init_TWFY.fetch_data_online('getConstituencies')
+
+        self.assertEqual(request_data, [{"name":"Aberavon"}])
+        self.assertRaises(http_cache.CacheMiss, parl_init_TWFY.fetch_data_online, 'getMPs')
+
+    def test_cache_evicts_least_recently_used(self):
+        '''FETCH:: Test the cache evicts the least recently used entries past max_bytes'''
+        cache = http_cache.ResponseCache(self.cache_dir, max_bytes=10)
+        cache.store('http://example.com/a', self.recorded_response('aaaa'))
+        cache.store('http://example.com/b', self.recorded_response('bbbb'))
+        for f in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, f), (0, 0))
+        cache.lookup('http://example.com/a')
+        cache.store('http://example.com/c', self.recorded_response('cccc'))
+
+        self.assertNotEqual(cache.lookup('http://example.com/a'), None)
+        self.assertEqual(cache.lookup('http://example.com/b'), None)
+        self.assertNotEqual(cache.lookup('http://example.com/c'), None)
+
+
 class TestBuildDataMethods(unittest.TestCase):
     def test_build_mp_and_office_list(self):
         '''BUILD:: Test the MPandOffice tuple list is build correctly, 
@@ -336,9 +476,52 @@ class TestBuildDataMethods(unittest.TestCase):
 
         self.assertEqual(processed_data, test_reference)
 
+    def test_match_members(self):
+        '''BUILD:: Test bulk MNIS members are joined to TWFY constituency names despite spelling'''
+        self.assertEqual(parl_init_GOV.constituency_key(u"Ynys M\xf4n"), u"ynys mon")
+        self.assertEqual(parl_init_GOV.constituency_key(u"Brighton, Kemptown"), 
+                         parl_init_GOV.constituency_key(u"Brighton Kemptown"))
+
+        members = [parl_init_GOV.build_mp_addresses_from_member(
+                        member_addresses_xml(i, c)[0]) for i, c in 
+                    [(1, u"Ynys Mon"), (2, u"Ashton-under-Lyne"), (3, u"Elsewhere")]]
+        matched = parl_init_GOV.match_members(
+            [u"Ynys M\xf4n", u"Ashton under Lyne", u"Vacant Seat"], members)
+        self.assertEqual(dict((c, m["official_ID"]) for c, m in matched.items()),
+                         {u"Ynys M\xf4n":"1", u"Ashton under Lyne":"2"})
+
+    def test_build_member_without_addresses(self):
+        '''BUILD:: Test a member with no Addresses element builds with no addresses'''
+        member_xml = etree.fromstring(
+            '<Member Member_Id="8"><DisplayAs>A Minister</DisplayAs><MemberFrom>Somewhere'
+            '</MemberFrom></Member>')
+        self.assertEqual(parl_init_GOV.build_mp_addresses_from_member(member_xml)["addresses"], {})
+
+    def test_handle_from_twitter_url(self):
+        '''BUILD:: Test twitter handles are parsed out of the url variants MNIS returns'''
+        for url in ["https://twitter.com/mark4ceredigion", "http://twitter.com/mark4ceredigion",
+                    "https://www.twitter.com/mark4ceredigion/", "twitter.com/mark4ceredigion",
+                    "http://twitter.com/#!/mark4ceredigion", " @mark4ceredigion",
+                    "https://twitter.com/mark4ceredigion?lang=en"]:
+            self.assertEqual(parl_init_GOV.handle_from_twitter_url(url), "mark4ceredigion")
 
 
 
+
+def member_addresses_xml(official_id, constituency, website=None, twitter=None):
+    '''Build a minimal MNIS Members/Addresses document, for tests that run offline'''
+    addresses = ''
+    if website:
+        addresses += '<Address Type_Id="6"><Address1>%s</Address1></Address>' % website
+    if twitter:
+        addresses += '<Address Type_Id="7"><Address1>%s</Address1></Address>' % twitter
+
+    return etree.fromstring(
+        '<Members><Member Member_Id="%s"><DisplayAs>MP for %s</DisplayAs>'
+        '<MemberFrom>%s</MemberFrom><Addresses>%s</Addresses></Member></Members>' % (
+            official_id, constituency, constituency, addresses))
+
+
 class TestLoadDataMethods(unittest.TestCase):
     def setUp(self):
         self.test_db = "test.db"
@@ -363,17 +546,17 @@ class TestLoadDataMethods(unittest.TestCase):
             loaded_constituencies = cur.fetchall()
 
             test_reference = [
-                (None, u'Worsley and Eccles South', 0, None, None, None, None, None),
-                (None, u'Worthing West', 0, None, None, None, None, None),
-                (None, u'Wrexham', 0, None, None, None, None, None),
-                (None, u'Wycombe', 0, None, None, None, None, None),
-                (None, u'Wyre and Preston North', 0, None, None, None, None, None), 
-                (None, u'Wyre Forest', 0, None, None, None, None, None),
-                (None, u'Wythenshawe and Sale East', 0, None, None, None, None, None),
-                (None, u'Yeovil', 0, None, None, None, None, None),
-                (None, u'Ynys M\xf4n', 0, None, None, None, None, None),
-                (None, u'York Central', 0, None, None, None, None, None), 
-                (None, u'York Outer', 0, None, None, None, None, None)
+                (None, u'Worsley and Eccles South', 0, None, None, None, None, None, None),
+                (None, u'Worthing West', 0, None, None, None, None, None, None),
+                (None, u'Wrexham', 0, None, None, None, None, None, None),
+                (None, u'Wycombe', 0, None, None, None, None, None, None),
+                (None, u'Wyre and Preston North', 0, None, None, None, None, None, None), 
+                (None, u'Wyre Forest', 0, None, None, None, None, None, None),
+                (None, u'Wythenshawe and Sale East', 0, None, None, None, None, None, None),
+                (None, u'Yeovil', 0, None, None, None, None, None, None),
+                (None, u'Ynys M\xf4n', 0, None, None, None, None, None, None),
+                (None, u'York Central', 0, None, None, None, None, None, None), 
+                (None, u'York Outer', 0, None, None, None, None, None, None)
             ]
             
             self.assertEqual( loaded_constituencies[-11:], test_reference)
@@ -394,11 +577,11 @@ class TestLoadDataMethods(unittest.TestCase):
 
             loaded_mps = cur.fetchall()
             mp_test_reference = [
-                (u'Mike Kane', u'Wythenshawe and Sale East', 1, u'Labour', None, 40912, 25220, None), 
-                (u'Marcus Fysh', u'Yeovil', 1, u'Conservative', None, 41102, 25384, None), 
-                (u'Albert Owen', u'Ynys M\xf4n', 1, u'Labour', None, 40873, 11148, None), 
-                (u'Rachael Maskell', u'York Central', 1, u'Labour/Co-operative', None, 41325, 25433, None), 
-                (u'Julian Sturdy', u'York Outer', 1, u'Conservative', None, 41326, 24853, None)
+                (u'Mike Kane', u'Wythenshawe and Sale East', 1, u'Labour', None, 40912, 25220, None, None), 
+                (u'Marcus Fysh', u'Yeovil', 1, u'Conservative', None, 41102, 25384, None, None), 
+                (u'Albert Owen', u'Ynys M\xf4n', 1, u'Labour', None, 40873, 11148, None, None), 
+                (u'Rachael Maskell', u'York Central', 1, u'Labour/Co-operative', None, 41325, 25433, None, None), 
+                (u'Julian Sturdy', u'York Outer', 1, u'Conservative', None, 41326, 24853, None, None)
             ]
             
             # Test MPs general data has loaded
@@ -408,10 +591,10 @@ class TestLoadDataMethods(unittest.TestCase):
             loaded_offices = cur.fetchall()
 
             offices_test_reference = [
-                (10040, u"Speaker's Committee for the Independent Parliamentary Standards Authority", u'2015-05-18', u'9999-12-31', u'John Bercow', u'Chair'), 
-                (10040, u"Speaker's Committee on the Electoral Commission", u'2015-03-30', u'9999-12-31', u'John Bercow', u'Member'), 
-                (10040, u'', u'2009-06-22', u'9999-12-31', u'John Bercow', u'Speaker of the House of Commons'), 
-                (10040, u'House of Commons Commission', u'2009-06-22', u'9999-12-31', u'John Bercow', u'Member')
+                (10040, u"Speaker's Committee for the Independent Parliamentary Standards Authority", u'2015-05-18', u'9999-12-31', u'John Bercow', u'Chair', 1), 
+                (10040, u"Speaker's Committee on the Electoral Commission", u'2015-03-30', u'9999-12-31', u'John Bercow', u'Member', 1), 
+                (10040, u'', u'2009-06-22', u'9999-12-31', u'John Bercow', u'Speaker of the House of Commons', 1), 
+                (10040, u'House of Commons Commission', u'2009-06-22', u'9999-12-31', u'John Bercow', u'Member', 1)
             ]
             
             self.maxDiff = None
@@ -448,6 +631,1591 @@ class TestLoadDataMethods(unittest.TestCase):
 
         pass
 
+    def test_gov_setup_concurrent_fetch(self):
+        '''LOAD:: Test GOV_setup with a worker pool writes the same rows as a serial run'''
+        session = self.session_factory()
+        session.add_all([parl_init_GOV.MPCommons(Constituency=c) 
+                            for c in [u"Ceredigion", u"Vacant Seat", u"York Central"]])
+        session.commit()
+
+        fixtures = {
+            u"Ceredigion":member_addresses_xml(1498, u"Ceredigion", 
+                            website="http://www.markwilliams.org.uk/",
+                            twitter="https://twitter.com/mark4ceredigion"),
+            u"Vacant Seat":etree.fromstring('<Members/>'),
+            u"York Central":member_addresses_xml(4471, u"York Central", 
+                            twitter="https://twitter.com/rachaelmaskell")
+        }
+        def fake_fetch_xml_online(request, api='members/query/', output=''):
+            return fixtures[request[len('constituency='):-1]]
+
+        real_fetch_xml_online = parl_init_GOV.fetch_xml_online
+        parl_init_GOV.fetch_xml_online = fake_fetch_xml_online
+        try:
+            parl_init_GOV.GOV_setup(self.session_factory, workers=3, mode='per_constituency')
+        finally:
+            parl_init_GOV.fetch_xml_online = real_fetch_xml_online
+
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT Constituency, OfficialId, TwitterHandle FROM MPCommons \
+                            ORDER BY Constituency")
+            self.assertEqual(cur.fetchall(), [(u"Ceredigion", 1498, u"mark4ceredigion"), 
+                                              (u"Vacant Seat", None, None), 
+                                              (u"York Central", 4471, u"rachaelmaskell")])
+
+            cur.execute("SELECT * FROM Addresses ORDER BY OfficialID, AddressType ASC")
+            self.assertEqual(cur.fetchall(), [
+                (1498, u"twitter", u"https://twitter.com/mark4ceredigion"),
+                (1498, u"website", u"http://www.markwilliams.org.uk/"),
+                (4471, u"twitter", u"https://twitter.com/rachaelmaskell")
+            ])
+
+    def test_gov_setup_bulk_streams_members(self):
+        '''LOAD:: Test GOV_setup in bulk mode joins one streamed query to the seats, and caches it'''
+        session = self.session_factory()
+        session.add_all([parl_init_GOV.MPCommons(Constituency=c) 
+                            for c in [u"Ceredigion", u"Vacant Seat", u"York Central"]])
+        session.commit()
+
+        members = [member_addresses_xml(4471, u"York Central", 
+                        twitter="https://twitter.com/rachaelmaskell")[0],
+                   member_addresses_xml(1498, u"Ceredigion", 
+                        website="http://www.markwilliams.org.uk/",
+                        twitter="https://twitter.com/mark4ceredigion")[0],
+                   member_addresses_xml(9999, u"Not In The Db")[0]]
+        document = '<Members>%s</Members>' % ''.join(etree.tostring(m) for m in members)
+
+        cache_dir = tempfile.mkdtemp()
+        real_transport = transport._transport
+        try:
+            shared = transport.configure(backoff=0, cache=http_cache.ResponseCache(cache_dir))
+            # the unmatched seat falls back to a per seat request
+            adapter = ReplayAdapter([(200, document), (200, '<Members/>')])
+            shared.session.mount('http://', adapter)
+            parl_init_GOV.GOV_setup(self.session_factory, mode='bulk')
+
+            self.assertEqual(len(adapter.sent), 2)
+            self.assertIn('House=Commons%7CIsEligible=true', adapter.sent[0].url)
+            self.assertIn('constituency=Vacant%20Seat', adapter.sent[1].url)
+            self.assertEqual(shared.stats()['bytes'], len(document) + len('<Members/>'))
+
+            # the streamed body was cached as it was read: no network needed second time
+            transport.configure(cache=http_cache.ResponseCache(cache_dir, offline=True))
+            self.assertEqual(len(list(parl_init_GOV.iter_member_addresses())), 3)
+        finally:
+            transport._transport = real_transport
+            shutil.rmtree(cache_dir)
+
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT Constituency, OfficialId, TwitterHandle FROM MPCommons \
+                            ORDER BY Constituency")
+            self.assertEqual(cur.fetchall(), [(u"Ceredigion", 1498, u"mark4ceredigion"), 
+                                              (u"Vacant Seat", None, None), 
+                                              (u"York Central", 4471, u"rachaelmaskell")])
+
+            cur.execute("SELECT * FROM Addresses ORDER BY OfficialID, AddressType ASC")
+            self.assertEqual(cur.fetchall(), [
+                (1498, u"twitter", u"https://twitter.com/mark4ceredigion"),
+                (1498, u"website", u"http://www.markwilliams.org.uk/"),
+                (4471, u"twitter", u"https://twitter.com/rachaelmaskell")
+            ])
+
+    def test_bulk_update_and_upsert(self):
+        '''LOAD:: Test the batched loaders update pending rows and replace rows by primary key'''
+        session = self.session_factory()
+        session.add_all([parl_init_GOV.MPCommons(Constituency=c) 
+                            for c in [u"Ceredigion", u"York Outer"]])
+
+        parl_init_TWFY.update_mps([
+            {'name':u'Mark Williams', 'party':u'Liberal Democrat', 'member_id':40728,
+                'person_id':11489, 'constituency':u'Ceredigion'},
+            {'name':u'Julian Sturdy', 'party':u'Conservative', 'member_id':41326,
+                'person_id':24853, 'constituency':u'York Outer'}
+        ], session)
+        bulk.bulk_upsert(session, parl_init_GOV.Address, [
+            {'OfficialId':1498, 'AddressType':u'website', 'Address':u'http://a.org/'},
+            {'OfficialId':1498, 'AddressType':u'twitter', 'Address':u'http://a.org/'}
+        ])
+        session.commit()
+
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT * FROM MPCommons ORDER BY Constituency")
+            self.assertEqual(cur.fetchall(), [
+                (u'Mark Williams', u'Ceredigion', 1, u'Liberal Democrat', None, 40728, 11489, None, None),
+                (u'Julian Sturdy', u'York Outer', 1, u'Conservative', None, 41326, 24853, None, None)
+            ])
+            cur.execute("SELECT * FROM Addresses")
+            self.assertEqual(cur.fetchall(), [(1498, u'twitter', u'http://a.org/')])
+
+    def test_sync_images(self):
+        '''LOAD:: Test images are stored by content hash, and skipped when unchanged'''
+        image_dir = tempfile.mkdtemp()
+        real_transport = transport._transport
+        session = self.session_factory()
+        session.add_all([
+            parl_init_GOV.MPCommons(Constituency=u"Ceredigion", PersonId=11489),
+            parl_init_GOV.MPCommons(Constituency=u"York Outer", PersonId=24853),
+            parl_init_GOV.MPCommons(Constituency=u"Vacant Seat")
+        ])
+        session.commit()
+
+        try:
+            adapter = ReplayAdapter([(200, 'jpeg one', {'etag':'"1"'}), (200, 'jpeg two')])
+            transport.configure(backoff=0).session.mount('http://', adapter)
+            self.assertEqual(images.sync_images(session, image_dir, workers=1), 2)
+            session.commit()
+
+            adapter = ReplayAdapter([(304, ''), (200, 'jpeg two')])
+            transport.configure(backoff=0).session.mount('http://', adapter)
+            self.assertEqual(images.sync_images(session, image_dir, workers=1), 0)
+
+            self.assertEqual(images.image_path(image_dir, 11489), images.content_path(image_dir,
+                                hashlib.sha1('jpeg one').hexdigest()))
+            self.assertTrue(os.path.isfile(images.image_path(image_dir, 24853)))
+            self.assertEqual(images.image_path(image_dir, 1), None)
+        finally:
+            transport._transport = real_transport
+            shutil.rmtree(image_dir)
+
+        self.assertEqual(adapter.sent[0].headers['If-None-Match'], '"1"')
+        # the served urls, never local paths
+        stored = dict(session.query(parl_init_GOV.MPCommons.PersonId, 
+                                    parl_init_GOV.MPCommons.ImageUrl))
+        self.assertEqual(stored, {11489:'images/mps/11489.jpg', 24853:'images/mps/24853.jpg',
+                                  None:None})
+
+    def test_failed_image_download_leaves_no_temp_file(self):
+        '''LOAD:: Test a download which fails part way removes its temporary file'''
+        image_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, image_dir)
+        class BrokenResponse(object):
+            status_code = 200
+            def iter_content(self, size):
+                yield 'half a jpeg'
+                raise requests.ConnectionError('reset')
+            def close(self):
+                pass
+        self.patch(transport, get=lambda url, **kwargs: BrokenResponse())
+
+        with self.assertRaises(requests.ConnectionError):
+            images.fetch_image(11489, image_dir)
+        self.assertEqual(os.listdir(image_dir), [])
+
+    def test_refresh_applies_only_changes(self):
+        '''LOAD:: Test a refresh diffs fetched data against the db and writes only the changes'''
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.executemany('INSERT INTO MPCommons VALUES(?,?,?,?,?,?,?,?,?)', [
+                (u'Mark Williams', u'Ceredigion', 1, u'Liberal Democrat', None, 40728, 11489, 1498,
+                    u'mark4ceredigion'),
+                (u'Old Member', u'York Outer', 1, u'Labour', None, 40730, 11491, 4471,
+                    u'oldmember'),
+                (u'Gone Member', u'Abolished Seat', 1, u'Labour', None, 40731, 11492, 4472, None)
+            ])
+            cur.executemany('INSERT INTO Offices VALUES(?,?,?,?,?,?,?)', [
+                (11489, u'Welsh Affairs Committee', u'2015-07-13', u'9999-12-31', 
+                    u'Mark Williams', u'Member', 1),
+                (11491, u'Treasury', u'2015-07-13', u'9999-12-31', u'Old Member', u'Minister', 1)
+            ])
+            cur.executemany('INSERT INTO Addresses VALUES(?,?,?)', [
+                (1498, u'twitter', u'https://twitter.com/mark4ceredigion'),
+                (4471, u'twitter', u'https://twitter.com/oldmember')
+            ])
+
+        rows = refresh.build_parliament_rows(
+            [u'Ceredigion', u'York Outer'],
+            [
+                {'name':u'Mark Williams', 'party':u'Liberal Democrat', 'member_id':40728,
+                    'person_id':11489, 'constituency':u'Ceredigion'},
+                {'name':u'New Member', 'party':u'Conservative', 'member_id':40999,
+                    'person_id':11999, 'constituency':u'York Outer'}
+            ],
+            [
+                {'person_id':11489, 'department':u'Welsh Affairs Committee', 
+                    'start_date':u'2015-07-13', 'end_date':u'9999-12-31', 
+                    'name':u'Mark Williams', 'title':u'Member'}
+            ],
+            {
+                u'Ceredigion':{"official_ID":"1498", "addresses":
+                    {"twitter":u"https://twitter.com/mark4ceredigion"}},
+                u'York Outer':{"official_ID":"4999", "addresses":
+                    {"twitter":u"https://twitter.com/newmember"}}
+            })
+
+        session = self.session_factory()
+        summary = refresh.apply_parliament_rows(session, rows)
+        session.commit()
+
+        self.assertEqual(summary, {
+            'MPCommons':{'inserted':0, 'updated':1, 'deleted':1},
+            'Offices':{'inserted':0, 'updated':0, 'deleted':1},
+            'Addresses':{'inserted':1, 'updated':0, 'deleted':1}
+        })
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT * FROM MPCommons ORDER BY Constituency")
+            self.assertEqual(cur.fetchall(), [
+                (u'Mark Williams', u'Ceredigion', 1, u'Liberal Democrat', None, 40728, 11489, 1498,
+                    u'mark4ceredigion'),
+                (u'New Member', u'York Outer', 1, u'Conservative', None, 40999, 11999, 4999,
+                    u'newmember')
+            ])
+            cur.execute("SELECT * FROM Addresses ORDER BY OfficialId")
+            self.assertEqual(cur.fetchall(), [
+                (1498, u'twitter', u'https://twitter.com/mark4ceredigion'),
+                (4999, u'twitter', u'https://twitter.com/newmember')
+            ])
+
+        # nothing changed, nothing written
+        session = self.session_factory()
+        summary = refresh.apply_parliament_rows(session, rows)
+        self.assertEqual(sum(sum(counts.values()) for counts in summary.values()), 0)
+
+    def test_setup_refuses_to_drop_server_databases(self):
+        '''LOAD:: Test setup won't rebuild a database in place, which would drop the live tables'''
+        with sqlite3.connect(self.test_db) as connection:
+            connection.execute("INSERT INTO MPCommons (Constituency, MP) VALUES ('York Outer', 0)")
+        # as a server database is seen: no file to build aside
+        self.patch(sqlite_profile, sqlite_path=lambda db_url: None)
+
+        with self.assertRaises(ValueError) as raised:
+            main_setup.setup_archipelago('sqlite:///' + self.test_db)
+        self.assertTrue('refresh_archipelago' in str(raised.exception))
+        with sqlite3.connect(self.test_db) as connection:
+            self.assertEqual(connection.execute("SELECT Constituency FROM MPCommons").fetchall(),
+                             [(u'York Outer',)])
+
+    def refresh_rows(self, name):
+        return refresh.build_parliament_rows([u'Ceredigion'],
+            [{'name':name, 'party':u'Liberal Democrat', 'member_id':40728,
+              'person_id':11489, 'constituency':u'Ceredigion'}], [], {})
+
+    def test_refresh_is_one_transaction(self):
+        '''LOAD:: Test a refresh commits its data, search index and generation together, or none of them'''
+        session = self.session_factory()
+        refresh.apply_parliament_rows(session, self.refresh_rows(u'Mark Williams'))
+        search_index.build_search_index(session)
+        first = generation.bump_generation(session)
+        session.commit()
+        session.close()
+
+        def broken_bump(session):
+            raise ValueError('failed late')
+        real_bump = generation.bump_generation
+        self.patch(refresh, fetch_parliament=lambda *args: self.refresh_rows(u'Mark Wiliams'))
+        self.patch(generation, bump_generation=broken_bump)
+        with self.assertRaises(ValueError):
+            refresh.refresh(self.session_factory)
+
+        # nothing was committed before the failure
+        session = self.session_factory()
+        self.assertEqual(generation.read_generation(session), first)
+        self.assertEqual(session.execute('SELECT Name FROM MPSearch').fetchall(), 
+                         [(u'Mark Williams',)])
+        self.assertEqual(session.query(history.Membership.Name).all(), [])
+        session.close()
+
+        generation.bump_generation = real_bump
+        refresh.refresh(self.session_factory)
+        session = self.session_factory()
+        self.assertNotEqual(generation.read_generation(session), first)
+        self.assertEqual(session.execute('SELECT Name FROM MPSearch').fetchall(), 
+                         [(u'Mark Wiliams',)])
+        self.assertEqual(session.query(history.Membership.Name).all(), [(u'Mark Wiliams',)])
+        session.close()
+
+    def test_refresh_keeps_seats_gov_failed_on(self):
+        '''LOAD:: Test a seat whose GOV fetch failed keeps its official id, handle and addresses'''
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.executemany('INSERT INTO MPCommons VALUES(?,?,?,?,?,?,?,?,?)', [
+                (u'Mark Williams', u'Ceredigion', 1, u'Liberal Democrat', None, 40728, 11489, 1498,
+                    u'mark4ceredigion'),
+                (u'Old Member', u'York Outer', 1, u'Labour', None, 40730, 11491, 4471,
+                    u'oldmember')
+            ])
+            cur.executemany('INSERT INTO Addresses VALUES(?,?,?)', [
+                (1498, u'twitter', u'https://twitter.com/mark4ceredigion'),
+                (4471, u'twitter', u'https://twitter.com/oldmember')
+            ])
+
+        rows = refresh.build_parliament_rows(
+            [u'Ceredigion', u'York Outer'],
+            [
+                {'name':u'Mark Williams', 'party':u'Liberal Democrat', 'member_id':40728,
+                    'person_id':11489, 'constituency':u'Ceredigion'},
+                {'name':u'Old Member', 'party':u'Labour Co-op', 'member_id':40730,
+                    'person_id':11491, 'constituency':u'York Outer'}
+            ], [],
+            {u'Ceredigion':{"official_ID":"1498", "addresses":{}}},
+            failed=[u'York Outer'])
+
+        session = self.session_factory()
+        summary = refresh.apply_parliament_rows(session, rows)
+        session.commit()
+
+        self.assertEqual(summary['MPCommons'], {'inserted':0, 'updated':2, 'deleted':0})
+        self.assertEqual(summary['Addresses'], {'inserted':0, 'updated':0, 'deleted':1})
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT Constituency, Party, OfficialId, TwitterHandle FROM MPCommons \
+                            ORDER BY Constituency")
+            self.assertEqual(cur.fetchall(), [
+                (u'Ceredigion', u'Liberal Democrat', 1498, None),
+                (u'York Outer', u'Labour Co-op', 4471, u'oldmember')])
+            cur.execute("SELECT * FROM Addresses")
+            self.assertEqual(cur.fetchall(), [(4471, u'twitter', u'https://twitter.com/oldmember')])
+
+    def patch(self, module, **replacements):
+        '''Replace module functions for the rest of the test'''
+        for name, replacement in replacements.items():
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, replacement)
+
+    def test_pipelined_setup(self):
+        '''LOAD:: Test the pipelined setup loads TWFY and GOV data fetched side by side'''
+        twfy = {
+            ('getMPs', '&party=liberal'):[{'name':u'Mark Williams', 'party':u'Liberal Democrat',
+                'member_id':u'40728', 'person_id':u'11489', 'constituency':u'Ceredigion',
+                'office':[{'dept':u'Welsh Affairs Committee', 'from_date':u'2015-07-13',
+                           'to_date':u'9999-12-31', 'position':u'Member'}]}],
+            ('getMP', '&constituency=Vacant Seat'):{'error':u'Unknown constituency'},
+            ('getMP', '&constituency=York Central'):{'full_name':u'Rachael Maskell', 
+                'party':u'Labour', 'member_id':u'41000', 'person_id':u'25431', 
+                'constituency':u'York Central'}
+        }
+        self.patch(parl_init_TWFY, 
+            fetch_constituency_names=lambda: [u"Ceredigion", u"Vacant Seat", u"York Central"],
+            fetch_data_online=lambda request, bonus_arg='': twfy.get((request, bonus_arg), []))
+        self.patch(parl_init_GOV,
+            iter_member_addresses=lambda: (parl_init_GOV.build_mp_addresses_from_member(
+                member_addresses_xml(i, c, twitter=t)[0]) for i, c, t in [
+                    (4471, u"York Central", "https://twitter.com/rachaelmaskell"),
+                    (1498, u"Ceredigion", None)]),
+            fetch_xml_online=lambda request, api='members/query/', output='': 
+                etree.fromstring('<Members/>'))
+
+        stats = pipeline.pipelined_setup(self.session_factory, gov_mode='bulk', queue_size=2)
+
+        self.assertEqual(stats.keys(), ['twfy', 'gov', 'build', 'load'])
+        self.assertEqual((stats['twfy']['items'], stats['gov']['items']), (1 + 11 + 2, 2))
+        self.assertEqual(stats['load']['items'], 1 + (11 + 2)*2 + 2)
+        self.assertTrue(stats['load']['max_depth'] <= 2)
+
+        with sqlite3.connect(self.test_db) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT Constituency, Name, MP, PersonId, OfficialId, TwitterHandle \
+                            FROM MPCommons ORDER BY Constituency")
+            self.assertEqual(cur.fetchall(), [
+                (u"Ceredigion", u"Mark Williams", 1, 11489, 1498, None),
+                (u"Vacant Seat", None, 0, None, None, None),
+                (u"York Central", u"Rachael Maskell", 1, 25431, 4471, u"rachaelmaskell")])
+            cur.execute("SELECT PersonId, Office FROM Offices")
+            self.assertEqual(cur.fetchall(), [(11489, u"Welsh Affairs Committee")])
+            cur.execute("SELECT * FROM Addresses")
+            self.assertEqual(cur.fetchall(), 
+                             [(4471, u"twitter", u"https://twitter.com/rachaelmaskell")])
+
+    def test_pipelined_setup_failure(self):
+        '''LOAD:: Test an error in one pipeline stage stops the others and is raised'''
+        def unavailable():
+            raise ValueError('TWFY is down')
+        self.patch(parl_init_TWFY, fetch_constituency_names=unavailable)
+
+        # GOV is waiting on the constituency list, which never comes
+        with self.assertRaises(ValueError):
+            pipeline.pipelined_setup(self.session_factory, gov_mode='per_constituency')
+
+    def test_pipelined_setup_failure_rolls_back(self):
+        '''LOAD:: Test a failed pipeline rolls back and closes the loader's session'''
+        def broken_update(mps_list, session):
+            raise ValueError('bad TWFY data')
+        self.patch(parl_init_TWFY,
+            fetch_constituency_names=lambda: [u"Ceredigion"],
+            fetch_data_online=lambda request, bonus_arg='':
+                {'error':u'Unknown constituency'} if request == 'getMP' else [],
+            update_mps=broken_update)
+        self.patch(parl_init_GOV, iter_member_addresses=lambda: iter([]))
+
+        with self.assertRaises(ValueError):
+            pipeline.pipelined_setup(self.session_factory, gov_mode='bulk')
+
+        # the constituencies were flushed, but never committed, and no lock is held
+        with sqlite3.connect(self.test_db, timeout=0) as connection:
+            cur = connection.cursor()
+            cur.execute("SELECT COUNT(*) FROM MPCommons")
+            self.assertEqual(cur.fetchone(), (0,))
+            cur.execute("INSERT INTO MPCommons (Constituency, MP) VALUES ('York Outer', 0)")
+
+
+def load_reference_database(test_db):
+    '''Build a small database of reference data offline, for the accessor tests which 
+    do not need all 650 constituencies'''
+    engine = main_setup.create_database('sqlite:///'+test_db)
+    with sqlite3.connect(test_db) as connection:
+        cur = connection.cursor()
+        cur.executemany('INSERT INTO MPCommons (Name, Constituency, MP, Party, MemberId, \
+                            PersonId, OfficialId, TwitterHandle) VALUES(?,?,1,?,?,?,?,?)', [
+            (u"Mark Williams", u"Ceredigion", u"Liberal Democrat", 40728, 11489, 123456789, None),
+            (u"William Marks", u"York Outer", u"Labour", 40730, 11491, 987654321, None),
+            (u"Mill Warkiams", u"Belfast West", u"Labour", 40732, 11493, 11223344, u"whatahandle")
+        ])
+        cur.execute('INSERT INTO MPCommons (Constituency, MP) VALUES(?,0)', (u"Vacant Seat",))
+        cur.executemany('INSERT INTO Offices VALUES(?,?,?,?,?,?,?)', [
+            (11489, u"Welsh Affairs Committee", u"2015-07-13", u"9999-12-31", 
+                u"Mark Williams", u"Member", 1),
+            (11489, u"Foreign Office", u"2015-07-13", u"9999-12-31", 
+                u"Mark Williams", u"Foreign Secretary", 1),
+            (11493, u"Welsh Affairs Committee", u"2015-07-13", u"9999-12-31", 
+                u"Mill Warkiams", u"Member", 1)
+        ])
+        cur.executemany('INSERT INTO Addresses VALUES(?,?,?)', [
+            (11223344, u'twitter', u'https://twitter.com/whatahandle'),
+            (11223344, u'website', u'http://www.warkiams.org.uk/'),
+            (123456789, u'website', u'http://www.markwilliams.org.uk/')
+        ])
+    return engine
+
+
+class ReferenceDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_db = "test.db"
+        self.engine = load_reference_database(self.test_db)
+
+    def tearDown(self):
+        # pooled connections would otherwise outlive the file
+        archipelago.registry.dispose()
+        os.remove(self.test_db)
+
+
+class TestQueryCacheMethods(ReferenceDatabaseTestCase):
+    def test_cached_accessors_hit_until_generation_changes(self):
+        '''ACCESS:: Test cached accessors are served from the cache until the db is rewritten'''
+        arch = archipelago.Archipelago("sqlite:///test.db", cache=True, cache_check_interval=0)
+
+        first = arch.get_all_mps(as_records=True)
+        second = arch.get_all_mps(as_records=True)
+        self.assertEqual([mp.Name for mp in first], [mp.Name for mp in second])
+        self.assertEqual(arch.cache_stats()['hits'], 1)
+        self.assertEqual(arch.cache_stats()['misses'], 1)
+
+        # a refresh changes a row and bumps the generation stamp
+        session = sessionmaker(bind=self.engine)()
+        session.query(parl_init_GOV.MPCommons).\
+            filter(parl_init_GOV.MPCommons.Constituency==u"York Outer").\
+            update({parl_init_GOV.MPCommons.Name:u"Aaron Newname"})
+        generation.bump_generation(session)
+        session.commit()
+
+        third = arch.get_all_mps(as_records=True)
+        self.assertEqual(third[1].Name, u"Aaron Newname")
+        self.assertEqual(arch.cache_stats()['invalidations'], 1)
+
+    def test_orm_results_are_not_cached(self):
+        '''ACCESS:: Test ORM objects, which belong to one thread's session, are never cached'''
+        arch = archipelago.Archipelago("sqlite:///test.db", cache=True)
+        mps = arch.get_all_mps()
+        arch.close()
+
+        mp = arch.get_all_mps()[0]
+        self.assertTrue(mp in arch.session)
+        self.assertEqual([a.AddressType for a in mp.Addresses], [])
+        self.assertFalse(mps[0] is mp)
+        self.assertEqual(arch.cache_stats()['size'], 0)
+
+        # from another thread: objects of that thread's own session
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(
+                                    arch.get_all_mps()[0] in arch.session))
+        thread.start()
+        thread.join()
+        self.assertEqual(sessions, [True])
+
+    def test_cache_hits_skip_the_generation_check(self):
+        '''ACCESS:: Test the generation is read at most once per check interval, not per hit'''
+        arch = archipelago.Archipelago("sqlite:///test.db", cache=True, cache_check_interval=3600)
+        arch.get_constituencies()
+        with arch.count_queries() as counter:
+            for _ in range(100):
+                arch.get_constituencies()
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(arch.cache_stats()['hits'], 100)
+
+    def test_query_cache_is_size_and_ttl_bounded(self):
+        '''ACCESS:: Test the query cache evicts least recently used and expired entries'''
+        cache = query_cache.QueryCache(maxsize=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache.ttl = 0
+        self.assertEqual(cache.get('c'), (False, None))
+
+
+class TestRecordAccessorMethods(ReferenceDatabaseTestCase):
+    def test_all_mps_as_records(self):
+        '''ACCESS:: Test accessors return the same rows as records or dicts as ORM objects'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+
+        mps = arch.get_all_mps()
+        records = arch.get_all_mps(as_records=True)
+        dicts = arch.get_all_mps(as_records='dict')
+
+        self.assertEqual([(mp.Name, mp.Constituency, mp.OfficialId) for mp in mps],
+                         [(r.Name, r.Constituency, r.OfficialId) for r in records])
+        self.assertEqual([r._asdict() for r in records], dicts)
+        self.assertEqual(tuple(records[1]), (u"Mark Williams", u"Ceredigion", 1, 
+                            u"Liberal Democrat", None, 40728, 11489, 123456789, None))
+
+    def test_filtered_accessors_as_records(self):
+        '''ACCESS:: Test tweeting and official id accessors in record mode'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+
+        tweeting = arch.get_all_tweeting_mps(as_records=True)
+        by_id = arch.get_mps_by_official_id([123456789, 987654321], as_records='dict')
+
+        self.assertEqual([mp.Name for mp in tweeting], [u"Mill Warkiams"])
+        self.assertEqual([mp['Name'] for mp in by_id], [u"Mark Williams", u"William Marks"])
+
+
+class TestEngineMethods(ReferenceDatabaseTestCase):
+    def test_schema_check_is_cached(self):
+        '''ACCESS:: Test instances on one url share an engine, and check the schema once'''
+        first = archipelago.Archipelago("sqlite:///test.db")
+        with first.count_queries() as counter:
+            second = archipelago.Archipelago("sqlite:///test.db")
+
+        self.assertTrue(first._engine is second._engine)
+        self.assertEqual(counter.statements, ['PRAGMA schema_version'])
+        self.assertFalse(first.session is second.session)
+
+    def test_file_connections_are_pooled(self):
+        '''ACCESS:: Test sessions on a SQLite file reuse one tuned connection, until the file is replaced'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        connects = []
+        event.listen(arch._engine, 'connect', lambda dbapi_connection, record: 
+                                                connects.append(record))
+        for _ in range(10):
+            arch.get_constituencies()
+            arch.close()
+        self.assertTrue(len(connects) <= 1)
+
+        # renamed over, as setup does: the pooled connection is dropped, not reused
+        build = load_reference_database(staging.staging_path("test.db"))
+        build.execute("DELETE FROM MPCommons WHERE Constituency='Vacant Seat'")
+        staging.promote(build, "test.db")
+        self.addCleanup(staging.remove_sqlite_files, staging.previous_path("test.db"))
+        self.assertEqual(len(arch.get_constituencies()), 3)
+        arch.close()
+
+    def test_concurrent_instances_do_not_leak(self):
+        '''ACCESS:: Test many threads on two databases get the right data and return every connection'''
+        load_reference_database("test2.db")
+        self.addCleanup(os.remove, "test2.db")
+        with sqlite3.connect("test2.db") as connection:
+            connection.execute("UPDATE MPCommons SET Name='Other Db' WHERE Constituency='Ceredigion'")
+
+        expected = {"sqlite:///test.db":u"Mark Williams", "sqlite:///test2.db":u"Other Db"}
+        checkouts, checked_out = [], set()
+        def checkout(dbapi_connection, record, proxy):
+            checkouts.append(record)
+            checked_out.add(record)
+        for url in expected:
+            engine = archipelago.registry.engine(url)
+            self.addCleanup(archipelago.registry.dispose, url)
+            event.listen(engine, 'checkout', checkout)
+            event.listen(engine, 'checkin', lambda dbapi_connection, record: 
+                                                checked_out.discard(record))
+
+        errors = []
+        shared = archipelago.Archipelago("sqlite:///test.db")
+        def work(i):
+            url = sorted(expected)[i % 2]
+            try:
+                for _ in range(20):
+                    with archipelago.Archipelago(url) as arch:
+                        mp = arch.get_mps_by_official_id([123456789])[0]
+                        if mp.Name != expected[url]:
+                            errors.append((url, mp.Name))
+                    # one instance used from every thread: a session each
+                    if len(shared.get_constituencies()) != 4:
+                        errors.append(('shared', i))
+                    shared.close()
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        # every connection checked out was checked back in
+        self.assertTrue(len(checkouts) >= 16 * 20 * 2)
+        self.assertEqual(checked_out, set())
+
+    def test_build_does_not_block_other_databases(self):
+        '''ACCESS:: Test a slow build of one database only holds up openers of that database'''
+        self.addCleanup(lambda: os.path.exists("test3.db") and os.remove("test3.db"))
+        self.addCleanup(archipelago.registry.dispose, "sqlite:///test3.db")
+        started, release, builds = threading.Event(), threading.Event(), []
+        def slow_build(arch):
+            builds.append(arch._db_url)
+            started.set()
+            release.wait(10)
+            load_reference_database("test3.db")
+        real_build = archipelago.Archipelago._build
+        archipelago.Archipelago._build = slow_build
+        self.addCleanup(setattr, archipelago.Archipelago, '_build', real_build)
+
+        opened = []
+        def open_database(url):
+            with archipelago.Archipelago(url) as arch:
+                opened.append((url, len(arch.get_constituencies())))
+        building = [threading.Thread(target=open_database, args=("sqlite:///test3.db",)) 
+                        for _ in range(4)]
+        for thread in building:
+            thread.start()
+        self.assertTrue(started.wait(10))
+
+        # while test3.db builds, test.db opens and answers, again and again
+        others = [threading.Thread(target=open_database, args=("sqlite:///test.db",)) 
+                    for _ in range(16)]
+        for thread in others:
+            thread.start()
+        for thread in others:
+            thread.join(10)
+        self.assertEqual(opened, [("sqlite:///test.db", 4)] * 16)
+
+        release.set()
+        for thread in building:
+            thread.join(10)
+        self.assertEqual(builds, ["sqlite:///test3.db"])
+        self.assertEqual(opened[16:], [("sqlite:///test3.db", 4)] * 4)
+
+
+class TestSQLiteProfileMethods(ReferenceDatabaseTestCase):
+    def pragma(self, engine, name):
+        return engine.scalar('PRAGMA %s' % name)
+
+    def test_profiles_set_pragmas(self):
+        '''ACCESS:: Test built dbs use WAL, and serving connections a sized cache and mmap'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        self.assertEqual(self.pragma(arch._engine, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(arch._engine, 'cache_size'), 
+                         -main_setup.sqlite_profile.cache_size_kb)
+        self.assertEqual(self.pragma(arch._engine, 'mmap_size'), 
+                         main_setup.sqlite_profile.mmap_size)
+
+    def test_read_only_replica(self):
+        '''ACCESS:: Test a read only Archipelago serves queries and refuses writes'''
+        arch = archipelago.Archipelago("sqlite:///test.db", read_only=True)
+        self.addCleanup(archipelago.registry.dispose, "sqlite:///test.db")
+
+        self.assertEqual([mp.Name for mp in arch.get_all_tweeting_mps()], [u"Mill Warkiams"])
+        self.assertRaises(OperationalError, arch._engine.execute, 
+                          "DELETE FROM MPCommons")
+        arch.close()
+
+    def test_read_only_sees_writes_to_the_live_file(self):
+        '''ACCESS:: Test a read only Archipelago sees a write still in the WAL, which an immutable replica would not'''
+        arch = archipelago.Archipelago("sqlite:///test.db", read_only=True)
+        self.addCleanup(archipelago.registry.dispose, "sqlite:///test.db")
+        count = "SELECT count(*) FROM MPCommons"
+        before = arch._engine.scalar(count)
+
+        # the writer stays connected, so its commit isn't checkpointed out of the WAL
+        writer = main_setup.sqlite_profile.tuned_engine("sqlite:///test.db", 'load')
+        connection = writer.connect()
+        connection.execute("DELETE FROM MPCommons WHERE Name = 'Mill Warkiams'")
+        self.assertNotEqual(os.path.getsize("test.db-wal"), 0)
+        self.assertEqual(arch._engine.scalar(count), before - 1)
+        connection.close()
+        writer.dispose()
+        arch.close()
+
+        # only replicas, which nothing writes to, are opened immutable
+        self.assertNotIn('immutable', main_setup.sqlite_profile.read_only_uri("test.db"))
+        self.assertIn('immutable=1', 
+                      main_setup.sqlite_profile.read_only_uri("test.db", immutable=True))
+
+    def patch_setup(self, twfy_setup):
+        for module, name in [(parl_init_TWFY, 'TWFY_setup'), (parl_init_GOV, 'GOV_setup')]:
+            self.addCleanup(setattr, module, name, getattr(module, name))
+        parl_init_TWFY.TWFY_setup = twfy_setup
+        parl_init_GOV.GOV_setup = lambda session_factory, workers=1, mode=None: None
+
+    def test_setup_swaps_in_a_finished_build(self):
+        '''LOAD:: Test setup builds aside, renames the build over the live db, and leaves it on failure'''
+        reader = archipelago.Archipelago("sqlite:///test.db")
+        self.assertEqual(len(reader.get_constituencies()), 4)
+        reader.close()
+
+        def failing_setup(session_factory, load_images=False):
+            session_factory().add(parl_init_TWFY.MPCommons(Constituency=u"Half Built"))
+            raise ValueError('TWFY is down')
+        self.patch_setup(failing_setup)
+        self.assertRaises(ValueError, main_setup.setup_archipelago, "sqlite:///test.db")
+        self.assertEqual(len(reader.get_constituencies()), 4)
+        self.assertFalse(os.path.exists(staging.staging_path("test.db")))
+        reader.close()
+
+        self.patch_setup(new_seats_setup([u"New Seat"]))
+        engine, session_factory = main_setup.setup_archipelago("sqlite:///test.db", 
+                                                                constituencies=1)
+        engine.dispose()
+        self.addCleanup(staging.remove_sqlite_files, staging.previous_path("test.db"))
+
+        self.assertEqual(reader.get_constituencies(), [u"New Seat"])
+        self.assertFalse(os.path.exists(staging.staging_path("test.db")))
+        reader.close()
+
+    def test_invalid_build_is_not_promoted(self):
+        '''LOAD:: Test a build with the wrong number of constituencies is thrown away'''
+        self.patch_setup(new_seats_setup([u"New Seat", u"Other Seat"]))
+        try:
+            main_setup.setup_archipelago("sqlite:///test.db", constituencies=650)
+            self.fail('invalid build promoted')
+        except staging.ValidationError as error:
+            self.assertEqual(error.problems, ['2 constituencies, expected 650'])
+
+        with archipelago.Archipelago("sqlite:///test.db") as arch:
+            self.assertEqual(len(arch.get_constituencies()), 4)
+        self.assertFalse(os.path.exists(staging.staging_path("test.db")))
+        self.assertFalse(os.path.exists(staging.previous_path("test.db")))
+
+    def test_build_is_not_promoted_over_a_busy_wal(self):
+        '''LOAD:: Test a build is thrown away if a reader keeps the live WAL from being checkpointed'''
+        self.addCleanup(setattr, sqlite_profile, 'checkpoint_timeout', 
+                        sqlite_profile.checkpoint_timeout)
+        sqlite_profile.checkpoint_timeout = 0.1
+        # a reader on the snapshot before a write which is still in the WAL
+        reader = sqlite3.connect("test.db", isolation_level=None)
+        reader.execute("BEGIN")
+        reader.execute("SELECT count(*) FROM MPCommons").fetchall()
+        writer = sqlite3.connect("test.db", isolation_level=None)
+        writer.execute("DELETE FROM MPCommons WHERE Constituency='Vacant Seat'")
+
+        self.patch_setup(new_seats_setup([u"New Seat"]))
+        self.assertRaises(sqlite_profile.CheckpointError, main_setup.setup_archipelago, 
+                          "sqlite:///test.db", constituencies=1)
+        self.assertFalse(os.path.exists(staging.staging_path("test.db")))
+        self.assertFalse(os.path.exists(staging.previous_path("test.db")))
+        reader.close()
+        writer.close()
+
+        with archipelago.Archipelago("sqlite:///test.db") as arch:
+            self.assertEqual(len(arch.get_constituencies()), 3)
+
+    def test_history_survives_rebuilds(self):
+        '''LOAD:: Test a rebuild carries the live history over and closes what ended'''
+        with archipelago.Archipelago("sqlite:///test.db") as arch:
+            history.record_history(arch.session, '2016-01-01')
+            arch.session.commit()
+
+        self.patch_setup(new_seats_setup([u"New Seat"]))
+        main_setup.setup_archipelago("sqlite:///test.db", constituencies=1)[0].dispose()
+        self.addCleanup(staging.remove_sqlite_files, staging.previous_path("test.db"))
+
+        with archipelago.Archipelago("sqlite:///test.db") as arch:
+            self.assertEqual(arch.get_constituencies(), [u"New Seat"])
+            self.assertEqual(len(arch.as_of('2016-01-01').get_all_mps()), 3)
+            self.assertEqual(arch.as_of(datetime.date.today()).get_all_mps(), [])
+
+    def test_rollback_restores_previous_snapshot(self):
+        '''LOAD:: Test rollback puts the replaced db back, and a second rollback undoes it'''
+        self.patch_setup(new_seats_setup([u"New Seat"]))
+        main_setup.setup_archipelago("sqlite:///test.db", constituencies=1)[0].dispose()
+        self.addCleanup(staging.remove_sqlite_files, staging.previous_path("test.db"))
+
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        self.assertEqual(arch.get_constituencies(), [u"New Seat"])
+        self.assertTrue(arch.rollback())
+        self.assertEqual(len(arch.get_constituencies()), 4)
+        self.assertTrue(arch.rollback())
+        self.assertEqual(arch.get_constituencies(), [u"New Seat"])
+        arch.close()
+
+        staging.remove_sqlite_files(staging.previous_path("test.db"))
+        self.assertFalse(main_setup.rollback_archipelago("sqlite:///test.db"))
+
+
+def new_seats_setup(constituencies):
+    '''A stand in for TWFY_setup, loading a seat with an MP for each constituency'''
+    def setup(session_factory, load_images=False):
+        session = session_factory()
+        session.add_all([parl_init_TWFY.MPCommons(Constituency=c, MP=1) for c in constituencies])
+        session.commit()
+    return setup
+
+
+@unittest.skipIf(numpy is None, 'columnar snapshots need numpy')
+class TestColumnarMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestColumnarMethods, self).setUp()
+        self.snapshot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot)
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.addCleanup(self.arch.close)
+
+    def by_constituency(self, records):
+        return sorted(records, key=lambda r: r['Constituency'])
+
+    def test_export_and_memory_map(self):
+        '''ACCESS:: Test a columnar snapshot maps back to the same rows, with encoded columns'''
+        manifest = self.arch.export_columns(self.snapshot)
+        self.assertEqual(manifest['generation'], self.arch.generation())
+
+        tables = columnar.load_columns(self.snapshot)
+        mps = tables['MPCommons']
+        self.assertEqual(len(mps), 4)
+        self.assertTrue(isinstance(mps['OfficialId'], numpy.memmap))
+        self.assertEqual(self.by_constituency(mps.records()), 
+                         self.by_constituency(self.arch.get_all_mps(as_records='dict')))
+
+        # dictionary encoded: filter on codes, without decoding
+        party = mps['Party']
+        self.assertEqual(list(party.dictionary), [u"Labour", u"Liberal Democrat"])
+        labour = mps['Constituency'][party.codes == party.code(u"Labour")]
+        self.assertEqual(sorted(labour), [u"Belfast West", u"York Outer"])
+        self.assertEqual(mps.mask('TwitterHandle').sum(), 3)
+
+        addresses = tables['Addresses']
+        twitter = addresses['AddressType'].code(u"twitter")
+        self.assertEqual(list(addresses['OfficialId'][addresses['AddressType'].codes == twitter]),
+                         [11223344])
+        self.assertEqual(len(tables['Offices']), 3)
+
+    def test_compressed_snapshot(self):
+        '''ACCESS:: Test a compressed snapshot holds the same rows as a plain one'''
+        plain = os.path.join(self.snapshot, 'plain')
+        compressed = os.path.join(self.snapshot, 'compressed')
+        self.arch.export_columns(plain)
+        self.arch.export_columns(compressed, compressed=True)
+
+        for table, columns in columnar.load_columns(compressed).items():
+            self.assertEqual(columns.records(), columnar.load_columns(plain)[table].records())
+
+
+class TestFrozenArchipelagoMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestFrozenArchipelagoMethods, self).setUp()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.addCleanup(self.arch.close)
+        self.frozen = self.arch.freeze()
+
+    def test_frozen_queries_match(self):
+        '''ACCESS:: Test a frozen archipelago answers the accessors as the database does'''
+        columns = lambda mps: [(mp.Name, mp.Constituency, mp.OfficialId) for mp in mps]
+        self.assertEqual(columns(self.frozen.get_all_mps()), columns(self.arch.get_all_mps()))
+        self.assertEqual(columns(self.frozen.get_all_tweeting_mps()), 
+                         columns(self.arch.get_all_tweeting_mps()))
+        self.assertEqual(columns(self.frozen.get_mps_by_official_id([987654321, 123456789, 5])),
+                         columns(self.arch.get_mps_by_official_id([987654321, 123456789, 5])))
+        self.assertEqual(self.frozen.get_twitter_users(), self.arch.get_twitter_users())
+        self.assertEqual(sorted(self.frozen.get_constituencies()), 
+                         sorted(self.arch.get_constituencies()))
+        self.assertEqual(self.frozen.generation, self.arch.generation())
+
+    def test_frozen_indexes(self):
+        '''ACCESS:: Test the frozen hash indexes and relationships'''
+        mp = self.frozen.get_mp_by_official_id(123456789)
+        self.assertEqual(mp.Name, u"Mark Williams")
+        self.assertTrue(self.frozen.get_mp_by_person_id(11489) is mp)
+        self.assertTrue(self.frozen.get_mp_by_member_id(40728) is mp)
+        self.assertTrue(self.frozen.get_mp_by_constituency(u"Ceredigion") is mp)
+        self.assertEqual(self.frozen.get_mp_by_twitter_handle(u"whatahandle").Name, 
+                         u"Mill Warkiams")
+        self.assertEqual(self.frozen.get_mp_by_official_id(5), None)
+
+        self.assertEqual(sorted(o.Title for o in mp.Offices), [u"Foreign Secretary", u"Member"])
+        self.assertEqual([a.Address for a in mp.Addresses], [u"http://www.markwilliams.org.uk/"])
+        self.assertEqual([m.Name for m in self.frozen.get_mps_by_party(u"Labour")],
+                         [u"Mill Warkiams", u"William Marks"])
+        self.assertEqual([m.Name for m in self.frozen.get_mps_by_office(u"Welsh Affairs Committee")],
+                         [u"Mark Williams", u"Mill Warkiams"])
+
+    def test_frozen_records_are_immutable_and_pickle(self):
+        '''ACCESS:: Test frozen records refuse changes, and the dataset survives a pickle'''
+        mp = self.frozen.get_mp_by_official_id(123456789)
+        self.assertRaises(AttributeError, setattr, mp, 'Name', u"Someone Else")
+        self.assertRaises(AttributeError, setattr, mp, 'Extra', 1)
+
+        path = os.path.join(tempfile.mkdtemp(), 'frozen.pickle')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.frozen.dump(path)
+        loaded = frozen.FrozenArchipelago.load(path)
+
+        self.assertEqual(loaded.mps, self.frozen.mps)
+        self.assertEqual(loaded.get_mp_by_official_id(123456789), mp)
+        self.assertEqual(loaded.generation, self.frozen.generation)
+
+
+class TestHistoryMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestHistoryMethods, self).setUp()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.addCleanup(self.arch.close)
+
+    def record(self, today):
+        session = self.arch.session
+        summary = history.record_history(session, today)
+        session.commit()
+        return summary
+
+    def replace_york_outer_mp(self):
+        with sqlite3.connect(self.test_db) as connection:
+            connection.execute("UPDATE MPCommons SET Name='Marie Wilks', PersonId=11500 \
+                                WHERE Constituency='York Outer'")
+            connection.execute("DELETE FROM Offices WHERE Office='Foreign Office'")
+
+    def test_record_history_intervals(self):
+        '''LOAD:: Test memberships and office terms open, carry on and close as the data changes'''
+        summary = self.record('2016-01-01')
+        self.assertEqual(summary['Memberships'], {'opened':3, 'closed':0})
+        self.assertEqual(summary['OfficeTerms'], {'recorded':3, 'closed':0})
+        # nothing changed, nothing new
+        self.assertEqual(self.record('2016-02-01')['Memberships'], {'opened':0, 'closed':0})
+
+        self.replace_york_outer_mp()
+        summary = self.record('2016-06-01')
+        self.assertEqual(summary['Memberships'], {'opened':1, 'closed':1})
+        self.assertEqual(summary['OfficeTerms'], {'recorded':2, 'closed':1})
+
+        held = self.arch.get_memberships(since='2016-01-01', constituency=u"York Outer")
+        self.assertEqual([(m.Name, m.StartDate, m.EndDate) for m in held], [
+            (u"William Marks", datetime.date(2016, 1, 1), datetime.date(2016, 5, 31)),
+            (u"Marie Wilks", datetime.date(2016, 6, 1), history.OPEN_END)])
+        self.assertEqual(self.arch.get_memberships(until='2015-12-31'), [])
+
+    def test_as_of(self):
+        '''ACCESS:: Test the point in time view of seats and offices'''
+        self.record('2016-01-01')
+        self.replace_york_outer_mp()
+        self.record('2016-06-01')
+
+        before, after = self.arch.as_of('2016-03-01'), self.arch.as_of(datetime.date(2016, 7, 1))
+        self.assertEqual(before.get_mp_by_constituency(u"York Outer").Name, u"William Marks")
+        self.assertEqual(after.get_mp_by_constituency(u"York Outer").Name, u"Marie Wilks")
+        self.assertEqual(self.arch.as_of('2015-01-01').get_mp_by_constituency(u"York Outer"), None)
+        self.assertEqual([m.Name for m in after.get_all_mps()], 
+                         [u"Marie Wilks", u"Mark Williams", u"Mill Warkiams"])
+
+        # office terms carry TWFY's own start dates
+        self.assertEqual(sorted(o.Office for o in before.get_offices(person_id=11489)),
+                         [u"Foreign Office", u"Welsh Affairs Committee"])
+        self.assertEqual([o.Office for o in after.get_offices(person_id=11489)],
+                         [u"Welsh Affairs Committee"])
+        self.assertEqual(len(self.arch.as_of('2015-07-13').get_offices()), 3)
+        self.assertEqual(self.arch.as_of('2015-07-12').get_offices(), [])
+        self.assertRaises(ValueError, self.arch.as_of, 'last tuesday')
+
+    def test_interval_queries_use_indexes(self):
+        '''ACCESS:: Test point in time queries range scan an interval index'''
+        table = history.Membership.__table__
+        day = datetime.date(2016, 1, 1)
+        for conditions in [history._overlapping(table, day, day),
+                           [table.c.Constituency==u"York Outer"]]:
+            statement = history.select([table]).where(history.and_(*conditions)).\
+                            compile(dialect=self.arch._engine.dialect, 
+                                    compile_kwargs={'literal_binds':True})
+            plan = ' | '.join(tuple(row)[-1] for row in 
+                        self.arch._engine.execute('EXPLAIN QUERY PLAN %s' % statement))
+            self.assertIn('USING INDEX ix_Memberships_', plan)
+
+
+class TestCurrentOfficeMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestCurrentOfficeMethods, self).setUp()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.addCleanup(self.arch.close)
+        self.arch.session.add(archipelago.Office(PersonId=11489, Office=u"Treasury", 
+                                Title=u"Minister", Name=u"Mark Williams", IsCurrent=False,
+                                StartDate=datetime.date(2010, 5, 12), 
+                                EndDate=datetime.date(2012, 9, 4)))
+        self.arch.session.commit()
+
+    def test_get_current_offices(self):
+        '''ACCESS:: Test current offices, by person and by department, leave out ended ones'''
+        offices = self.arch.get_current_offices()
+        self.assertEqual([(o.PersonId, o.Office) for o in offices], [
+            (11489, u"Foreign Office"), (11489, u"Welsh Affairs Committee"),
+            (11493, u"Welsh Affairs Committee")])
+        self.assertEqual(offices[0].StartDate, datetime.date(2015, 7, 13))
+        self.assertEqual([o.Title for o in self.arch.get_current_offices(person_id=11489)],
+                         [u"Foreign Secretary", u"Member"])
+        self.assertEqual([o.PersonId for o in self.arch.get_current_offices(
+                            department=u"Welsh Affairs Committee")], [11489, 11493])
+        self.assertEqual(self.arch.get_current_offices(department=u"Treasury"), [])
+
+        frozen = self.arch.freeze()
+        self.assertEqual([(o.PersonId, o.Office, o.Title) for o in frozen.get_current_offices()],
+                         [(o.PersonId, o.Office, o.Title) for o in offices])
+        self.assertEqual(len(frozen.get_current_offices(person_id=11489, 
+                                department=u"Foreign Office")), 1)
+
+    def test_office_columns_typed(self):
+        '''BUILD:: Test TWFY offices are loaded with dates, and flagged current by their end date'''
+        office = {'person_id':11489, 'department':u"Treasury", 'name':u"Mark Williams", 
+                  'title':u"Minister", 'start_date':u"2010-05-12", 'end_date':u"2012-09-04"}
+        columns = parl_init_TWFY.office_columns(office)
+        self.assertEqual((columns['StartDate'], columns['EndDate'], columns['IsCurrent']),
+                         (datetime.date(2010, 5, 12), datetime.date(2012, 9, 4), False))
+        office['end_date'] = u"9999-12-31"
+        self.assertTrue(parl_init_TWFY.office_columns(office)['IsCurrent'])
+
+    def test_undated_offices_are_skipped(self):
+        '''BUILD:: Test offices whose start date, part of their key, is not a date are left out'''
+        offices = [{'person_id':11489, 'department':u"Treasury", 'name':u"Mark Williams",
+                    'title':u"Minister", 'start_date':start, 'end_date':u"9999-12-31"}
+                        for start in [u"2010-05-12", u"", None, u"12/05/2010"]]
+        self.assertEqual([row['StartDate'] for row in parl_init_TWFY.office_rows(offices)],
+                         [datetime.date(2010, 5, 12)])
+
+    def test_refresh_recomputes_is_current(self):
+        '''LOAD:: Test a refresh clears IsCurrent from offices ended since, with nothing else changed'''
+        session = self.arch.session
+        mps = [{'name':mp.Name, 'party':mp.Party, 'member_id':mp.MemberId, 
+                'person_id':mp.PersonId, 'constituency':mp.Constituency} 
+                    for mp in self.arch.get_all_mps() if mp.MP]
+        offices = [{'person_id':o.PersonId, 'department':o.Office, 'name':o.Name, 
+                    'title':o.Title, 'start_date':o.StartDate, 'end_date':o.EndDate}
+                        for o in session.query(archipelago.Office)]
+        # the Foreign Secretary's term ended yesterday, which the db has not caught up with
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        for office in offices:
+            if office['title'] == u"Foreign Secretary":
+                office['end_date'] = yesterday
+        rows = refresh.build_parliament_rows(self.arch.get_constituencies(), mps, offices, {},
+                                             failed=self.arch.get_constituencies())
+
+        summary = refresh.apply_parliament_rows(session, rows)
+        session.commit()
+        self.assertEqual(summary['Offices'], {'inserted':0, 'updated':1, 'deleted':0})
+        self.assertEqual(summary['MPCommons'], {'inserted':0, 'updated':0, 'deleted':0})
+        self.assertEqual([o.Title for o in self.arch.get_current_offices(person_id=11489)],
+                         [u"Member"])
+
+
+class TestOfficeGraphMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestOfficeGraphMethods, self).setUp()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.arch.graph_check_interval = 0
+        self.addCleanup(self.arch.close)
+
+    def change_offices(self, add=(), remove=()):
+        session = self.arch.session
+        for person_id, office in add:
+            session.add(archipelago.Office(PersonId=person_id, Office=office, Title=u"Member",
+                            StartDate=datetime.date(2016, 1, 1), 
+                            EndDate=datetime.date(9999, 12, 31), IsCurrent=True))
+        for person_id, office in remove:
+            session.query(archipelago.Office).filter_by(PersonId=person_id, Office=office).delete()
+        generation.bump_generation(session)
+        session.commit()
+
+    def test_graph_queries(self):
+        '''ACCESS:: Test neighbour, co-membership and shortest path queries over the office graph'''
+        self.assertEqual(self.arch.get_committee_neighbours(11489), [(11493, 1)])
+        self.assertEqual(self.arch.get_co_membership(11489, 11493), 1)
+        self.assertEqual(self.arch.get_co_membership(11489, 11491), 0)
+        self.assertEqual(self.arch.get_party_co_membership(), 
+                         {(u"Labour", u"Liberal Democrat"):1})
+        self.assertEqual(self.arch.get_committee_path(11493, 11489), 
+                         [11493, u"Welsh Affairs Committee", 11489])
+        self.assertEqual(self.arch.get_committee_path(11493, 11491), None)
+
+        self.change_offices(add=[(11491, u"Foreign Office")])
+        self.assertEqual(self.arch.get_committee_path(11493, 11491), 
+                         [11493, u"Welsh Affairs Committee", 11489, u"Foreign Office", 11491])
+        self.assertEqual(self.arch.get_committee_neighbours(11489), [(11491, 1), (11493, 1)])
+        self.assertEqual(self.arch.get_party_co_membership(), 
+                         {(u"Labour", u"Liberal Democrat"):2})
+
+    def test_graph_updates_incrementally(self):
+        '''ACCESS:: Test the graph is kept per generation, and updated in place of a rebuild'''
+        graph = self.arch.office_graph()
+        self.assertTrue(self.arch.office_graph() is graph)
+
+        self.change_offices(add=[(11491, u"Treasury"), (11489, u"Treasury")],
+                            remove=[(11493, u"Welsh Affairs Committee")])
+        updated = self.arch.office_graph()
+        self.assertFalse(updated is graph)
+        self.assertEqual(updated.generation, self.arch.generation())
+        # the untouched committee keeps its node, new ones are appended
+        self.assertEqual(updated.committees, 
+                         [u"Foreign Office", u"Welsh Affairs Committee", u"Treasury"])
+
+        rebuilt = archipelago.OfficeGraph.from_connectable(self.arch._engine)
+        for person_id in [11489, 11491, 11493]:
+            self.assertEqual(sorted(updated.committees_of(person_id)), 
+                             sorted(rebuilt.committees_of(person_id)))
+            self.assertEqual(updated.neighbours(person_id), rebuilt.neighbours(person_id))
+        for committee in rebuilt.committees:
+            self.assertEqual(updated.members_of(committee), rebuilt.members_of(committee))
+        self.assertEqual(updated.members_of(u"Welsh Affairs Committee"), [11489])
+        self.assertEqual(graph.members_of(u"Welsh Affairs Committee"), [11489, 11493])
+
+    def test_graph_queries_skip_the_generation_check(self):
+        '''ACCESS:: Test graph queries between generation checks don't touch the db'''
+        self.arch.graph_check_interval = 3600
+        self.arch.get_committee_neighbours(11489)
+        with self.arch.count_queries() as counter:
+            for _ in range(100):
+                self.arch.get_committee_neighbours(11489)
+        self.assertEqual(counter.count, 0)
+
+
+class TestBatchLookupMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestBatchLookupMethods, self).setUp()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.addCleanup(self.arch.close)
+
+    def names(self, records):
+        return [r.Name if r is not None else None for r in records]
+
+    def test_lookup_keeps_order_and_misses(self):
+        '''ACCESS:: Test batch lookups by each key line up with the input, with None for misses'''
+        self.assertEqual(self.names(self.arch.lookup_mps([987654321, 5, 123456789, 987654321])),
+                         [u"William Marks", None, u"Mark Williams", u"William Marks"])
+        self.assertEqual(self.names(self.arch.lookup_mps([11493, 11489], by='PersonId')),
+                         [u"Mill Warkiams", u"Mark Williams"])
+        self.assertEqual(self.names(self.arch.lookup_mps([40730, None], by='MemberId')),
+                         [u"William Marks", None])
+        self.assertEqual(self.names(self.arch.lookup_mps([u"nobody", u"whatahandle"], 
+                                                         by='TwitterHandle')),
+                         [None, u"Mill Warkiams"])
+        self.assertEqual(self.arch.lookup_mps([]), [])
+        self.assertRaises(ValueError, self.arch.lookup_mps, [1], by='Name')
+
+    def test_lookup_many_keys(self):
+        '''ACCESS:: Test lookups past SQLite's parameter limit, chunked and by scan'''
+        keys = range(3000) + [123456789, 11223344]
+        with self.arch.count_queries() as counter:
+            found = self.arch.lookup_mps(keys)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(self.names(found[-2:]), [u"Mark Williams", u"Mill Warkiams"])
+        self.assertEqual(found[:3000], [None]*3000)
+
+        keys = range(1500) + [11223344]
+        with self.arch.count_queries() as counter:
+            found = self.arch.lookup_mps(keys)
+        self.assertEqual(counter.count, 4)
+        self.assertEqual(self.names(found[-1:]), [u"Mill Warkiams"])
+
+    @unittest.skipIf(numpy is None, 'aligned columns need numpy')
+    def test_lookup_columns(self):
+        '''ACCESS:: Test batch lookups as masked numpy columns aligned with the input'''
+        columns = self.arch.lookup_mps([11223344, 5, 123456789], as_columns=True)
+        self.assertEqual(columns['found'].tolist(), [True, False, True])
+        self.assertEqual(columns['Name'].tolist(), [u"Mill Warkiams", None, u"Mark Williams"])
+        self.assertEqual(columns['PersonId'].tolist(), [11493, None, 11489])
+        self.assertEqual(columns['TwitterHandle'].tolist(), [u"whatahandle", None, None])
+
+
+class TestTwitterResolverMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestTwitterResolverMethods, self).setUp()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+        self.addCleanup(self.arch.close)
+
+    def bump_generation(self):
+        session = self.arch.session
+        generation.bump_generation(session)
+        session.commit()
+
+    def test_fold_handle(self):
+        '''BUILD:: Test handles, @handles and url variants fold to one canonical handle'''
+        for handle in [u"Mark4Ceredigion", u"@mark4ceredigion", u"https://twitter.com/Mark4Ceredigion",
+                       u"http://www.twitter.com/mark4ceredigion/", u"twitter.com/MARK4CEREDIGION",
+                       u"https://twitter.com/#!/mark4ceredigion"]:
+            self.assertEqual(parl_init_GOV.fold_handle(handle), u"mark4ceredigion")
+
+    def test_resolve(self):
+        '''ACCESS:: Test screen names resolve to MPs whatever their case or form'''
+        resolver = self.arch.twitter_resolver()
+        self.assertTrue(self.arch.twitter_resolver() is resolver)
+        self.assertEqual(len(resolver), 1)
+        for handle in [u"whatahandle", u"WhatAHandle", u"@whatahandle", 
+                       u"https://www.twitter.com/WHATAHANDLE/"]:
+            self.assertEqual(resolver.resolve(handle).Name, u"Mill Warkiams")
+        self.assertEqual(resolver.resolve(u"nobody"), None)
+        self.assertEqual(resolver.resolve(None), None)
+        self.assertEqual([mp and mp.Name for mp in resolver.resolve_many([u"x", u"WHATAHANDLE"])],
+                         [None, u"Mill Warkiams"])
+        self.assertTrue(u"@WhatAHandle" in resolver)
+
+    def test_resolver_reloads_on_new_generation(self):
+        '''ACCESS:: Test the resolver map is only reloaded once the db generation changes'''
+        resolver = archipelago.TwitterResolver(self.arch._engine, check_interval=0)
+        accounts = resolver.accounts()
+        self.assertTrue(resolver.accounts() is accounts)
+
+        with sqlite3.connect(self.test_db) as connection:
+            connection.execute("UPDATE MPCommons SET TwitterHandle='Mark4Ceredigion' \
+                                WHERE OfficialId=123456789")
+        self.assertEqual(resolver.resolve(u"mark4ceredigion"), None)
+        self.bump_generation()
+        self.assertEqual(resolver.resolve(u"mark4ceredigion").Name, u"Mark Williams")
+        self.assertFalse(resolver.accounts() is accounts)
+
+        # reload() doesn't wait for the generation
+        with sqlite3.connect(self.test_db) as connection:
+            connection.execute("UPDATE MPCommons SET TwitterHandle=NULL WHERE OfficialId=123456789")
+        self.assertFalse(u"mark4ceredigion" in resolver.reload())
+
+        # between checks, lookups don't touch the db
+        resolver.check_interval = 3600
+        with self.arch.count_queries() as counter:
+            for _ in range(100):
+                resolver.resolve(u"whatahandle")
+        self.assertEqual(counter.count, 0)
+
+
+class TestAsyncArchipelagoMethods(ReferenceDatabaseTestCase):
+    def test_async_accessors_match_sync(self):
+        '''ACCESS:: Test the async accessors return futures of the same records as the sync ones'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        with async_archipelago.AsyncArchipelago("sqlite:///test.db") as client:
+            mps = client.get_all_mps()
+            twitter_users = client.get_twitter_users()
+            by_id = client.get_mps_by_official_id([987654321, 123456789], as_records='dict')
+
+            done = []
+            mps.add_done_callback(done.append)
+            self.assertEqual(mps.result(timeout=10), arch.get_all_mps(as_records=True))
+            self.assertEqual(done, [mps])
+            self.assertEqual(twitter_users.result(timeout=10), arch.get_twitter_users())
+            self.assertEqual(by_id.result(timeout=10), 
+                arch.get_mps_by_official_id([987654321, 123456789], as_records='dict'))
+
+    def test_async_results_are_records(self):
+        '''ACCESS:: Test the async accessors refuse to hand ORM objects across threads'''
+        with async_archipelago.AsyncArchipelago("sqlite:///test.db") as client:
+            self.assertTrue(all(isinstance(mp, records.MPRecord) 
+                                for mp in client.get_all_tweeting_mps().result(timeout=10)))
+            self.assertRaises(ValueError, client.get_all_mps, as_records=False)
+            self.assertRaises(ValueError, client.get_all_tweeting_mps, as_records=False)
+            self.assertRaises(ValueError, client.get_mps_by_official_id, [5], as_records=False)
+
+    def test_async_lookups_are_merged(self):
+        '''ACCESS:: Test concurrent official id lookups are answered by one query'''
+        calls = []
+        real_lookup = archipelago.Archipelago.lookup_mps
+        def counted_lookup(arch, keys, *args):
+            calls.append(keys)
+            return real_lookup(arch, keys, *args)
+        archipelago.Archipelago.lookup_mps = counted_lookup
+        self.addCleanup(setattr, archipelago.Archipelago, 'lookup_mps', real_lookup)
+
+        with async_archipelago.AsyncArchipelago("sqlite:///test.db", workers=1) as client:
+            # hold the only worker, so the lookups queue up behind it
+            gate = threading.Event()
+            blocker = client._submit(gate.wait)
+            lookups = [client.get_mps_by_official_id([o_id]) 
+                        for o_id in [123456789, 987654321, 5] * 100]
+            gate.set()
+
+            names = [[mp.Name for mp in lookup.result(timeout=10)] for lookup in lookups]
+            self.assertEqual(names[:3], [[u"Mark Williams"], [u"William Marks"], []])
+            self.assertEqual(names, names[:3] * 100)
+            self.assertEqual(calls, [[5, 123456789, 987654321]])
+
+    def test_async_errors_are_raised_by_result(self):
+        '''ACCESS:: Test an error on a worker is raised when the future's result is asked for'''
+        def broken(arch, **kwargs):
+            raise ValueError('broken')
+        real_get_all_mps = archipelago.Archipelago.get_all_mps
+        archipelago.Archipelago.get_all_mps = broken
+        self.addCleanup(setattr, archipelago.Archipelago, 'get_all_mps', real_get_all_mps)
+
+        with async_archipelago.AsyncArchipelago("sqlite:///test.db") as client:
+            future = client.get_all_mps()
+            self.assertRaises(ValueError, future.result, 10)
+            self.assertTrue(isinstance(future.exception(10), ValueError))
+
+
+class TestEagerLoadingMethods(ReferenceDatabaseTestCase):
+    def touch_relationships(self, mps):
+        return [(mp.Name, sorted(a.Address for a in mp.Addresses), 
+                 sorted(o.Title for o in mp.Offices)) for mp in mps]
+
+    def test_eager_loading_avoids_n_plus_one(self):
+        '''ACCESS:: Test all MPs with addresses and offices load in at most three queries'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+
+        with arch.count_queries() as lazy:
+            lazy_result = self.touch_relationships(arch.get_all_mps())
+        arch.session.expunge_all()
+
+        for strategy in ('subquery', 'joined'):
+            with arch.count_queries() as eager:
+                eager_result = self.touch_relationships(
+                    arch.get_all_mps(load=('addresses', 'offices'), strategy=strategy))
+            arch.session.expunge_all()
+
+            self.assertEqual(eager_result, lazy_result)
+            self.assertTrue(eager.count <= 3)
+
+        self.assertEqual(lazy.count, 1 + 2*4)
+
+    def test_unknown_relationship(self):
+        '''ACCESS:: Test loading an unknown relationship raises ValueError'''
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        self.assertRaises(ValueError, arch.get_all_mps, load=('committees',))
+
+
+class TestSearchMethods(ReferenceDatabaseTestCase):
+    def setUp(self):
+        super(TestSearchMethods, self).setUp()
+        session = sessionmaker(bind=self.engine)()
+        self.assertTrue(search_index.build_search_index(session))
+        session.commit()
+        self.arch = archipelago.Archipelago("sqlite:///test.db")
+
+    def names(self, results):
+        return [r['name'] for r in results]
+
+    def test_search_prefixes_and_offices(self):
+        '''ACCESS:: Test search ranks name, constituency, party and office matches'''
+        # an exact match isn't padded with fuzzy near misses (William Marks)
+        self.assertEqual(self.names(self.arch.search('mark williams')), [u"Mark Williams"])
+        self.assertEqual(set(self.names(self.arch.search('mark will'))[:2]), 
+                         set([u"Mark Williams", u"William Marks"]))
+        self.assertEqual(self.names(self.arch.search('ceredig')), [u"Mark Williams"])
+        self.assertEqual(self.names(self.arch.search('foreign secretary')), [u"Mark Williams"])
+        self.assertEqual(self.names(self.arch.search('belfast')), [u"Mill Warkiams"])
+        self.assertEqual(set(self.names(self.arch.search('welsh affairs'))), 
+                         set([u"Mark Williams", u"Mill Warkiams"]))
+        self.assertEqual(len(self.arch.search('labour', limit=1)), 1)
+
+    def test_search_tolerates_misspellings(self):
+        '''ACCESS:: Test fuzzy trigram matches catch misspelt queries'''
+        self.assertEqual(self.names(self.arch.search('wiliams'))[0], u"Mark Williams")
+        self.assertEqual(self.names(self.arch.search('york outr'))[0], u"William Marks")
+        self.assertEqual(self.arch.search('zzzz'), [])
+
+    def test_search_without_fts(self):
+        '''ACCESS:: Test search falls back to the trigram index without an FTS5 table'''
+        self.arch.session.execute('DROP TABLE %s' % search_index.fts_table)
+        self.assertEqual(self.names(self.arch.search('ceredigion'))[0], u"Mark Williams")
+
+
+class TestSchemaMethods(unittest.TestCase):
+    def setUp(self):
+        self.test_db = "test.db"
+
+    def tearDown(self):
+        os.remove(self.test_db)
+
+    def explain(self, arch, query):
+        statement = query.statement.compile(dialect=arch._engine.dialect, 
+                                            compile_kwargs={'literal_binds':True})
+        plan = arch._engine.execute('EXPLAIN QUERY PLAN %s' % statement).fetchall()
+        return ' | '.join(tuple(row)[-1] for row in plan)
+
+    def test_accessors_use_indexes(self):
+        '''ACCESS:: Test EXPLAIN QUERY PLAN shows the hot filters and sorts using indexes'''
+        load_reference_database(self.test_db)
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        MPCommons, Address, Office = archipelago.MPCommons, archipelago.Address, archipelago.Office
+
+        twitter_plan = self.explain(arch, arch.session.query(MPCommons, Address.Address).\
+            join(MPCommons.Addresses).filter(Address.AddressType=='twitter'))
+        self.assertIn('INDEX ix_Addresses_AddressType_OfficialId (AddressType=?', twitter_plan)
+
+        by_name_plan = self.explain(arch, arch.session.query(MPCommons).order_by(MPCommons.Name))
+        self.assertIn('INDEX ix_MPCommons_Name', by_name_plan)
+        self.assertNotIn('TEMP B-TREE', by_name_plan)
+
+        for query, index in [
+                (arch.session.query(MPCommons).filter(MPCommons.Party=='Labour'), 'ix_MPCommons_Party'),
+                (arch.session.query(MPCommons).filter(MPCommons.MP==0), 'ix_MPCommons_MP'),
+                (arch.session.query(MPCommons).filter(MPCommons.TwitterHandle=='whatahandle'), 
+                    'ix_MPCommons_TwitterHandle'),
+                (arch.session.query(Office).filter(Office.EndDate=='9999-12-31'), 
+                    'ix_Offices_EndDate'),
+                (arch.session.query(Office).filter(Office.IsCurrent==True, Office.PersonId==11489),
+                    'ix_Offices_IsCurrent_PersonId'),
+                (arch.session.query(Office).filter(Office.IsCurrent==True, 
+                    Office.Office=='Treasury'), 'ix_Offices_IsCurrent_Office')]:
+            self.assertIn('INDEX %s' % index, self.explain(arch, query))
+
+    def test_migrate_existing_database(self):
+        '''LOAD:: Test a database built before the indexes and handle column is migrated'''
+        with sqlite3.connect(self.test_db) as connection:
+            connection.executescript("""
+                CREATE TABLE "MPCommons" ("Name" VARCHAR, "Constituency" VARCHAR NOT NULL, 
+                    "MP" INTEGER, "Party" VARCHAR, "ImageUrl" VARCHAR, "MemberId" INTEGER, 
+                    "PersonId" INTEGER, "OfficialId" INTEGER, PRIMARY KEY ("Constituency"), 
+                    UNIQUE ("MemberId"), UNIQUE ("PersonId"));
+                CREATE UNIQUE INDEX "ix_MPCommons_OfficialId" ON "MPCommons" ("OfficialId");
+                CREATE TABLE "Offices" ("PersonId" INTEGER NOT NULL, "Office" VARCHAR NOT NULL, 
+                    "StartDate" VARCHAR NOT NULL, "EndDate" VARCHAR, "Name" VARCHAR, 
+                    "Title" VARCHAR NOT NULL, PRIMARY KEY ("PersonId", "Office", "StartDate", "Title"));
+                CREATE TABLE "Addresses" ("OfficialId" INTEGER NOT NULL, "AddressType" VARCHAR, 
+                    "Address" VARCHAR NOT NULL, PRIMARY KEY ("OfficialId", "Address"));
+                INSERT INTO MPCommons VALUES ('Mill Warkiams', 'Belfast West', 1, 'Labour', 
+                    NULL, 40732, 11493, 11223344);
+                INSERT INTO Addresses VALUES (11223344, 'twitter', 'https://twitter.com/whatahandle/');
+            """)
+
+        arch = archipelago.Archipelago("sqlite:///test.db")
+
+        self.assertEqual(arch.get_twitter_users()[0]["handle"], "whatahandle")
+        self.assertEqual(arch.twitter_resolver().resolve(u"WhatAHandle").Name, u"Mill Warkiams")
+        self.assertEqual(migrations.migrate(arch._engine, arch._session_factory), [])
+        with sqlite3.connect(self.test_db) as connection:
+            indexes = set(row[0] for row in 
+                connection.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+        self.assertTrue(set(['ix_MPCommons_Name', 'ix_MPCommons_Party', 'ix_MPCommons_MP',
+                             'ix_MPCommons_TwitterHandle', 'ix_Offices_EndDate',
+                             'ix_Addresses_AddressType_OfficialId']) <= indexes)
+
+    def test_migrate_typed_office_dates(self):
+        '''LOAD:: Test string office dates are converted in place, and IsCurrent filled in'''
+        with sqlite3.connect(self.test_db) as connection:
+            connection.executescript("""
+                CREATE TABLE "Offices" ("PersonId" INTEGER NOT NULL, "Office" VARCHAR NOT NULL, 
+                    "StartDate" VARCHAR NOT NULL, "EndDate" VARCHAR, "Name" VARCHAR, 
+                    "Title" VARCHAR NOT NULL, PRIMARY KEY ("PersonId", "Office", "StartDate", "Title"));
+                CREATE INDEX "ix_Offices_EndDate" ON "Offices" ("EndDate");
+                INSERT INTO Offices VALUES (11489, 'Foreign Office', '2010-05-12', '2014-07-15',
+                    'Mark Williams', 'Minister');
+                INSERT INTO Offices VALUES (11489, 'Foreign Office', '2014-07-15', '9999-12-31',
+                    'Mark Williams', 'Foreign Secretary');
+                INSERT INTO Offices VALUES (11489, 'Treasury', 'unknown', '9999-12-31',
+                    'Mark Williams', 'Minister');
+            """)
+        engine = create_engine("sqlite:///test.db")
+        changes = migrations.migrate(engine, sessionmaker(bind=engine))
+        self.assertIn('retyped column Offices.StartDate', changes)
+        self.assertIn('retyped column Offices.EndDate', changes)
+        self.assertIn('added column Offices.IsCurrent', changes)
+        self.assertEqual(migrations.migrate(engine, sessionmaker(bind=engine)), [])
+
+        arch = archipelago.Archipelago("sqlite:///test.db")
+        offices = arch.session.query(archipelago.Office).order_by(archipelago.Office.StartDate).all()
+        self.assertEqual([(o.StartDate, o.EndDate, o.IsCurrent) for o in offices], [
+            (datetime.date(2010, 5, 12), datetime.date(2014, 7, 15), False),
+            (datetime.date(2014, 7, 15), datetime.date(9999, 12, 31), True)])
+        self.assertEqual([o.Title for o in arch.get_current_offices(person_id=11489)],
+                         [u"Foreign Secretary"])
+        arch.close()
+        engine.dispose()
+
+    def legacy_offices(self, name="Offices"):
+        with sqlite3.connect(self.test_db) as connection:
+            connection.executescript("""
+                CREATE TABLE "%s" ("PersonId" INTEGER NOT NULL, "Office" VARCHAR NOT NULL, 
+                    "StartDate" VARCHAR NOT NULL, "EndDate" VARCHAR, "Name" VARCHAR, 
+                    "Title" VARCHAR NOT NULL, PRIMARY KEY ("PersonId", "Office", "StartDate", "Title"));
+                INSERT INTO "%s" VALUES (11489, 'Foreign Office', '2010-05-12', '2014-07-15',
+                    'Mark Williams', 'Minister');
+                INSERT INTO "%s" VALUES (11489, 'Foreign Office', '2014-07-15', '9999-12-31',
+                    'Mark Williams', 'Foreign Secretary');
+            """ % (name, name, name))
+
+    def office_rows(self, engine):
+        return [(row.StartDate, row.Title) for row in engine.execute(
+                    'SELECT * FROM Offices ORDER BY StartDate')]
+
+    def test_retyping_failure_keeps_data(self):
+        '''LOAD:: Test a retype which fails part way leaves the table as it was, and is retried'''
+        self.legacy_offices()
+        engine = create_engine("sqlite:///test.db")
+        self.addCleanup(engine.dispose)
+        real_to_date = history.to_date
+        converted = []
+        def failing_to_date(value, default=None):
+            converted.append(value)
+            if len(converted) > 2:
+                raise ValueError('interrupted')
+            return real_to_date(value, default)
+        history.to_date = failing_to_date
+        try:
+            self.assertRaises(ValueError, migrations.migrate, engine, sessionmaker(bind=engine))
+        finally:
+            history.to_date = real_to_date
+
+        self.assertEqual(self.office_rows(engine), [(u'2010-05-12', u'Minister'),
+                                                    (u'2014-07-15', u'Foreign Secretary')])
+        changes = migrations.migrate(engine, sessionmaker(bind=engine))
+        self.assertIn('dropped partial Offices_retyping', changes)
+        self.assertIn('retyped column Offices.StartDate', changes)
+        self.assertEqual(self.office_rows(engine), [(u'2010-05-12', u'Minister'),
+                                                    (u'2014-07-15', u'Foreign Secretary')])
+        self.assertEqual(migrations.migrate(engine, sessionmaker(bind=engine)), [])
+        self.assertFalse('Offices_retyping' in inspect(engine).get_table_names())
+
+    def test_failed_backfill_is_retried(self):
+        '''LOAD:: Test a backfill which fails after its column is added is run again by the next migrate'''
+        self.legacy_offices()
+        engine = create_engine("sqlite:///test.db")
+        self.addCleanup(engine.dispose)
+        key = (archipelago.Office.__tablename__, 'IsCurrent')
+        backfill = migrations.BACKFILLS[key]
+        def failing_backfill(session):
+            raise ValueError('interrupted')
+        migrations.BACKFILLS[key] = failing_backfill
+        try:
+            self.assertRaises(ValueError, migrations.migrate, engine, sessionmaker(bind=engine))
+        finally:
+            migrations.BACKFILLS[key] = backfill
+
+        current = 'SELECT IsCurrent FROM Offices ORDER BY StartDate'
+        # the added column holds its default: the current office is wrongly marked
+        self.assertEqual([row[0] for row in engine.execute(current)], [0, 0])
+        self.assertEqual(migrations.migrate(engine, sessionmaker(bind=engine)), [])
+        self.assertEqual([row[0] for row in engine.execute(current)], [0, 1])
+        self.assertEqual(migrations.pending_backfills(engine), [])
+
+    def test_retyping_resumes_after_drop(self):
+        '''LOAD:: Test a complete copy left by a retype interrupted after the drop is put in place'''
+        self.legacy_offices()
+        engine = create_engine("sqlite:///test.db")
+        self.addCleanup(engine.dispose)
+        real_rename = migrations._rename_into_place
+        def interrupted(connection, table):
+            raise ValueError('interrupted')
+        migrations._rename_into_place = interrupted
+        try:
+            self.assertRaises(ValueError, migrations.migrate, engine, sessionmaker(bind=engine))
+        finally:
+            migrations._rename_into_place = real_rename
+        self.assertFalse('Offices' in inspect(engine).get_table_names())
+
+        changes = migrations.migrate(engine, sessionmaker(bind=engine))
+        self.assertIn('resumed retyping Offices', changes)
+        self.assertEqual(self.office_rows(engine), [(u'2010-05-12', u'Minister'),
+                                                    (u'2014-07-15', u'Foreign Secretary')])
+        self.assertTrue('ix_Offices_EndDate' in 
+                        [i['name'] for i in inspect(engine).get_indexes('Offices')])
+
+    def test_retyping_restores_earlier_leftover(self):
+        '''LOAD:: Test an old table left aside by an earlier, interrupted retype is put back'''
+        self.legacy_offices(name="Offices_retyping")
+        engine = create_engine("sqlite:///test.db")
+        self.addCleanup(engine.dispose)
+        archipelago.Office.__table__.create(engine)
+
+        changes = migrations.migrate(engine, sessionmaker(bind=engine))
+        self.assertIn('restored Offices from Offices_retyping', changes)
+        self.assertEqual(self.office_rows(engine), [(u'2010-05-12', u'Minister'),
+                                                    (u'2014-07-15', u'Foreign Secretary')])
+
+
 class TestDatabaseAccessorMethods(unittest.TestCase):
     def setUp(self):
         self.test_db = "test.db"
@@ -493,14 +2261,16 @@ class TestDatabaseAccessorMethods(unittest.TestCase):
                     "2015-07-13",
                     "9999-12-31",
                     "Mark Williams",
-                    "Member"
+                    "Member",
+                    1
                 ),(
                     11489,
                     "Foreign Office",
                     "2015-07-13", 
                     "9999-12-31", 
                     "Mark Williams",
-                    "Foreign Secretary"
+                    "Foreign Secretary",
+                    1
                 )
             ],
             [
@@ -515,7 +2285,7 @@ class TestDatabaseAccessorMethods(unittest.TestCase):
             cur = connection.cursor()
             cur.executemany('UPDATE MPCommons SET Name=?,Party=?,MP=1,MemberId=?,PersonId=?, OfficialId=?\
                             WHERE Constituency=?', test_reference[0])  
-            cur.executemany('INSERT INTO Offices VALUES(?,?,?,?,?,?)', test_reference[1])
+            cur.executemany('INSERT INTO Offices VALUES(?,?,?,?,?,?,?)', test_reference[1])
             cur.executemany('INSERT INTO Addresses VALUES(?,?,?)', test_reference[2])
 
     def tearDown(self):